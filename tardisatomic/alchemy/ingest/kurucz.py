@@ -3,12 +3,45 @@ from tardisatomic.alchemy import Ion, Level, Transition, TransitionType, Transit
 from tardisatomic.alchemy.ingest import BaseIngest
 
 from tardisatomic.kurucz.io import (read_gfall_raw, parse_gfall,
-                                    extract_levels, extract_lines)
+                                    extract_levels, extract_lines,
+                                    select_gfall_lines, GFallCache)
 from tardisatomic.util import convert_air_to_vacuum
 import pandas as pd
 import numpy as np
 
-import ipdb
+
+def read_gfall_levels_lines(fname, atoms=None, cache_dir=None):
+    """
+    Levels and lines of gfall.dat
+
+    Only the lines of `atoms` are parsed - they are selected while reading
+    the file or, with `cache_dir`, from the cached raw gfall table.
+
+    Parameters
+    ----------
+
+    fname: ~str
+        path to gfall.dat
+    atoms: list
+        atomic numbers (optional - default=None uses all lines)
+    cache_dir: ~str
+        directory of the gfall cache (optional - default=None reads fname)
+
+    Returns
+    -------
+        : ~pandas.DataFrame
+            levels
+        : ~pandas.DataFrame
+            lines
+    """
+    if cache_dir is None:
+        gfall_raw = read_gfall_raw(fname, atoms=atoms)
+    else:
+        gfall_raw = select_gfall_lines(
+            GFallCache(cache_dir).read_gfall_raw(fname), atoms=atoms)
+    gfall_parsed = parse_gfall(gfall_raw)
+    levels = extract_levels(gfall_parsed)
+    return levels, extract_lines(gfall_parsed, levels)
 
 
 class IngestGFAll(BaseIngest):
@@ -22,12 +55,10 @@ class IngestGFAll(BaseIngest):
         else:
             return wavelength
 
-    def ingest(self, fname, exclude_atoms=[]):
-        gfall = read_gfall_raw(fname)
-        gfall_parsed = parse_gfall(gfall)
-        levels = extract_levels(gfall_parsed)
-
-        lines = extract_lines(gfall_parsed, levels)
+    def ingest(self, fname, exclude_atoms=[], cache_dir=None):
+        include_atoms = list(set(np.arange(1, 31)) - set(exclude_atoms))
+        levels, lines = read_gfall_levels_lines(fname, atoms=include_atoms,
+                                                cache_dir=cache_dir)
 
         units_angstrom = Unit(unit='angstrom')
         units_none = Unit(unit='None')
@@ -47,7 +78,6 @@ class IngestGFAll(BaseIngest):
         self.atomic_db.session.add(value_type_loggf)
         self.atomic_db.session.commit()
 
-        include_atoms = list(set(np.arange(0, 30)) - set(exclude_atoms))
         levels['alchemy_level'] = 0
         levels = levels.ix[levels['atomic_number'].isin(include_atoms)]
         _tmp = []
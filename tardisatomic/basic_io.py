@@ -7,12 +7,168 @@ import os
 
 import pandas as pd
 
+from tardisatomic import sqlite_ndarray, keys
+
 class TARDISAtomicError(Exception):
     pass
 
 class MissingAtomicData(TARDISAtomicError):
     pass
 
+def line_level_keys(lines_data, level_type):
+    """
+    Keys of the 'upper' or 'lower' levels of the lines
+    """
+    return keys.pack(lines_data['atomic_number'].values,
+                     lines_data['ion_number'].values,
+                     lines_data['level_number_' + level_type].values)
+
+
+def auto_ionizing_lines_mask(lines_data, auto_ionizing_levels):
+    """
+    Mask of the lines with an auto-ionizing upper or lower level
+
+    Parameters
+    ----------
+
+    lines_data: ~pandas.DataFrame
+        lines with atomic_number, ion_number, level_number_upper and
+        level_number_lower columns
+    auto_ionizing_levels: ~pandas.DataFrame
+        levels indexed by (atomic_number, ion_number, level_number)
+    """
+    auto_ionizing_keys = keys.index_keys(auto_ionizing_levels.index)
+    return (keys.isin(line_level_keys(lines_data, 'upper'), auto_ionizing_keys) |
+            keys.isin(line_level_keys(lines_data, 'lower'), auto_ionizing_keys))
+
+
+def referenced_level_keys(lines_data):
+    """
+    Sorted unique keys of the upper and lower levels of the lines
+    """
+    return np.union1d(line_level_keys(lines_data, 'upper'),
+                      line_level_keys(lines_data, 'lower'))
+
+
+def levels_without_lines(levels, lines_data):
+    """
+    Index of the levels that are neither the upper nor the lower level of a
+    line
+    """
+    return levels.index[~keys.isin(keys.index_keys(levels.index),
+                                   referenced_level_keys(lines_data))]
+
+
+def orphan_levels_mask(levels_data, lines_data):
+    """
+    Mask of the levels that are not referenced by any line
+
+    Fully ionized levels and artificial levels (source tardis_artificial*)
+    are never orphans.
+
+    Parameters
+    ----------
+
+    levels_data: ~pandas.DataFrame
+        levels with a source column, indexed by (atomic_number, ion_number,
+        level_number)
+    lines_data: ~pandas.DataFrame
+        lines with atomic_number, ion_number, level_number_upper and
+        level_number_lower columns
+    """
+    referenced = keys.isin(keys.index_keys(levels_data.index),
+                           referenced_level_keys(lines_data))
+    fully_ionized = (levels_data.index.get_level_values(0).values ==
+                     levels_data.index.get_level_values(1).values)
+    artificial = levels_data['source'].str.startswith(
+        'tardis_artificial').values.astype(bool)
+    return ~(referenced | fully_ionized | artificial)
+
+
+def renumber_levels(levels_data):
+    """
+    Number the levels of every ion consecutively from 0 in the order of
+    `levels_data`
+
+    Parameters
+    ----------
+
+    levels_data: ~pandas.DataFrame
+        levels indexed by (atomic_number, ion_number, level_number)
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            new level numbers of the levels
+        : tuple
+            sorted keys of the previous level numbers and the corresponding
+            new level numbers (see `remap_level_numbers`)
+    """
+    level_numbers = levels_data.groupby(level=[0, 1],
+                                        sort=False).cumcount().values
+    level_keys = keys.index_keys(levels_data.index)
+    order = np.argsort(level_keys, kind='mergesort')
+    return level_numbers, (level_keys[order], level_numbers[order])
+
+
+def remap_level_numbers(level_number_map, level_keys):
+    """
+    New level numbers of the level keys (nan for levels that do not exist)
+
+    Parameters
+    ----------
+
+    level_number_map: tuple
+        sorted keys and new level numbers returned by `renumber_levels`
+    level_keys: ~numpy.ndarray
+        keys of the previous level numbers (e.g. `line_level_keys`)
+    """
+    sorted_keys, level_numbers = level_number_map
+    if len(sorted_keys) == 0:
+        return np.repeat(np.nan, len(level_keys))
+    positions = keys.lookup(sorted_keys, level_keys, assume_sorted=True)
+    return np.where(positions >= 0, level_numbers[positions], np.nan)
+
+
+def metastable_levels_mask(levels_data, lines_data):
+    """
+    Mask of the levels that are not the upper level of any of the lines
+
+    Parameters
+    ----------
+
+    levels_data: ~pandas.DataFrame
+        levels indexed by (atomic_number, ion_number, level_number)
+    lines_data: ~pandas.DataFrame
+        lines with atomic_number, ion_number and level_number_upper columns
+        (e.g. the lines above the metastable loggf threshold)
+    """
+    return ~keys.isin(keys.index_keys(levels_data.index),
+                      line_level_keys(lines_data, 'upper'))
+
+
+def levels_ionization_energy(levels_data, ionization_data):
+    """
+    Ionization energy of the ion of every level (nan if it is not in
+    `ionization_data`)
+
+    Parameters
+    ----------
+
+    levels_data: ~pandas.DataFrame
+        levels indexed by (atomic_number, ion_number, level_number)
+    ionization_data: ~pandas.DataFrame
+        ionization energies indexed by (atomic_number, ion_number) - the ion
+        number is the one of the ion that is created by the ionization
+    """
+    positions = keys.lookup(
+        keys.index_keys(ionization_data.index),
+        keys.pack(levels_data.index.get_level_values(0).values,
+                  levels_data.index.get_level_values(1).values + 1))
+    return np.where(positions >= 0,
+                    ionization_data.iloc[:, 0].values[positions], np.nan)
+
+
 class BasicAtomicData(object):
     """
     Basic class for all data imports with TARDIS atomic.
@@ -69,7 +225,7 @@ class BasicAtomicData(object):
             logging.critical('Atomic Database {0} does not exist'.format(sql_fname))
             raise MissingAtomicData('Atomic Database {0} does not exist'.format(sql_fname))
 
-        return sqlite3.connect(sql_fname)
+        return sqlite_ndarray.connect(sql_fname)
 
 
 
@@ -122,8 +278,8 @@ class LevelsLines(BasicAtomicData):
                             ('f_lu', np.float), ('loggf', np.float), ('level_number_lower', np.int),
                             ('level_number_upper', np.int), ('source', '|S64')]
 
-        lines_data = self.sqlconn.execute(lines_data_sql_stmt).fetchall()
-        lines_data = np.array(lines_data, dtype=lines_data_dtype)
+        lines_data = sqlite_ndarray.read_structured(
+            self.sqlconn, lines_data_sql_stmt, lines_data_dtype)
 
         lines_data = pd.DataFrame(lines_data)
 
@@ -136,14 +292,6 @@ class LevelsLines(BasicAtomicData):
         lines_data['A_ul'] = 2 * einstein_coeff * lines_data['nu'] ** 2 / constants.c.cgs.value ** 2 * lines_data[
             'f_ul']
 
-        lines_data_level_number_upper = lines_data.set_index(['atomic_number', 'ion_number', 'level_number_upper'])
-        lines_data_level_number_upper = lines_data_level_number_upper.groupby(
-            level=['atomic_number', 'ion_number', 'level_number_upper'])
-
-        lines_data_level_number_lower = lines_data.set_index(['atomic_number', 'ion_number', 'level_number_lower'])
-        lines_data_level_number_lower = lines_data_level_number_lower.groupby(
-            level=['atomic_number', 'ion_number', 'level_number_lower'])
-
         if ion_filter_stmt is not None:
             where_stmt.append(ion_filter_stmt)
         if atom_filter_stmt is not None:
@@ -157,8 +305,8 @@ class LevelsLines(BasicAtomicData):
         levels_dtype = [('atomic_number', np.int), ('ion_number', np.int), ('level_number', np.int),
                         ('energy', np.float), ('g', np.int), ('source', '|S64')]
 
-        levels_data = self.sqlconn.execute(levels_sql_stmt).fetchall()
-        levels_data = np.array(levels_data, dtype=levels_dtype)
+        levels_data = sqlite_ndarray.read_structured(
+            self.sqlconn, levels_sql_stmt, levels_dtype)
         levels_data = pd.DataFrame(levels_data)
         levels_data.set_index(['atomic_number', 'ion_number', 'level_number'], inplace=True)
 
@@ -169,12 +317,7 @@ class LevelsLines(BasicAtomicData):
             logging.warning('METASTABLE_LOGGF_THRESHOLD not set. Using default! loggf > -3 ')
             lines_data_level_number_upper_meta = lines_data[lines_data.loggf > -3]
 
-        lines_data_level_number_upper_meta = lines_data_level_number_upper_meta.groupby(
-            ['atomic_number', 'ion_number', 'level_number_upper'])
-
-        count_down = lines_data_level_number_upper_meta['line_id'].count()
-        levels_data['metastable'] = count_down == 0
-        levels_data['metastable'] = pd.isnull(levels_data['metastable'])
+        levels_data['metastable'] = metastable_levels_mask(levels_data, lines_data_level_number_upper_meta)
 
         try:
             ionization_data = self.config['IONIZATION_DATA']
@@ -183,136 +326,44 @@ class LevelsLines(BasicAtomicData):
                              'ionization data are required. Abort!')
             raise
 
-        levels_atom_ion_index = zip(levels_data.index.get_level_values('atomic_number'),
-                                    levels_data.index.get_level_values('ion_number').values + 1)
-
-        levels_ionization_energy = ionization_data.ix[levels_atom_ion_index]
-        levels_ionization_energy = levels_ionization_energy.values.reshape(levels_ionization_energy.shape[0])
-
-        auto_ionizing_levels_mask = (levels_data.energy >= levels_ionization_energy).values
+        auto_ionizing_levels_mask = (levels_data.energy.values >=
+                                     levels_ionization_energy(levels_data, ionization_data))
 
         auto_ionizing_levels = levels_data[auto_ionizing_levels_mask]
 
-        auto_ionizing_line_ids = []
-
+        all_lines_data = lines_data
         # Culling lines_data with low gf values
         lines_data = lines_data[(lines_data.source != 'kurucz') | (lines_data.loggf > args.kurucz_loggf_threshold)]
         print "Cleaning auto-ionizing"
-        for index in auto_ionizing_levels.index:
-            index_in_lines = False
-            try:
-                line_group = lines_data_level_number_upper.get_group(index)
-            except KeyError:
-                pass
-            else:
-                auto_ionizing_line_ids += line_group.line_id.values.tolist()
-                index_in_lines = True
-
-            try:
-                line_group = lines_data_level_number_lower.get_group(index)
-            except KeyError:
-                pass
-            else:
-                auto_ionizing_line_ids += line_group.line_id.values.tolist()
-                index_in_lines = True
-
-            if not index_in_lines:
-                print "INDEX %s not in lines" % (index,)
-
-        auto_ionizing_line_ids = np.unique(auto_ionizing_line_ids)
-        lines_data = lines_data[~lines_data.reset_index().line_id.isin(auto_ionizing_line_ids).values]
+        for index in levels_without_lines(auto_ionizing_levels, all_lines_data):
+            print "INDEX %s not in lines" % (index,)
+
+        lines_data = lines_data[~auto_ionizing_lines_mask(lines_data, auto_ionizing_levels)]
         levels_data = levels_data[~auto_ionizing_levels_mask]
 
         print "cleaning levels which don't exist in lines"
-        existing_levels_ids = []
-        for idx, line in levels_data.reset_index().iterrows():
-            index_in_lines = False
-            index = line['atomic_number'], line['ion_number'], line['level_number']
-
-            try:
-                line_group = lines_data_level_number_upper.get_group(index)
-            except KeyError:
-                if index[0] == index[1]:
-                    #print "Found fully ionized %s" % (index,)
-                    index_in_lines = True
-                elif line['source'].startswith('tardis_artificial'):
-                    #print "Found artifical ion level %s" % (index, )
-                    index_in_lines = True
-                else:
-                    pass
-            else:
-                index_in_lines = True
-
-            try:
-                line_group = lines_data_level_number_lower.get_group(index)
-            except KeyError:
-                if index[0] == index[1]:
-                    #print "Found fully ionized %s" % (index,)
-                    index_in_lines = True
-                elif line['source'].startswith('tardis_artificial'):
-                    #print "Found artifical ion level %s" % (index, )
-                    index_in_lines = True
-                else:
-                    pass
-                pass
-            else:
-                index_in_lines = True
-
-            if not index_in_lines:
-                pass
-                #        print "INDEX %s not in lines" % (index,)
-            else:
-                existing_levels_ids.append(index)
-
+        orphan_levels = orphan_levels_mask(levels_data, all_lines_data)
         print "Found %d levels which don't exist in lines (total=%d levels)" % (
-        len(levels_data) - len(existing_levels_ids), len(levels_data))
-        levels_data = levels_data.ix[existing_levels_ids]
-        levels_prev_index = pd.Series(index=levels_data.index.copy())
-        levels_data.reset_index(inplace=True)
-        levels_data.set_index(['atomic_number', 'ion_number'], inplace=True)
+        orphan_levels.sum(), len(levels_data))
+        levels_data = levels_data[~orphan_levels]
 
         print "Relabeling index numbers"
-
-        for index in np.unique(levels_data.index.values):
-            levels_prev_index.ix[index] = np.arange(levels_data.ix[index].level_number.count())
-            levels_data.loc[index, 'level_number'] = np.arange(levels_data.ix[index].level_number.count())
+        level_numbers, level_number_map = renumber_levels(levels_data)
+        levels_data.reset_index(inplace=True)
+        levels_data['level_number'] = level_numbers
+        levels_data.set_index(['atomic_number', 'ion_number'], inplace=True)
 
         self._levels_data = levels_data
-        self._levels_prev_index = levels_prev_index
+        self._level_number_map = level_number_map
         self._lines_data = lines_data
 
 
 
 
     def prepare(self):
-
-
-        lines_data_level_number_upper = self._lines_data.set_index(
-            ['atomic_number', 'ion_number', 'level_number_upper'])
-        lines_data_level_number_upper_index = lines_data_level_number_upper.index.copy()
-        lines_data_level_number_upper = lines_data_level_number_upper.groupby(
-            level=['atomic_number', 'ion_number', 'level_number_upper'])
-
-        lines_data_level_number_lower = self._lines_data.set_index(
-            ['atomic_number', 'ion_number', 'level_number_lower'])
-        lines_data_level_number_lower_index = lines_data_level_number_lower.index.copy()
-        lines_data_level_number_lower = lines_data_level_number_lower.groupby(
-            level=['atomic_number', 'ion_number', 'level_number_lower'])
-
-        self._lines_data.level_number_lower = self._levels_prev_index.ix[lines_data_level_number_lower_index].values
-        self._lines_data.level_number_upper = self._levels_prev_index.ix[lines_data_level_number_upper_index].values
-
-        lines_data_level_number_upper = self._lines_data.set_index(
-            ['atomic_number', 'ion_number', 'level_number_upper'])
-        lines_data_level_number_upper_index = lines_data_level_number_upper.index.copy()
-        lines_data_level_number_upper = lines_data_level_number_upper.groupby(
-            level=['atomic_number', 'ion_number', 'level_number_upper'])
-
-        lines_data_level_number_lower = self._lines_data.set_index(
-            ['atomic_number', 'ion_number', 'level_number_lower'])
-        lines_data_level_number_lower_index = lines_data_level_number_lower.index.copy()
-        lines_data_level_number_lower = lines_data_level_number_lower.groupby(
-            level=['atomic_number', 'ion_number', 'level_number_lower'])
+        for level_type in ('lower', 'upper'):
+            self._lines_data['level_number_' + level_type] = remap_level_numbers(
+                self._level_number_map, line_level_keys(self._lines_data, level_type))
 
         lines_data = self._lines_data.set_index('line_id')
         levels_data = self._levels_data.reset_index().set_index(['atomic_number', 'ion_number', 'level_number'])
@@ -373,8 +424,8 @@ class CollisionData(BasicAtomicData):
 
         collision_data_dtype += [(str(item), np.float) for item in temperature_columns]
 
-        collision_data = self.sqlconn.execute(select_collision_stmt).fetchall()
-        self._collision_data = np.array(collision_data, dtype=collision_data_dtype)
+        self._collision_data = sqlite_ndarray.read_structured(
+            self.sqlconn, select_collision_stmt, collision_data_dtype)
 
     def save(self):
         with h5py.File(self.config['HDF5_FILE']) as hdf5_file:
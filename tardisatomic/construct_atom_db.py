@@ -1,20 +1,24 @@
 import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+from functools import partial
 import sqlite3
-import math
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
 import numpy as np
-#import macro_atom_transition
-from tardisatomic import import_ionDB, fileio, util, sql_stmts
+import pandas as pd
+from tardisatomic import import_ionDB, fileio, util, sql_stmts, sqlite_ndarray
+from tardisatomic.kurucz.io.gfall import gfall_raw_2_db
 from astropy import constants
 gfall_db = os.path.join(os.path.dirname(__file__), 'data', 'gfall.db3')
+gfall_schema_path = os.path.join(os.path.dirname(__file__), 'data',
+                                 'gfall.db3.schema')
 zeta_datafile = os.path.join(os.path.dirname(__file__), 'data', 'knox_long_recombination_zeta.dat')
 
 
-def convert_air2vacuum(wavelength):
-    if wavelength > 2000.:
-        return util.convert_air_to_vacuum(wavelength)
-    else:
-        return wavelength
-
 try:
     import sqlparse
     sqlparse_available = True
@@ -26,42 +30,307 @@ except ImportError:
 
 hc = (constants.h * constants.c).to('eV cm').value
 
-update_oscillator_stmt = """
-UPDATE
-    lines
-SET
-    f_ul = pow(10, loggf) / g_upper,
-    f_lu = pow(10, loggf) / g_lower
-"""
-    
-    
-def new_linelist_from_gfall(new_dbname, select_atom=None):
+# connection settings for the bulk loading of the database - the rollback
+# journal is kept in memory and nothing is synced to disk, so a crash during
+# the build leaves a corrupt database (the build has to be restarted)
+build_profiles = {
+    'safe': OrderedDict(),
+    'bulk': OrderedDict([('journal_mode', 'MEMORY'),
+                         ('synchronous', 'OFF'),
+                         ('cache_size', -1024**2),  # in KiB
+                         ('mmap_size', 2**30),
+                         ('temp_store', 'MEMORY')])}
+
+
+def set_pragmas(conn, pragmas):
+    """
+    Apply the `pragmas` (name: value) to `conn` and return the previous values
+
+    Pragmas that do not apply to the database (e.g. mmap_size for in-memory
+    databases) are skipped.
+    """
+    previous_pragmas = OrderedDict()
+    for name, value in pragmas.items():
+        previous_value = conn.execute('PRAGMA {0}'.format(name)).fetchone()
+        if previous_value is None:
+            continue
+        previous_pragmas[name] = previous_value[0]
+        conn.execute('PRAGMA {0} = {1}'.format(name, value))
+    return previous_pragmas
+
+
+@contextmanager
+def build_profile(conn, profile='bulk'):
+    """
+    Apply the pragmas of a build profile (see `build_profiles`) to `conn`
+
+    The previous settings are restored when the block is left and the query
+    planner statistics are updated with ANALYZE.
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    profile: ~str
+        name of the build profile (default='bulk')
+    """
+    previous_pragmas = set_pragmas(conn, build_profiles[profile])
+    try:
+        yield conn
+    finally:
+        set_pragmas(conn, previous_pragmas)
+    start_time = time.time()
+    conn.execute('ANALYZE')
+    conn.commit()
+    print "analyzed the database in {0:.2f} s".format(
+        time.time() - start_time)
+
+
+@contextmanager
+def attached_databases(conn, databases):
+    """
+    Attach the `databases` (schema name: file name) to `conn` within the
+    block
+
+    Databases can neither be attached nor detached within a transaction.
+    """
+    attached = []
+    try:
+        for schema_name, dbname in databases.items():
+            conn.execute('ATTACH DATABASE ? AS {0}'.format(schema_name),
+                         (dbname,))
+            attached.append(schema_name)
+        yield conn
+    finally:
+        for schema_name in attached:
+            conn.execute('DETACH DATABASE {0}'.format(schema_name))
+
+
+@contextmanager
+def build_stage(conn, name, databases=None):
+    """
+    Run the block as one explicit transaction on `conn`
+
+    The sqlite3 module commits implicitly before statements that are not
+    DML (e.g. CREATE TABLE), so `conn` is switched to manual transaction
+    handling within the block. The transaction is rolled back if the block
+    raises an exception.
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    name: ~str
+        name of the stage that is printed with its run time
+    databases: dict
+        databases (schema name: file name) that are attached before the
+        transaction begins and detached after it has ended (optional)
+    """
+    print "Starting build stage {0}".format(name)
+    start_time = time.time()
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        with attached_databases(conn, databases or {}):
+            conn.execute('BEGIN')
+            try:
+                yield conn
+            except:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+    finally:
+        conn.isolation_level = isolation_level
+    print "Finished build stage {0} in {1:.2f} s".format(
+        name, time.time() - start_time)
+
+
+def _copy_database_method(conn):
+    if hasattr(conn, 'backup'):
+        return 'backup'
+    elif sqlite3.sqlite_version_info >= (3, 27, 0):
+        return 'vacuum'
+    else:
+        return 'dump'
+
+
+def _count_dump_rows(conn):
+    """
+    Number of rows of the tables that are dumped by `conn.iterdump`
+    """
+    tables = [name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE sql NOT NULL AND "
+        "type == 'table'")
+              if not name.startswith('sqlite_') or
+              name in ('sqlite_sequence', 'sqlite_stat1')]
+    return sum(conn.execute('SELECT count(*) FROM "{0}"'.format(
+        name.replace('"', '""'))).fetchone()[0] for name in tables)
+
+
+def copy_database(conn, dbname, method=None, pages=4096, rows=100000):
+    """
+    Copy the database of `conn` (e.g. a database built in memory) to the file
+    `dbname`
+
+    The copy is written to `dbname`.partial which is renamed to `dbname` once
+    it is complete. The progress is printed in pages (backup and vacuum) or
+    rows (dump). VACUUM INTO reports the pages that have been written to the
+    partial file, which lag behind by up to the size of the page cache.
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    dbname: ~str
+    method: ~str
+        'backup' (online backup API, python >= 3.7), 'vacuum' (VACUUM INTO,
+        SQLite >= 3.27) or 'dump' (SQL dump of the database) - default=None
+        uses the first one that is available
+    pages: ~int
+        number of pages copied per step of the online backup and approximate
+        number of pages between the progress reports of VACUUM INTO
+        (default=4096)
+    rows: ~int
+        number of rows of the dump copied between progress reports
+        (default=100000)
+    """
+    if method is None:
+        method = _copy_database_method(conn)
+    print "Copying the database to {0} ({1})".format(dbname, method)
+    start_time = time.time()
+
+    partial_dbname = dbname + '.partial'
+    if os.path.exists(partial_dbname):
+        os.remove(partial_dbname)
+
+    if method == 'backup':
+        def print_progress(status, remaining, total):
+            print "copied {0:d} of {1:d} pages".format(total - remaining, total)
+
+        partial_conn = sqlite3.connect(partial_dbname)
+        conn.backup(partial_conn, pages=pages, progress=print_progress)
+        partial_conn.close()
+    elif method == 'vacuum':
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        total_pages = (conn.execute('PRAGMA page_count').fetchone()[0] -
+                       conn.execute('PRAGMA freelist_count').fetchone()[0])
+        progress = {'pages': 0}
+
+        def print_progress():
+            if os.path.exists(partial_dbname):
+                copied_pages = min(os.path.getsize(partial_dbname) // page_size,
+                                   total_pages)
+                if copied_pages >= progress['pages'] + pages:
+                    progress['pages'] = copied_pages
+                    print "copied {0:d} of {1:d} pages".format(copied_pages,
+                                                               total_pages)
+            # a non-zero return value would abort the copy
+            return 0
+
+        # called every 10000 virtual machine instructions of the copy
+        conn.set_progress_handler(print_progress, 10000)
+        try:
+            conn.execute('VACUUM INTO ?', (partial_dbname,))
+        finally:
+            conn.set_progress_handler(None, 10000)
+        print "copied {0:d} of {0:d} pages".format(total_pages)
+    elif method == 'dump':
+        total_rows = _count_dump_rows(conn)
+        copied_rows = 0
+        # the dump contains its own BEGIN and COMMIT
+        partial_conn = sqlite3.connect(partial_dbname, isolation_level=None)
+        for stmt in conn.iterdump():
+            partial_conn.execute(stmt)
+            if stmt.startswith('INSERT INTO'):
+                copied_rows += 1
+                if copied_rows % rows == 0:
+                    print "copied {0:d} of {1:d} rows".format(copied_rows,
+                                                              total_rows)
+        partial_conn.close()
+        if copied_rows % rows:
+            print "copied {0:d} of {1:d} rows".format(copied_rows, total_rows)
+    else:
+        raise ValueError('Unknown copy method {0}'.format(method))
+
+    os.rename(partial_dbname, dbname)
+    print "copied the database in {0:.2f} s".format(time.time() - start_time)
+
+
+def sqlite_math_functions_available(conn):
+    """
+    Check if the SQLite library has been compiled with the built-in math
+    functions (such as pow; SQLite >= 3.35)
+    """
+    try:
+        conn.execute('SELECT pow(10, 0)')
+    except sqlite3.OperationalError:
+        return False
+    else:
+        return True
+
+
+def create_gf_table(conn):
+    """
+    Create the temporary table gfall_gf with gf = 10**loggf for every
+    distinct loggf in the gfall table
+    """
+    loggf = np.array(conn.execute('SELECT DISTINCT loggf FROM gfall '
+                                  'WHERE loggf IS NOT NULL').fetchall(),
+                     dtype=np.float64).reshape(-1)
+    conn.execute('DROP TABLE IF EXISTS temp.gfall_gf')
+    conn.execute('CREATE TEMP TABLE gfall_gf(loggf float primary key, '
+                 'gf float) WITHOUT ROWID')
+    conn.executemany('INSERT INTO temp.gfall_gf VALUES (?, ?)',
+                     zip(loggf.tolist(), (10 ** loggf).tolist()))
+
+
+def new_linelist_from_gfall(new_dbname, select_atom=None, commit=True):
     print "Reading lines from Kurucz gfall"
-    conn = sqlite3.connect(new_dbname)
-    conn.create_function('pow', 2, math.pow)
-    conn.create_function('convert_air2vacuum', 1, convert_air2vacuum)
+    start_time = time.time()
+    if isinstance(new_dbname, sqlite3.Connection):
+        conn = new_dbname
+    else:
+        conn = sqlite3.connect(new_dbname)
     curs = conn.cursor()
+    curs.execute('drop table if exists lines')
     curs.execute(sql_stmts.linelist_create_stmt)
     if select_atom is None:
         elem_select_stmt = ""
     else:
-        elem_select_stmt = " and elem in (%s)" % (','.join(map(str, select_atom)),)
+        elem_select_stmt = "WHERE atomic_number in (%s)" % (
+            ','.join(map(str, select_atom)),)
+
+    if sqlite_math_functions_available(conn):
+        gf_stmt = 'pow(10, gfall.loggf)'
+        from_stmt = 'gfall'
+    else:
+        create_gf_table(conn)
+        gf_stmt = 'gfall_gf.gf'
+        from_stmt = ('gfall LEFT JOIN temp.gfall_gf '
+                     'ON gfall_gf.loggf = gfall.loggf')
+
+    insert_fromgfall_stmt = (sql_stmts.linelist_insert_stmt +
+                             sql_stmts.linelist_select_stmt % {
+                                 'air_to_vacuum': sql_stmts.air_to_vacuum_stmt,
+                                 'hc': hc,
+                                 'gf': gf_stmt,
+                                 'from_stmt': from_stmt,
+                                 'where_stmt': elem_select_stmt})
 
-    insert_fromgfall_stmt = sql_stmts.linelist_insert_stmt + sql_stmts.linelist_select_stmt % {'hc':hc, 'where_stmt':elem_select_stmt}
-    
     if sqlparse_available:
         print sqlparse.format(insert_fromgfall_stmt, reindent=True)
     else:
         print insert_fromgfall_stmt
-    
+
     curs.execute(insert_fromgfall_stmt)
-    
-    conn.commit()
-    print "%d lines in database" % (conn.execute('select count(atom) from lines').fetchone()[0])
-    print "updating oscillator strengths"
-    
-    conn.execute(update_oscillator_stmt)
-    conn.commit()
+    conn.execute('DROP TABLE IF EXISTS temp.gfall_gf')
+
+    if commit:
+        conn.commit()
+    print "%d lines in database (%.2f s)" % (
+        conn.execute('select count(atom) from lines').fetchone()[0],
+        time.time() - start_time)
     return conn
 
 
@@ -101,116 +370,326 @@ FROM
         label_lower as label 
     FROM
         lines)
-    ORDER BY atom, ion, energy
+    ORDER BY atom, ion, energy, g, label
     """
 
-def add_artificial_ionized_levels(conn):
-    #Clean first
+# level_id counts the levels of each ion in the order of their energy
+level_insert_window_stmt = """
+INSERT INTO
+    levels(atom, ion, energy, g, label, level_id, source)
+SELECT
+    atom,
+    ion,
+    energy,
+    g,
+    label,
+    ROW_NUMBER() OVER (PARTITION BY atom, ion
+                       ORDER BY energy, g, label) - 1,
+    'kurucz'
+FROM
+    (%s)
+ORDER BY atom, ion, energy, g, label
+""" % level_select_stmt
+
+level_insert_stmt = """
+INSERT INTO
+    levels(atom, ion, energy, g, label, level_id, source)
+VALUES
+    (?, ?, ?, ?, ?, ?, 'kurucz')"""
+
+level_index_stmts = [
+    'create index if not exists level_unique_idx on levels(atom, ion, energy, g, label)',
+    'create index if not exists level_global_idx on levels(id)']
+
+link_index_stmts = [
+    'create index if not exists line_level_upper_idx on lines(atom, ion, level_id_upper)',
+    'create index if not exists line_level_lower_idx on lines(atom, ion, level_id_lower)',
+    'create index if not exists level_idx on levels(atom, ion, level_id)',
+    'create index if not exists global_level_idx on levels(id)']
 
-    ionized_levels_stmt = "INSERT INTO levels (atom, ion, energy, g, metastable, level_id, source) " \
-                          "values(?, ?, ?, ?, ?, ?, ?)"
+# ROW_NUMBER() needs window functions
+sqlite_window_functions_available = sqlite3.sqlite_version_info >= (3, 25, 0)
 
+# UPDATE ... FROM needs SQLite >= 3.33
+sqlite_update_from_available = sqlite3.sqlite_version_info >= (3, 33, 0)
 
-    clean_fully_ionized_stmt = "DELETE FROM levels WHERE atom == ion "
+nist_ions_create_stmt = """
+CREATE TEMP TABLE
+    nist_ions(
+        id integer primary key,
+        atom integer,
+        ion integer,
+        g float)"""
+
+# in the order of the NIST ionization data - the fully ionized level of an
+# atom is inserted before the missing ground level of its last ion; ions that
+# do not have levels get one ground level
+artificial_levels_insert_stmt = """
+INSERT INTO
+    levels(atom, ion, energy, g, metastable, level_id, source)
+SELECT
+    atom, ion, 0.0, g, 1, 0, source
+FROM
+    (SELECT
+        id,
+        0 AS artificial_type,
+        atom,
+        atom AS ion,
+        1.0 AS g,
+        'tardis_artificial_fully_ionized' AS source
+    FROM
+        temp.nist_ions
+    WHERE
+        ion + 1 = atom
+    UNION ALL
+    SELECT
+        min(id),
+        1,
+        atom,
+        ion,
+        g,
+        'tardis_artificial_missing_ion'
+    FROM
+        temp.nist_ions
+    WHERE
+        NOT EXISTS (SELECT
+                        1
+                    FROM
+                        levels
+                    WHERE
+                        levels.atom = nist_ions.atom AND
+                        levels.ion = nist_ions.ion)
+    GROUP BY atom, ion)
+ORDER BY id, artificial_type"""
 
-    conn.execute(clean_fully_ionized_stmt)
+
+def add_artificial_ionized_levels(conn, commit=True):
+    """
+    Add the fully ionized level of every atom and a ground level for every
+    ion of the NIST ionization data that does not have levels
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    commit: ~bool
+        commit the changes (default=True, False leaves the transaction to the
+        caller, e.g. `build_stage`)
+    """
+    start_time = time.time()
+    conn.execute("DELETE FROM levels WHERE atom == ion")
 
     ionization_data = fileio.read_nist_ionization_data(full_information=True)
-    for atomic_number, ion_number, level_g, energy in ionization_data[['atomic_number', 'ion_number', 'ground_level_g',
-                                                                      'energy']]:
-        atomic_number = int(atomic_number)
-        ion_number = int(ion_number) - 1
-        if ion_number + 1 == atomic_number:
-            print "Adding fully ionized for atom %d" % atomic_number
-            conn.execute(ionized_levels_stmt, (atomic_number, atomic_number, 0.0, 1.0, True, 0,
-                                               'tardis_artificial_fully_ionized'))
-
-        no_levels = conn.execute('select count(atom) from levels where atom=? and ion=?', (atomic_number, ion_number))\
-                                .fetchone()[0]
-        if no_levels > 0:
-            continue
-        print "Atom %d Ion %d has 0 levels adding artificial level" % (atomic_number, ion_number)
-        conn.execute(ionized_levels_stmt, (atomic_number, ion_number, 0.0, level_g, True, 0,
-                                           'tardis_artificial_missing_ion'))
+    conn.execute('DROP TABLE IF EXISTS temp.nist_ions')
+    conn.execute(nist_ions_create_stmt)
+    conn.executemany('INSERT INTO temp.nist_ions(atom, ion, g) '
+                     'VALUES (?, ?, ?)',
+                     zip(ionization_data['atomic_number'].tolist(),
+                         (ionization_data['ion_number'] - 1).tolist(),
+                         ionization_data['ground_level_g'].tolist()))
+    conn.execute(artificial_levels_insert_stmt)
+    for source, count in conn.execute(
+            "SELECT source, count(*) FROM levels WHERE source IN "
+            "('tardis_artificial_fully_ionized', "
+            "'tardis_artificial_missing_ion') GROUP BY source"):
+        print "Added {0:d} {1} levels".format(count, source)
+    conn.execute('DROP TABLE temp.nist_ions')
 
-    conn.commit()
+    if commit:
+        conn.commit()
+    print "added the artificial levels in {0:.2f} s".format(
+        time.time() - start_time)
+
+
+def _number_levels(level_rows):
+    """
+    Append the level_id (running index within each ion) to the rows of
+    `level_select_stmt`
+    """
+    old_atom = None
+    old_ion = None
+    for atom, ion, energy, g, label in level_rows:
+        if atom == old_atom and ion == old_ion:
+            level_id += 1
+        else:
+            old_atom = atom
+            old_ion = ion
+            level_id = 0
+        yield atom, ion, energy, g, label, level_id
 
 
 def create_levels(conn):
     print "Creating level and level indices"
+    start_time = time.time()
     curs = conn.cursor()
     curs.execute('drop table if exists levels')
     curs.execute(level_create_stmt)
    #TODO: The level id is not nice, but necessary for the make_kurucz_hdf5.
-    curs = conn.execute(level_select_stmt)
-    
-    old_atom = None
-    old_ion = None
-    levels_data = []
-    for atom, ion, energy, g , label in curs:
-        if atom == old_atom and ion == old_ion:    
-            i +=1
-        else:
-            old_atom = atom
-            old_ion = ion
-            i=0
-        conn.execute('insert into levels(atom, ion, energy, g, label, level_id, source) values(?, ?, ?, ?, ?, ?, "kurucz")', (atom, ion, energy, g , label, i))
-    conn.execute('create index level_unique_idx on levels(atom, ion, energy, g, label)')
-    conn.execute('create index level_global_idx on levels(id)')
+    if sqlite_window_functions_available:
+        curs.execute(level_insert_window_stmt)
+    else:
+        curs.executemany(level_insert_stmt,
+                         _number_levels(conn.execute(level_select_stmt)))
+    print "inserted {0:d} levels in {1:.2f} s".format(
+        conn.execute('select count(*) from levels').fetchone()[0],
+        time.time() - start_time)
+
+    for index_stmt in level_index_stmts:
+        conn.execute(index_stmt)
 
     return conn
 
-def link_levels(conn):
-    print "linking levels -- this may take several minutes"
-    update_link_stmt = """
-        update
-            lines
-        set
-            level_id_upper = 
-            (select level_id from levels
-                where lines.atom=levels.atom and
-                lines.ion=levels.ion and
-                    lines.e_upper=levels.energy and
-                    lines.g_upper=levels.g and
-                    lines.label_upper=levels.label),
-            level_id_lower = 
-            (select level_id from levels
-                where lines.atom=levels.atom and
-                    lines.ion=levels.ion and
-                    lines.e_lower=levels.energy and
-                    lines.g_lower=levels.g and
-                    lines.label_lower=levels.label)
-        """
-    
+link_create_stmt = """
+CREATE TEMP TABLE
+    link(
+        id integer primary key,
+        level_id_upper integer,
+        level_id_lower integer,
+        global_level_id_upper integer,
+        global_level_id_lower integer) WITHOUT ROWID"""
+
+# the link table is scanned in the order of the line ids and every line is
+# found by its primary key
+link_lines_join_stmt = """
+UPDATE
+    lines
+SET
+    level_id_upper = link.level_id_upper,
+    level_id_lower = link.level_id_lower,
+    global_level_id_upper = link.global_level_id_upper,
+    global_level_id_lower = link.global_level_id_lower
+FROM
+    temp.link
+WHERE
+    link.id = lines.id"""
+
+# fallback for SQLite < 3.33 (no UPDATE ... FROM)
+link_lines_stmt = """
+UPDATE
+    lines
+SET
+    level_id_upper = ?,
+    level_id_lower = ?,
+    global_level_id_upper = ?,
+    global_level_id_lower = ?
+WHERE
+    id = ?"""
+
+
+def _read_frame(conn, select_stmt, columns):
+    """
+    Result of an SQL query as a pandas DataFrame
+    """
+    return pd.DataFrame.from_records(conn.execute(select_stmt).fetchall(),
+                                     columns=columns)
+
+
+def _match_levels(lines, levels, level_keys, line_keys, level_column):
+    """
+    Look up `level_column` of the upper and lower level of every line with a
+    hash join on the keys (same semantics as the former correlated
+    subqueries: NULL keys do not match and the first matching level is used)
+
+    Parameters
+    ----------
+
+    lines: ~pandas.DataFrame
+    levels: ~pandas.DataFrame
+    level_keys: list
+        key columns of levels
+    line_keys: list
+        corresponding columns of lines with '{0}' for 'upper'/'lower'
+    level_column: ~str
+
+    Returns
+    -------
+        : list of ~numpy.ndarray
+            float values for the upper and lower levels (nan if there is no
+            matching level)
+    """
+    levels = levels.dropna(subset=level_keys).drop_duplicates(level_keys)
+    levels = levels[level_keys + [level_column]].rename(
+        columns={level_column:'matched_value'})
+
+    matched_values = []
+    for level_type in ('upper', 'lower'):
+        line_levels = lines[['id'] + [key.format(level_type)
+                                      for key in line_keys]]
+        line_levels.columns = ['id'] + level_keys
+        matched = pd.merge(line_levels, levels, how='left', on=level_keys)
+        # the merge keeps all lines but not necessarily their order
+        matched = matched.set_index('id').matched_value.reindex(
+            lines.id.values)
+        matched_values.append(matched.values.astype(np.float64))
+    return matched_values
+
+
+def _sql_integers(values):
+    """
+    Float array with nan for missing values as list of int and None
+    """
+    missing = np.isnan(values)
+    sql_values = np.where(missing, 0, values).astype(np.int64).astype(object)
+    sql_values[missing] = None
+    return sql_values.tolist()
+
+
+def link_levels(conn, commit=True):
+    print "Linking lines and levels"
+    start_time = time.time()
+
+    lines = _read_frame(conn, 'SELECT id, atom, ion, e_upper, g_upper, '
+                              'label_upper, e_lower, g_lower, label_lower '
+                              'FROM lines',
+                        ['id', 'atom', 'ion', 'e_upper', 'g_upper',
+                         'label_upper', 'e_lower', 'g_lower', 'label_lower'])
+    levels = _read_frame(conn, 'SELECT id, atom, ion, energy, g, label, '
+                               'level_id FROM levels ORDER BY id',
+                         ['id', 'atom', 'ion', 'energy', 'g', 'label',
+                          'level_id'])
+    print "read {0:d} lines and {1:d} levels in {2:.2f} s".format(
+        len(lines), len(levels), time.time() - start_time)
+
+    start_time = time.time()
+    lines['level_id_upper'], lines['level_id_lower'] = _match_levels(
+        lines, levels, ['atom', 'ion', 'energy', 'g', 'label'],
+        ['atom', 'ion', 'e_{0}', 'g_{0}', 'label_{0}'], 'level_id')
+    print "joined the level ids in {0:.2f} s".format(time.time() - start_time)
 
-    update_global_link_stmt = """
-        update
-            lines
-        set
-            global_level_id_upper = 
-            (select id from levels
-                where lines.atom=levels.atom and
-                    lines.ion=levels.ion and
-                    lines.level_id_upper=levels.level_id),
-                    
-            global_level_id_lower = 
-            (select id from levels
-                where lines.atom=levels.atom and
-                    lines.ion=levels.ion and
-                    lines.level_id_lower=levels.level_id)
-        """
-
-
-
-    conn.execute(update_link_stmt)
-    conn.execute('create index line_level_upper_idx on lines(atom, ion, level_id_upper)')
-    conn.execute('create index line_level_lower_idx on lines(atom, ion, level_id_lower)')
-    conn.execute('create index level_idx on levels(atom, ion, level_id)')
-    conn.execute('create index global_level_idx on levels(id)')
     print "Linking lines and levels with global id"
-    conn.execute(update_global_link_stmt)
-    conn.execute('')
-    conn.commit()
+    start_time = time.time()
+    global_level_id_upper, global_level_id_lower = _match_levels(
+        lines, levels, ['atom', 'ion', 'level_id'],
+        ['atom', 'ion', 'level_id_{0}'], 'id')
+    print "joined the global level ids in {0:.2f} s".format(
+        time.time() - start_time)
+
+    start_time = time.time()
+    order = np.argsort(lines.id.values, kind='mergesort')
+    link_rows = zip(lines.id.values[order].tolist(),
+                    _sql_integers(lines.level_id_upper.values[order]),
+                    _sql_integers(lines.level_id_lower.values[order]),
+                    _sql_integers(global_level_id_upper[order]),
+                    _sql_integers(global_level_id_lower[order]))
+    if sqlite_update_from_available:
+        conn.execute('DROP TABLE IF EXISTS temp.link')
+        conn.execute(link_create_stmt)
+        conn.executemany('INSERT INTO temp.link VALUES (?, ?, ?, ?, ?)',
+                         link_rows)
+        conn.execute(link_lines_join_stmt)
+        conn.execute('DROP TABLE temp.link')
+    else:
+        conn.executemany(link_lines_stmt,
+                         [row[1:] + row[:1] for row in link_rows])
+    print "updated the lines in {0:.2f} s".format(time.time() - start_time)
+
+    start_time = time.time()
+    for index_stmt in link_index_stmts:
+        conn.execute(index_stmt)
+    if commit:
+        conn.commit()
+    print "created the level indices in {0:.2f} s".format(
+        time.time() - start_time)
     return conn
 
 
@@ -231,183 +710,178 @@ create_macro_atom_stmt="""
     )"""
 
 
-down_transition_stmt = """
-SELECT
-    global_level_id_upper as id,
-    count(global_level_id_lower) as number_down,
-    group_concat_intarray(global_level_id_lower) as reference_down,
-    group_concat_intarray(id) as line_id_down,
-    calculate_p_internal_down(wl, g_lower, g_upper, f_lu, e_lower) as p_int_down,
-    calculate_p_emission_down(wl, g_lower, g_upper, f_lu, e_upper - e_lower) as p_em_down
-FROM
-    lines 
-GROUP BY
-    global_level_id_upper
-"""
+macro_atom_insert_stmt = """
+INSERT INTO
+    macro_atom(id, count_down, count_up, reference_down, reference_up,
+               line_id_down, line_id_up, p_internal_down, p_emission_down,
+               p_internal_up)
+VALUES
+    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
 
-up_transition_stmt = """
-SELECT
-    global_level_id_lower as id,
-    count(global_level_id_upper) as number_up,
-    group_concat_intarray(global_level_id_upper) as reference_up,
-    group_concat_intarray(id) as line_id_up,
-    calculate_p_internal_up(wl, f_lu, e_lower) as p_int_up
-FROM
-    lines
-GROUP BY
-    global_level_id_lower
-
-"""
-
-update_up_stmt="""
-update macro_atom
-SET count_up = 
-    (select 
-        number_up 
-     from
-        up_transitions
-     where
-        up_transitions.id=macro_atom.id),
-        
-    reference_up = 
-    (select 
-        reference_up 
-     from
-        up_transitions
-     where
-        up_transitions.id=macro_atom.id),
-
-    line_id_up = 
-    (select 
-        line_id_up 
-     from
-        up_transitions
-     where
-        up_transitions.id=macro_atom.id),
-
-    p_internal_up = 
-    (select 
-        p_int_up 
-     from
-        up_transitions
-     where
-        up_transitions.id=macro_atom.id)
+
+def _group_slices(group_ids, level_ids):
     """
-    
-update_down_stmt="""
-update macro_atom
-SET count_down = 
-    (select 
-        number_down 
-     from
-        down_transitions
-     where
-        down_transitions.id=macro_atom.id),
-        
-    reference_down = 
-    (select 
-        reference_down 
-     from
-        down_transitions
-     where
-        down_transitions.id=macro_atom.id),
-    line_id_down = 
-    (select 
-        line_id_down
-     from
-        down_transitions
-     where
-        down_transitions.id=macro_atom.id),
-
-    p_internal_down = 
-    (select 
-        p_int_down
-     from
-        down_transitions
-     where
-        down_transitions.id=macro_atom.id),
-
-    p_emission_down = 
-    (select 
-        p_em_down 
-     from
-        down_transitions
-     where
-        down_transitions.id=macro_atom.id)
-    """
-
-
-
-
-def create_temporary_transition_table(conn):
+    Sort the transitions by `group_ids` and find the slice of every level in
+    `level_ids` in the sorted transitions (CSR offsets)
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            stable sort order of the transitions
+        : ~numpy.ndarray
+            start of the transitions of each level
+        : ~numpy.ndarray
+            end of the transitions of each level
+    """
+    order = np.argsort(group_ids, kind='mergesort')
+    sorted_ids = group_ids[order]
+    return (order, np.searchsorted(sorted_ids, level_ids, side='left'),
+            np.searchsorted(sorted_ids, level_ids, side='right'))
+
+
+def create_macro_atom(conn, commit=True):
+    """
+    Create the macro atom table with the down and up transitions of every
+    level that has line transitions
+
+    The lines are read once and grouped by their upper (down transitions)
+    and lower (up transitions) global level id. The transition
+    pre-coefficients (energies in eV) are
+
+    p_emission_down = 2 nu**2 f_ul / c**2 (e_upper - e_lower)
+    p_internal_down = 2 nu**2 f_ul / c**2 e_lower
+    p_internal_up = f_lu e_lower / (h nu)
+
+    Lines that are not linked to both of their levels are skipped.
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    commit: ~bool
+        commit the changes (default=True, False leaves the transaction to the
+        caller, e.g. `build_stage`)
+    """
+    print "Creating and populating the macro atom table"
+    start_time = time.time()
     curs = conn.cursor()
-    conn.create_aggregate('calculate_p_internal_down', 5, macro_atom_transition.calculate_p_internal_down)
-    conn.create_aggregate('calculate_p_emission_down', 5, macro_atom_transition.calculate_p_emission_down)
-    conn.create_aggregate('calculate_p_internal_up', 3, macro_atom_transition.calculate_p_internal_up)
-    conn.create_aggregate('group_concat_intarray', 1, macro_atom_transition.group_concat_intarray)
-    print "Creating temporary tables with down and up transition probabilities"
-    curs.execute('create temporary table down_transitions as %s' % down_transition_stmt)
-    curs.execute('create temporary table up_transitions as %s' % up_transition_stmt)
-    curs.execute('create index down_idx on down_transitions(id)')
-    curs.execute('create index up_idx on up_transitions(id)')
-    conn.commit()
+    curs.execute('drop table if exists macro_atom')
+    curs.execute(create_macro_atom_stmt)
+
+    lines = _read_frame(conn, 'SELECT id, wavelength, e_upper, e_lower, '
+                              'f_ul, f_lu, global_level_id_upper, '
+                              'global_level_id_lower FROM lines '
+                              'WHERE global_level_id_upper >= 0 AND '
+                              'global_level_id_lower >= 0 ORDER BY id',
+                        ['id', 'wavelength', 'e_upper', 'e_lower', 'f_ul',
+                         'f_lu', 'global_level_id_upper',
+                         'global_level_id_lower'])
+    line_ids = lines.id.values.astype(np.int64)
+    upper_ids = lines.global_level_id_upper.values.astype(np.int64)
+    lower_ids = lines.global_level_id_lower.values.astype(np.int64)
+    e_lower = lines.e_lower.values.astype(np.float64)
+
+    # wavelength in angstrom
+    nu = constants.c.cgs.value / (lines.wavelength.values * 1e-8)
+    p_down = 2 * nu**2 * lines.f_ul.values / constants.c.cgs.value**2
+    p_emission_down = p_down * (lines.e_upper.values - e_lower)
+    p_internal_down = p_down * e_lower
+    p_internal_up = lines.f_lu.values * e_lower / (constants.h.cgs.value * nu)
+
+    level_ids = np.union1d(upper_ids, lower_ids)
+    down_order, down_start, down_stop = _group_slices(upper_ids, level_ids)
+    up_order, up_start, up_stop = _group_slices(lower_ids, level_ids)
+
+    reference_down = lower_ids[down_order]
+    line_id_down = line_ids[down_order]
+    p_internal_down = p_internal_down[down_order]
+    p_emission_down = p_emission_down[down_order]
+    reference_up = upper_ids[up_order]
+    line_id_up = line_ids[up_order]
+    p_internal_up = p_internal_up[up_order]
+    print "grouped {0:d} lines into {1:d} levels in {2:.2f} s".format(
+        len(lines), len(level_ids), time.time() - start_time)
+
+    start_time = time.time()
+    macro_atom_rows = (
+        (level_id, int(down_stop[i] - down_start[i]),
+         int(up_stop[i] - up_start[i]),
+         reference_down[down_start[i]:down_stop[i]],
+         reference_up[up_start[i]:up_stop[i]],
+         line_id_down[down_start[i]:down_stop[i]],
+         line_id_up[up_start[i]:up_stop[i]],
+         p_internal_down[down_start[i]:down_stop[i]],
+         p_emission_down[down_start[i]:down_stop[i]],
+         p_internal_up[up_start[i]:up_stop[i]])
+        for i, level_id in enumerate(level_ids.tolist()))
+    curs.executemany(macro_atom_insert_stmt, macro_atom_rows)
+    conn.execute('create index macro_atom_global_idx on macro_atom(id)')
+    if commit:
+        conn.commit()
+    print "inserted the macro atom table in {0:.2f} s".format(
+        time.time() - start_time)
     return conn
 
-    
 
-update_macro_atom_clean = """
+metastable_case_stmt = """
+CASE
+    WHEN count_down = 0 THEN 1
+    WHEN count_down > 0 THEN 0
+END"""
+
+# macro_atom is scanned in the order of the level ids (see `create_macro_atom`)
+# and every level is found by its primary key
+flag_metastable_join_stmt = """
 UPDATE
-    macro_atom
+    levels
 SET
-    count_%(trans_type)s = 0,
-    reference_%(trans_type)s = ?,
-    line_id_%(trans_type)s = ?,
-    p_internal_%(trans_type)s = ?
-    %(p_emission_stmt)s
+    metastable = %s
+FROM
+    macro_atom
 WHERE
-    reference_%(trans_type)s isnull"""
+    macro_atom.id = levels.id""" % metastable_case_stmt
 
-def create_macro_atom(conn):
-    empty_array = -1
-    curs = conn.cursor()
-    print "Creating and populating the macro atom table"
-    curs.execute('drop table if exists macro_atom')    
-    curs.execute(create_macro_atom_stmt)
-    curs.execute('insert into macro_atom(id) select id from (select id from down_transitions union select id from up_transitions)')
-    curs.execute(update_down_stmt)
-    curs.execute(update_up_stmt)
-    print "Cleaning up macro atom table and setting counts to 0 where transitions don't exist"
-    print update_macro_atom_clean % dict(trans_type='down', p_emission_stmt=', p_emission_down = ?')
-    curs.execute(update_macro_atom_clean % dict(trans_type='down', p_emission_stmt=', p_emission_down = ?'),
-                    (empty_array, empty_array, empty_array, empty_array))
-    
-    curs.execute(update_macro_atom_clean % dict(trans_type='up', p_emission_stmt=''),
-                    (empty_array, empty_array, empty_array))
-    conn.execute('create index macro_atom_global_idx on macro_atom(id)')
-    conn.commit()
-    return conn
-    
-def flag_metastable(conn):
-    flag_metastable_stmt = """
-    UPDATE
-        levels
-    SET
-        metastable=(SELECT CASE
-                    WHEN
-                        count_down = 0
-                    THEN 1
-                    WHEN
-                        count_down > 0
-                    THEN 0
-                    END
-              FROM
-                macro_atom
-              WHERE
-                macro_atom.id=levels.id)
+# fallback for SQLite < 3.33 - one lookup in macro_atom_global_idx per level
+flag_metastable_stmt = """
+UPDATE
+    levels
+SET
+    metastable = (SELECT
+                      %s
+                  FROM
+                      macro_atom
+                  WHERE
+                      macro_atom.id = levels.id)""" % metastable_case_stmt
+
+
+def flag_metastable(conn, commit=True):
+    """
+    Flag the levels without downward transitions in macro_atom as metastable
+
+    The levels are updated with one UPDATE joined on macro_atom (or a
+    correlated lookup per level for SQLite < 3.33). Levels without a macro
+    atom entry are set to NULL.
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    commit: ~bool
+        commit the changes (default=True, False leaves the transaction to the
+        caller, e.g. `build_stage`)
     """
     print "Flagging metastable levels"
-    conn.execute(flag_metastable_stmt)
-    conn.commit()
+    start_time = time.time()
+    if sqlite_update_from_available:
+        conn.execute('UPDATE levels SET metastable = NULL '
+                     'WHERE metastable IS NOT NULL')
+        conn.execute(flag_metastable_join_stmt)
+    else:
+        conn.execute(flag_metastable_stmt)
+    if commit:
+        conn.commit()
+    print "flagged the metastable levels in {0:.2f} s".format(
+        time.time() - start_time)
     return conn
 
 
@@ -418,20 +892,18 @@ CREATE TABLE zeta(
     ion integer,
     zeta float_ndarray)"""
 
-def read_zeta(conn):
+def read_zeta(conn, commit=True):
     print "reading zeta values and inserting into db from %s" % zeta_datafile
     zeta_data = np.loadtxt(zeta_datafile, usecols=xrange(1,23), dtype=np.float64)
     conn.execute(create_zeta_table_stmt)
-    for line in zeta_data:
-        atom = int(line[0])
-        ion = int(line[1])
-        z_data = line[2:]
-        conn.execute('insert into zeta(atom, ion, zeta) values(?, ?, ?)',
-                     (atom, ion, sqlite3.Binary(z_data.tostring())))
-    conn.commit()
+    conn.executemany('insert into zeta(atom, ion, zeta) values(?, ?, ?)',
+                     [(int(line[0]), int(line[1]), line[2:])
+                      for line in zeta_data])
+    if commit:
+        conn.commit()
     return conn
 
-def ion_xs(conn):
+def ion_xs(conn, commit=True):
     print("Creating the ionization cross section table.")
     ion_xs_create_table = """
     CREATE TABLE ion_cx(id INTEGER PRIMARY KEY, level_id INTEGER, atom INTEGER, ion INTEGER, cx_threshold FLOAT, FOREIGN KEY(level_id, atom, ion) REFERENCES levels(level_id, atom, ion))
@@ -443,6 +915,8 @@ def ion_xs(conn):
 
     curs = conn.cursor()
     #curs.execute('PRAGMA foreign_keys = ON')
+    curs.execute('DROP TABLE IF EXISTS ion_cx_supporter')
+    curs.execute('DROP TABLE IF EXISTS ion_cx')
     curs.execute(ion_xs_create_table)
     curs.execute(ion_xs_creat_supporter)
 
@@ -453,12 +927,440 @@ def ion_xs(conn):
     final = np.concatenate((atomdata,cx[:,None]),axis=1)
     for i in final:
         curs.execute('INSERT OR IGNORE INTO ion_cx (level_id, atom, ion, cx_threshold) VALUES (?,?,?,?)',(int(i[2]),int(i[0]),int(i[1]),i[3]))
+    if commit:
+        conn.commit()
+    return conn
+
+
+def insert_gfall(conn, gfall_raw):
+    """
+    (Re)create the gfall table and insert the output of `read_gfall_raw` or
+    `iter_gfall_raw` with `gfall_raw_2_db`
+    """
+    conn.execute('DROP TABLE IF EXISTS gfall')
+    with open(gfall_schema_path) as fh:
+        conn.execute(fh.read())
+    gfall_raw_2_db(gfall_raw, conn)
+
+
+# stages of the kurucz database that follow the insertion of gfall - they do
+# not commit as every stage runs in one transaction (see `build_stage`)
+kurucz_build_stages = [
+    ('linelist', partial(new_linelist_from_gfall, commit=False)),
+    ('levels', create_levels),
+    ('link_levels', partial(link_levels, commit=False)),
+    ('ion_xs', partial(ion_xs, commit=False)),
+    ('artificial_levels', partial(add_artificial_ionized_levels,
+                                  commit=False))]
+
+build_metadata_create_stmt = """
+CREATE TABLE IF NOT EXISTS
+    build_metadata(
+        stage text primary key,
+        fingerprint text,
+        completed float)"""
+
+
+def stage_fingerprint(input_fingerprint, name):
+    """
+    Fingerprint of a build stage - it changes with the fingerprint of the
+    input of the stage, i.e. the fingerprint of the previous stage
+    """
+    return hashlib.sha1('{0}-{1}'.format(input_fingerprint, name)).hexdigest()
+
+
+@contextmanager
+def _no_databases(conn):
+    yield {}
+
+
+def run_build_stages(conn, stages, fingerprint='', profile='safe',
+                     resume=False):
+    """
+    Run build stages on `conn` and record their completion in the
+    build_metadata table
+
+    Each stage runs as one transaction. With `resume` the stages are skipped
+    as long as they have been completed with the same fingerprint; the first
+    stale stage and all following stages are run again.
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    stages: list
+        (name, function) or (name, function, prepare) - the functions are
+        called with `conn` and must not commit, so that a failing stage is
+        rolled back. prepare(conn) is run before the transaction of the
+        stage and returns a context manager that yields the databases
+        (schema name: file name) that are attached to `conn` for the stage
+    fingerprint: ~str
+        fingerprint of the input of the first stage (e.g. the hash of
+        gfall.dat and the options used to read it)
+    profile: ~str
+        build profile (see `build_profiles`), 'bulk' speeds up the build at
+        the cost of crash safety (default='safe')
+    resume: ~bool
+        skip completed stages (default=False)
+    """
+    conn.execute(build_metadata_create_stmt)
     conn.commit()
+    completed_stages = dict(conn.execute(
+        'SELECT stage, fingerprint FROM build_metadata').fetchall())
+
+    with build_profile(conn, profile):
+        for i, stage_items in enumerate(stages):
+            name, stage = stage_items[:2]
+            prepare = stage_items[2] if len(stage_items) > 2 else _no_databases
+            fingerprint = stage_fingerprint(fingerprint, name)
+            if resume and completed_stages.get(name) == fingerprint:
+                print "Skipping completed build stage {0}".format(name)
+                continue
+
+            if resume or i == 0:
+                # the following stages depend on this one and are run again
+                conn.executemany('DELETE FROM build_metadata WHERE stage = ?',
+                                 [(later_stage[0],)
+                                  for later_stage in stages[i:]])
+                conn.commit()
+                resume = False
+
+            with prepare(conn) as databases:
+                with build_stage(conn, name, databases):
+                    stage(conn)
+            # a stage that is interrupted before it is marked as completed
+            # is run again
+            conn.execute('INSERT INTO build_metadata(stage, fingerprint, '
+                         'completed) VALUES (?, ?, ?)',
+                         (name, fingerprint, time.time()))
+            conn.commit()
     return conn
 
 
+# stages that only depend on the gfall lines of one element - the sharded
+# build runs them for groups of elements in parallel
+sharded_stage_names = ('linelist', 'levels', 'link_levels')
+
+# lines.id of a shard -> gfall.id, the lines of a shard are inserted in the
+# order of gfall.id (see `new_linelist_from_gfall`)
+line_map_create_stmt = """
+CREATE TABLE
+    line_map(
+        line_id integer primary key,
+        gfall_id integer)"""
 
+shard_levels_merge_stmt = """
+INSERT INTO
+    main.levels(id, atom, ion, energy, g, label, level_id, metastable, source)
+SELECT
+    id + :level_offset,
+    atom,
+    ion,
+    energy,
+    g,
+    label,
+    level_id,
+    metastable,
+    source
+FROM
+    shard.levels
+ORDER BY id"""
+
+shard_lines_merge_stmt = """
+INSERT INTO
+    main.lines(id, wavelength, loggf, atom, ion,
+        e_upper, g_upper, label_upper, level_id_upper, global_level_id_upper,
+        f_ul,
+        e_lower, g_lower, label_lower, level_id_lower, global_level_id_lower,
+        f_lu, source)
+SELECT
+    line_map.gfall_id,
+    wavelength,
+    loggf,
+    atom,
+    ion,
+    e_upper,
+    g_upper,
+    label_upper,
+    level_id_upper,
+    global_level_id_upper + :level_offset,
+    f_ul,
+    e_lower,
+    g_lower,
+    label_lower,
+    level_id_lower,
+    global_level_id_lower + :level_offset,
+    f_lu,
+    source
+FROM
+    shard.lines JOIN shard.line_map ON line_map.line_id = lines.id
+ORDER BY line_map.gfall_id"""
+
+
+def database_filename(conn):
+    """
+    File of the main database of `conn` ('' for in-memory databases)
+    """
+    for _, name, filename in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return filename
 
 
+def shard_atoms(conn, atoms_per_shard=1):
+    """
+    Group the atomic numbers in the gfall table of `conn` into shards of
+    `atoms_per_shard` consecutive elements
+    """
+    atoms = [atom for atom, in conn.execute(
+        'SELECT DISTINCT atomic_number FROM gfall ORDER BY atomic_number')]
+    return [atoms[i:i + atoms_per_shard]
+            for i in xrange(0, len(atoms), atoms_per_shard)]
+
+
+def build_shard(dbname, shard_dbname, atoms, profile='safe'):
+    """
+    Build the levels and the linked lines of `atoms` from the gfall table of
+    `dbname` in the new database `shard_dbname`
+
+    Parameters
+    ----------
+
+    dbname: ~str
+        database with the gfall table
+    shard_dbname: ~str
+    atoms: list
+        atomic numbers of the shard
+    profile: ~str
+        build profile (see `build_profiles`) of the shard (default='safe')
+    """
+    conn = sqlite3.connect(shard_dbname)
+    with open(gfall_schema_path) as fh:
+        conn.execute(fh.read())
+    conn.commit()
+    conn.execute('ATTACH DATABASE ? AS source', (dbname,))
+    conn.execute('INSERT INTO gfall SELECT * FROM source.gfall '
+                 'WHERE atomic_number IN ({0}) ORDER BY id'.format(
+                     ','.join(map(str, atoms))))
+    conn.commit()
+    conn.execute('DETACH DATABASE source')
+
+    run_build_stages(conn, [(name, stage) for name, stage in
+                            kurucz_build_stages
+                            if name in sharded_stage_names],
+                     profile=profile)
+
+    conn.execute(line_map_create_stmt)
+    conn.execute('INSERT INTO line_map(gfall_id) SELECT id FROM gfall '
+                 'ORDER BY id')
+    conn.commit()
+    conn.close()
+    return shard_dbname
+
+
+def _build_shard(args):
+    # multiprocessing.Pool.map passes a single argument
+    return build_shard(*args)
+
+
+def merge_shards(conn, shard_dbnames):
+    """
+    Merge the lines and levels of the shards into `conn`
 
-    
\ No newline at end of file
+    The shards are appended in the given order and the global level ids of
+    each shard are offset by the number of levels before it. The line ids
+    are the ids of the gfall lines. For shards of consecutive elements in
+    ascending order both are the same as in the serial build.
+
+    Every shard is attached in turn, so `conn` must not be within a
+    transaction (see `sharded_levels_database`).
+    """
+    conn.execute('DROP TABLE IF EXISTS lines')
+    conn.execute(sql_stmts.linelist_create_stmt)
+    conn.execute('DROP TABLE IF EXISTS levels')
+    conn.execute(level_create_stmt)
+    conn.commit()
+
+    level_offset = 0
+    for shard_dbname in shard_dbnames:
+        start_time = time.time()
+        with attached_databases(conn, {'shard': shard_dbname}):
+            conn.execute(shard_levels_merge_stmt,
+                         {'level_offset': level_offset})
+            conn.execute(shard_lines_merge_stmt,
+                         {'level_offset': level_offset})
+            conn.commit()
+        level_offset = conn.execute(
+            'SELECT ifnull(max(id), 0) FROM levels').fetchone()[0]
+        print "merged shard {0} in {1:.2f} s".format(
+            shard_dbname, time.time() - start_time)
+    return conn
+
+
+@contextmanager
+def sharded_levels_database(conn, n_jobs=None, atoms_per_shard=1,
+                            shard_dir=None, profile='safe'):
+    """
+    Run the `sharded_stage_names` stages for groups of elements in parallel
+    and merge the shards into one database
+
+    Every worker process builds one shard database per group of elements
+    (see `build_shard`) from the gfall table of `conn`, which has to be a
+    database file. The shards are merged into a staging database (SQLite
+    attaches at most 10 databases at a time, so the shards can not be
+    attached to `conn` all at once). The block gets {'shards': staging
+    database} to attach to `conn` (see `build_stage`), all databases are
+    removed afterwards.
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    n_jobs: ~int
+        number of processes (default=None uses all CPUs)
+    atoms_per_shard: ~int
+        number of elements per shard (default=1)
+    shard_dir: ~str
+        directory for the shard databases (default=None uses the temporary
+        directory)
+    profile: ~str
+        build profile (see `build_profiles`) of the shards (default='safe')
+    """
+    dbname = database_filename(conn)
+    if not dbname:
+        raise ValueError('the sharded build needs a database file - the '
+                         'shards can not read the gfall table of an '
+                         'in-memory database')
+
+    shards = shard_atoms(conn, atoms_per_shard)
+    shard_dir = tempfile.mkdtemp(prefix='kurucz_shards', dir=shard_dir)
+    try:
+        shard_args = [(dbname,
+                       os.path.join(shard_dir, 'shard{0:03d}.db3'.format(i)),
+                       atoms, profile)
+                      for i, atoms in enumerate(shards)]
+        print "Building {0:d} shards with {1} processes".format(
+            len(shards), n_jobs or multiprocessing.cpu_count())
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            shard_dbnames = pool.map(_build_shard, shard_args)
+        finally:
+            pool.close()
+            pool.join()
+
+        merged_dbname = os.path.join(shard_dir, 'merged.db3')
+        merged_conn = sqlite3.connect(merged_dbname)
+        merge_shards(merged_conn, shard_dbnames)
+        merged_conn.close()
+        yield {'shards': merged_dbname}
+    finally:
+        shutil.rmtree(shard_dir)
+
+
+def insert_sharded_levels(conn, commit=True):
+    """
+    Replace the lines and levels of `conn` with those of the attached
+    'shards' database (see `sharded_levels_database`)
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    commit: ~bool
+        commit the changes (default=True, False leaves the transaction to the
+        caller, e.g. `build_stage`)
+    """
+    start_time = time.time()
+    conn.execute('DROP TABLE IF EXISTS main.lines')
+    conn.execute(sql_stmts.linelist_create_stmt)
+    conn.execute('DROP TABLE IF EXISTS main.levels')
+    conn.execute(level_create_stmt)
+    conn.execute('INSERT INTO main.levels SELECT * FROM shards.levels '
+                 'ORDER BY id')
+    conn.execute('INSERT INTO main.lines SELECT * FROM shards.lines '
+                 'ORDER BY id')
+    for index_stmt in level_index_stmts + link_index_stmts:
+        conn.execute(index_stmt)
+    if commit:
+        conn.commit()
+    print "inserted the sharded lines and levels in {0:.2f} s".format(
+        time.time() - start_time)
+    return conn
+
+
+def build_sharded_levels(conn, n_jobs=None, atoms_per_shard=1,
+                         shard_dir=None, profile='safe'):
+    """
+    Run the `sharded_stage_names` stages for groups of elements in parallel
+    and merge the results into `conn` (see `sharded_levels_database`)
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    n_jobs: ~int
+        number of processes (default=None uses all CPUs)
+    atoms_per_shard: ~int
+        number of elements per shard (default=1)
+    shard_dir: ~str
+        directory for the shard databases, which are removed after the merge
+        (default=None uses the temporary directory)
+    profile: ~str
+        build profile (see `build_profiles`) of the shards (default='safe')
+    """
+    # the shards read the gfall table from their own connections
+    conn.commit()
+    with sharded_levels_database(conn, n_jobs=n_jobs,
+                                 atoms_per_shard=atoms_per_shard,
+                                 shard_dir=shard_dir,
+                                 profile=profile) as databases:
+        with attached_databases(conn, databases):
+            insert_sharded_levels(conn)
+    return conn
+
+
+def build_kurucz_db(conn, profile='safe', read_gfall=None, fingerprint='',
+                    resume=False, n_jobs=1, atoms_per_shard=1, shard_dir=None):
+    """
+    Build the kurucz database in `conn` (see `kurucz_build_stages`)
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    profile: ~str
+        build profile (see `build_profiles`), 'bulk' speeds up the build at
+        the cost of crash safety (default='safe')
+    read_gfall: callable
+        returns the gfall lines (`read_gfall_raw` or `iter_gfall_raw`) that
+        are inserted in the first stage (optional - default=None uses the
+        gfall table in `conn`)
+    fingerprint: ~str
+        fingerprint of the gfall lines (default='')
+    resume: ~bool
+        skip the stages that have already been completed with the same
+        fingerprint (default=False)
+    n_jobs: ~int
+        number of processes - with n_jobs != 1 the `sharded_stage_names`
+        stages are run in parallel for groups of elements (see
+        `sharded_levels_database`, default=1)
+    atoms_per_shard: ~int
+        number of elements per shard of the parallel build (default=1)
+    shard_dir: ~str
+        directory for the shards of the parallel build (default=None uses the
+        temporary directory)
+    """
+    if n_jobs == 1:
+        stages = list(kurucz_build_stages)
+    else:
+        stages = [('sharded_levels',
+                   partial(insert_sharded_levels, commit=False),
+                   partial(sharded_levels_database, n_jobs=n_jobs,
+                           atoms_per_shard=atoms_per_shard,
+                           shard_dir=shard_dir, profile=profile))]
+        stages += [(name, stage) for name, stage in kurucz_build_stages
+                   if name not in sharded_stage_names]
+    if read_gfall is not None:
+        stages.insert(0, ('gfall',
+                          lambda conn: insert_gfall(conn, read_gfall())))
+    return run_build_stages(conn, stages, fingerprint=fingerprint,
+                            profile=profile, resume=resume)
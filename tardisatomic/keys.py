@@ -0,0 +1,171 @@
+"""
+Packed int64 keys of species and levels
+
+(atomic_number, ion_number, level_number) is packed into one int64 as
+
+    atomic_number << 56 | ion_number << 48 | level_number
+
+so joins on levels (or species, with level_number 0) become sorts and binary
+searches on integer arrays instead of hashing tuples in pandas MultiIndexes.
+The keys sort in the order of (atomic_number, ion_number, level_number).
+Missing or negative level numbers (e.g. -1 for lines that are not linked to a
+level) are packed to the key -1, which never matches a level.
+"""
+
+import numpy as np
+
+atomic_number_shift = 56
+ion_number_shift = 48
+level_number_mask = (1 << ion_number_shift) - 1
+
+missing_key = -1
+
+
+def pack(atomic_number, ion_number, level_number=0):
+    """
+    Pack atomic, ion and level numbers into int64 keys
+
+    Parameters
+    ----------
+
+    atomic_number: ~numpy.ndarray
+    ion_number: ~numpy.ndarray
+    level_number: ~numpy.ndarray
+        level numbers (nan or negative for missing levels), default=0 packs
+        species keys
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            int64 keys
+    """
+    level_number = np.asarray(level_number)
+    if level_number.dtype.kind == 'f':
+        missing = np.isnan(level_number)
+        level_number = np.where(missing, missing_key, level_number)
+    level_number = level_number.astype(np.int64)
+    keys = ((np.asarray(atomic_number).astype(np.int64) << atomic_number_shift) |
+            (np.asarray(ion_number).astype(np.int64) << ion_number_shift) |
+            (level_number & level_number_mask))
+    return np.where(level_number < 0, missing_key, keys)
+
+
+def unpack(keys):
+    """
+    Atomic, ion and level numbers of int64 keys (see `pack`)
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    return (keys >> atomic_number_shift,
+            (keys >> ion_number_shift) & 0xff,
+            keys & level_number_mask)
+
+
+def index_keys(index):
+    """
+    Keys of a (atomic_number, ion_number) or (atomic_number, ion_number,
+    level_number) MultiIndex
+    """
+    return pack(*[index.get_level_values(i).values
+                  for i in range(index.nlevels)])
+
+
+def lookup(keys, query, assume_sorted=False):
+    """
+    Positions of the query keys in `keys`
+
+    Parameters
+    ----------
+
+    keys: ~numpy.ndarray
+    query: ~numpy.ndarray
+    assume_sorted: ~bool
+        `keys` are sorted (default=False sorts them first)
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            position of the first occurrence of every query key in `keys`
+            (-1 if it does not occur)
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    query = np.asarray(query, dtype=np.int64)
+    if len(keys) == 0:
+        return -np.ones(query.shape, dtype=np.int64)
+
+    if assume_sorted:
+        sorted_keys = keys
+    else:
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+
+    positions = np.searchsorted(sorted_keys, query).clip(max=len(keys) - 1)
+    found = sorted_keys[positions] == query
+    if not assume_sorted:
+        positions = order[positions]
+    return np.where(found, positions, -1)
+
+
+def isin(query, keys):
+    """
+    Mask of the query keys that occur in `keys`
+    """
+    return np.in1d(query, keys)
+
+
+def group_offsets(keys):
+    """
+    Group equal keys
+
+    Parameters
+    ----------
+
+    keys: ~numpy.ndarray
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            stable order that sorts the keys
+        : ~numpy.ndarray
+            sorted unique keys
+        : ~numpy.ndarray
+            offsets of the groups - the positions of the keys of group i are
+            order[offsets[i]:offsets[i + 1]] (in their original order)
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+                            if len(keys) else [])
+    offsets = np.r_[starts, len(keys)].astype(np.int64)
+    return order, sorted_keys[starts], offsets
+
+
+def gather_groups(groups, query):
+    """
+    Positions of the keys of the groups of the query keys
+
+    Parameters
+    ----------
+
+    groups: tuple
+        output of `group_offsets`
+    query: ~numpy.ndarray
+        keys of the groups (keys without a group have no positions)
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            positions of the keys of all groups, in the order of `query`
+        : ~numpy.ndarray
+            number of positions of every query key
+    """
+    order, group_keys, offsets = groups
+    group_positions = lookup(group_keys, query, assume_sorted=True)
+    found = group_positions >= 0
+    starts = np.where(found, offsets[group_positions], 0)
+    counts = np.where(found, offsets[group_positions + 1] - starts, 0)
+
+    ends = np.cumsum(counts)
+    positions = (np.arange(ends[-1] if len(ends) else 0, dtype=np.int64) +
+                 np.repeat(starts - (ends - counts), counts))
+    return order[positions], counts
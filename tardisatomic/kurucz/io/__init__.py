@@ -1,2 +1,6 @@
-from tardisatomic.kurucz.io.gfall import (read_gfall_raw, parse_gfall,
-                                          extract_levels, extract_lines)
+from tardisatomic.kurucz.io.gfall import (read_gfall_raw, iter_gfall_raw,
+                                          parse_gfall, iter_gfall,
+                                          extract_levels, extract_lines,
+                                          gfall_raw_2_db, select_gfall_lines,
+                                          compact_gfall)
+from tardisatomic.kurucz.io.cache import GFallCache
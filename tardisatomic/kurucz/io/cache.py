@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from tardisatomic.kurucz.io.gfall import (read_gfall_raw, parse_gfall,
+                                          gfall_parser_version)
+
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.tardisatomic',
+                                 'gfall_cache')
+
+
+def hash_file(fname, block_size=2**20):
+    """
+    SHA1 hex digest of the content of `fname`
+    """
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class GFallCache(object):
+    """
+    Content-addressed on-disk cache of read and parsed gfall tables
+
+    Entries are keyed on the SHA1 of gfall.dat, the kind of table ('raw' for
+    `read_gfall_raw` and 'parsed' for `parse_gfall`), the number of skipped
+    header lines and `gfall_parser_version`. Every column of an entry is stored
+    as a .npy file and is memory-mapped (copy-on-write) when the entry is
+    loaded.
+
+    Entries of other parser versions, entries whose source file has changed
+    and incomplete entries are stale and are removed. When the cache grows
+    beyond `max_size` the least recently used entries are evicted.
+
+    Parameters
+    ----------
+
+    cache_dir: ~str
+        directory of the cache (default ~/.tardisatomic/gfall_cache)
+
+    max_size: ~int
+        maximum size of the cache in bytes (default 4 GB)
+    """
+
+    hash_index_fname = 'file_hashes.json'
+    meta_fname = 'meta.json'
+
+    def __init__(self, cache_dir=default_cache_dir, max_size=4 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def _read_json(fname, default=None):
+        try:
+            with open(fname) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return default
+
+    @staticmethod
+    def _write_json(fname, data):
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'w') as fh:
+            json.dump(data, fh)
+        os.rename(tmp_fname, fname)
+
+    def file_hash(self, fname):
+        """
+        SHA1 of `fname` - it is only recomputed if the size or modification
+        time of the file have changed
+        """
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        size_mtime = [stat.st_size, stat.st_mtime]
+
+        index_fname = os.path.join(self.cache_dir, self.hash_index_fname)
+        hash_index = self._read_json(index_fname, {})
+
+        if fname in hash_index and hash_index[fname][:2] == size_mtime:
+            return hash_index[fname][2]
+
+        file_hash = hash_file(fname)
+        hash_index[fname] = size_mtime + [file_hash]
+        self._write_json(index_fname, hash_index)
+        return file_hash
+
+    @staticmethod
+    def _entry_key(file_hash, kind, skip_header):
+        return hashlib.sha1('{0}-{1}-{2}-{3}'.format(
+            file_hash, kind, skip_header, gfall_parser_version)).hexdigest()
+
+    def _entry_dirs(self):
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            # entries that are being written start with a dot
+            if not key.startswith('.') and os.path.isdir(entry_dir):
+                yield entry_dir
+
+    def entries(self):
+        """
+        Meta data of all complete entries
+        """
+        entries = []
+        for entry_dir in self._entry_dirs():
+            meta = self._read_json(os.path.join(entry_dir, self.meta_fname))
+            if meta is not None:
+                entries.append(meta)
+        return entries
+
+    def size(self):
+        """
+        Size of all entries in bytes
+        """
+        return sum(meta['size'] for meta in self.entries())
+
+    def _remove_entry(self, entry_dir):
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def remove_stale(self):
+        """
+        Remove incomplete entries, entries of other parser versions and
+        entries whose source file has changed
+
+        Returns
+        -------
+            : ~int
+                number of removed entries
+        """
+        no_removed = 0
+        for entry_dir in list(self._entry_dirs()):
+            meta = self._read_json(os.path.join(entry_dir, self.meta_fname))
+            if meta is None:
+                stale = True
+            elif meta['parser_version'] != gfall_parser_version:
+                stale = True
+            elif os.path.exists(meta['source']):
+                stale = self.file_hash(meta['source']) != meta['file_hash']
+            else:
+                stale = False
+
+            if stale:
+                self._remove_entry(entry_dir)
+                no_removed += 1
+        return no_removed
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is smaller
+        than `max_size`
+
+        Returns
+        -------
+            : ~int
+                number of evicted entries
+        """
+        entries = []
+        for entry_dir in self._entry_dirs():
+            meta = self._read_json(os.path.join(entry_dir, self.meta_fname))
+            if meta is not None:
+                entries.append((os.path.getmtime(entry_dir), meta['size'],
+                                entry_dir))
+
+        cache_size = sum(size for _, size, _ in entries)
+        no_evicted = 0
+        for _, size, entry_dir in sorted(entries):
+            if cache_size <= self.max_size:
+                break
+            self._remove_entry(entry_dir)
+            cache_size -= size
+            no_evicted += 1
+        return no_evicted
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        for entry_dir in list(self._entry_dirs()):
+            self._remove_entry(entry_dir)
+
+    @staticmethod
+    def _memmapped_frame(gfall, index):
+        """
+        DataFrame of the memory-mapped columns that are not copied (string
+        columns are converted to object arrays and therefore copied)
+        """
+        for column, values in gfall.items():
+            if values.dtype.kind == 'S':
+                gfall[column] = values.astype(object)
+        return pd.DataFrame(gfall, columns=list(gfall.keys()),
+                            index=pd.Index(index), copy=False)
+
+    def _load(self, key, columns=None):
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta = self._read_json(os.path.join(entry_dir, self.meta_fname))
+        if meta is None:
+            return None
+
+        gfall = OrderedDict()
+        try:
+            for i, column in enumerate(meta['columns']):
+                if columns is None or column in columns:
+                    gfall[column] = np.load(
+                        os.path.join(entry_dir, '{0:d}.npy'.format(i)),
+                        mmap_mode='c')
+            index = np.load(os.path.join(entry_dir, 'index.npy'),
+                            mmap_mode='c')
+        except IOError:
+            self._remove_entry(entry_dir)
+            return None
+
+        # marks the entry as recently used for the eviction
+        os.utime(entry_dir, None)
+        return self._memmapped_frame(gfall, index)
+
+    def _store(self, key, gfall, meta):
+        tmp_dir = tempfile.mkdtemp(prefix='.{0}-'.format(key),
+                                   dir=self.cache_dir)
+        for i, column in enumerate(gfall.columns):
+            values = gfall[column].values
+            if values.dtype == object:
+                values = np.array(values.tolist(), dtype='S')
+            np.save(os.path.join(tmp_dir, '{0:d}.npy'.format(i)), values)
+        np.save(os.path.join(tmp_dir, 'index.npy'), gfall.index.values)
+
+        meta['columns'] = list(gfall.columns)
+        meta['parser_version'] = gfall_parser_version
+        meta['n_lines'] = len(gfall)
+        meta['created'] = time.time()
+        meta['size'] = sum(os.path.getsize(os.path.join(tmp_dir, item))
+                           for item in os.listdir(tmp_dir))
+        self._write_json(os.path.join(tmp_dir, self.meta_fname), meta)
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process has stored the same entry in the meantime
+            self._remove_entry(tmp_dir)
+
+    def _get(self, fname, kind, skip_header, build_gfall, columns=None):
+        file_hash = self.file_hash(fname)
+        key = self._entry_key(file_hash, kind, skip_header)
+
+        gfall = self._load(key, columns=columns)
+        if gfall is not None:
+            print "Loaded {0} gfall from cache entry {1}".format(kind, key)
+            return gfall
+
+        self.remove_stale()
+        gfall = build_gfall()
+        self._store(key, gfall, dict(kind=kind,
+                                     source=os.path.abspath(fname),
+                                     file_hash=file_hash,
+                                     skip_header=skip_header))
+        self.evict()
+
+        if columns is not None:
+            gfall = gfall[[column for column in gfall.columns
+                           if column in columns]]
+        return gfall
+
+    def read_gfall_raw(self, fname, skip_header=2, n_jobs=1, columns=None):
+        """
+        Cached version of `read_gfall_raw`
+
+        Parameters
+        ----------
+
+        fname: ~str
+            path to gfall.dat
+        skip_header: ~int
+            number of lines to skip at the beginning of the file (default=2)
+        n_jobs: ~int
+            number of processes used when the file needs to be parsed
+        columns: list
+            only load these columns (optional - default=None loads all)
+
+        Returns
+        -------
+            : pandas.DataFrame
+        """
+        return self._get(fname, 'raw', skip_header,
+                         lambda: read_gfall_raw(fname, skip_header=skip_header,
+                                                n_jobs=n_jobs),
+                         columns=columns)
+
+    def parse_gfall(self, fname, skip_header=2, n_jobs=1, columns=None):
+        """
+        Cached version of `parse_gfall` applied to `read_gfall_raw`
+
+        Parameters
+        ----------
+
+        fname: ~str
+            path to gfall.dat
+        skip_header: ~int
+            number of lines to skip at the beginning of the file (default=2)
+        n_jobs: ~int
+            number of processes used when the file needs to be parsed
+        columns: list
+            only load these columns (optional - default=None loads all)
+
+        Returns
+        -------
+            : pandas.DataFrame
+        """
+        return self._get(fname, 'parsed', skip_header,
+                         lambda: parse_gfall(self.read_gfall_raw(
+                             fname, skip_header=skip_header, n_jobs=n_jobs)),
+                         columns=columns)
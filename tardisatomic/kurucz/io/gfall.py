@@ -1,234 +1,1257 @@
+import os
 import time
 import re
+import gzip
+import bz2
+import multiprocessing
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import as_strided
 
 from astropy import units as u
 
-def read_gfall_raw(fname):
+from tardisatomic import keys
+
+try:
+    import lzma
+    lzma_available = True
+except ImportError:
+    lzma_available = False
+
+# increase whenever the output of read_gfall_raw/parse_gfall changes (this
+# invalidates the entries of the gfall cache)
+gfall_parser_version = 2
+
+#FORMAT(F11.4,F7.3,F6.2,F12.3,F5.2,1X,A10,F12.3,F5.2,1X,A10,
+#3F6.2,A4,2I2,I3,F6.3,I3,F6.3,2I5,1X,A1,A1,1X,A1,A1,i1,A3,2I5,I6)
+
+kurucz_fortran_format = ('F11.4,F7.3,F6.2,F12.3,F5.2,1X,A10,F12.3,F5.2,1X,'
+                         'A10,F6.2,F6.2,F6.2,A4,I2,I2,I3,F6.3,I3,F6.3,I5,I5,'
+                         '1X,I1,A1,1X,I1,A1,I1,A3,I5,I5,I6')
+
+gfall_columns = ['wavelength', 'loggf', 'element_code', 'e_first', 'j_first',
+                 'blank1', 'label_first', 'e_second', 'j_second', 'blank2',
+                 'label_second', 'log_gamma_rad', 'log_gamma_stark',
+                 'log_gamma_vderwaals', 'ref', 'nlte_level_no_first',
+                 'nlte_level_no_second', 'isotope', 'log_f_hyperfine',
+                 'isotope2', 'log_iso_abundance', 'hyper_shift_first',
+                 'hyper_shift_second', 'blank3', 'hyperfine_f_first',
+                 'hyperfine_note_first', 'blank4', 'hyperfine_f_second',
+                 'hyperfine_note_second', 'line_strength_class', 'line_code',
+                 'lande_g_first', 'lande_g_second', 'isotopic_shift']
+
+fortran_field_pattern = re.compile(r'^(\d*)([FIXA])(\d*)(\.\d+)?$')
+
+
+def parse_fortran_format(fortran_format):
     """
-    Reading in a normal gfall.dat (please remove any empty lines)
+    Split a Fortran FORMAT string into its field types and widths
 
     Parameters
     ----------
 
-    fname: ~str
-        path to gfall.dat
+    fortran_format: ~str
+        comma separated Fortran edit descriptors (e.g. 'F11.4,1X,A10')
+
+    Returns
+    -------
+        : list of (str, int)
+            field type ('F', 'I', 'X' or 'A') and width for each field
+    """
+    fields = []
+    for descriptor in fortran_format.split(','):
+        match = fortran_field_pattern.match(descriptor.strip())
+        if match is None:
+            raise ValueError('Unsupported Fortran edit descriptor '
+                             '{0}'.format(descriptor))
+        repeat, field_type, width, _ = match.groups()
+        if field_type == 'X':
+            fields.append((field_type, int(repeat or 1)))
+        else:
+            fields.append((field_type, int(width)))
+    return fields
+
+
+gfall_fields = parse_fortran_format(kurucz_fortran_format)
+gfall_record_length = sum(width for _, width in gfall_fields)
+
+
+def _fortran_field_slices(columns, fields):
+    """
+    Field type and character slice of each column in a fixed-width record
+    """
+    field_slices = OrderedDict()
+    field_start = 0
+    for column, (field_type, width) in zip(columns, fields):
+        field_slices[column] = (field_type,
+                                slice(field_start, field_start + width))
+        field_start += width
+    return field_slices
+
+
+gfall_field_slices = _fortran_field_slices(gfall_columns, gfall_fields)
+
+fixed_width_error = ('{0} is not a fixed width file (please remove any empty '
+                     'lines or use engine="genfromtxt")')
+
+
+def _decode_numeric_field(field, field_type):
+    """
+    Decode a fixed-width numeric column from a byte matrix
+
+    The digits are accumulated (column by column) into an integer mantissa
+    which is divided by the power of ten given by the number of decimals. As
+    both are exact doubles this gives the same (correctly rounded) value as
+    parsing the text.
+
+    Parameters
+    ----------
+
+    field: ~numpy.ndarray
+        uint8 array of shape (n_lines, width)
+    field_type: ~str
+        'F' for floats or 'I' for integers
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            float64 (blank -> nan) or int64 (blank -> -1) values. Fields
+            without any digit (e.g. a lone '-' or '-.') count as blank.
+    """
+    n_lines, width = field.shape
+    mantissa = np.zeros(n_lines, dtype=np.int64)
+    decimals = np.zeros(n_lines, dtype=np.int64)
+    after_point = np.zeros(n_lines, dtype=bool)
+    negative = np.zeros(n_lines, dtype=bool)
+    no_digits = np.ones(n_lines, dtype=bool)
+    invalid = np.zeros(n_lines, dtype=bool)
+
+    for i in xrange(width):
+        char = field[:, i]
+        digit = char - np.uint8(ord('0'))
+        is_digit = digit < 10
+        is_point = char == ord('.')
+        is_minus = char == ord('-')
+        is_space = char == ord(' ')
+
+        mantissa = np.where(is_digit, mantissa * 10 + digit, mantissa)
+        decimals += is_digit & after_point
+        after_point |= is_point
+        negative |= is_minus
+        no_digits &= ~is_digit
+        invalid |= ~(is_digit | is_point | is_minus | is_space |
+                     (char == ord('+')))
+
+    if field_type == 'I':
+        values = np.where(negative, -mantissa, mantissa)
+        values[no_digits | invalid] = -1
+    else:
+        powers_of_ten = 10. ** np.arange(width + 1)
+        # multiplying by -1.0 keeps the sign of negative zeros ('-0.000')
+        values = (np.where(negative, -1.0, 1.0) *
+                  (mantissa / powers_of_ten[decimals]))
+        values[no_digits | invalid] = np.nan
+
+    return values
+
+
+def _gfall_usecols(usecols=None):
+    """
+    Check the requested raw gfall columns and put them into file order
+    """
+    if usecols is None:
+        return gfall_columns
+
+    unknown_columns = set(usecols) - set(gfall_columns)
+    if unknown_columns:
+        raise ValueError('Unknown gfall columns {0}'.format(
+            ', '.join(sorted(unknown_columns))))
+    return [column for column in gfall_columns if column in usecols]
+
+
+def _decode_gfall_columns(records, usecols=None):
+    """
+    Decode gfall records into an ordered dictionary of column arrays (only
+    the fields of `usecols` are decoded)
+    """
+
+    if records.shape[1] < gfall_record_length:
+        raise ValueError('gfall records need to be at least {0} characters '
+                         'wide'.format(gfall_record_length))
+
+    gfall = OrderedDict()
+    for column in _gfall_usecols(usecols):
+        field_type, field_slice = gfall_field_slices[column]
+        field = records[:, field_slice]
+        if field_type in 'FI':
+            gfall[column] = _decode_numeric_field(field, field_type)
+        else:
+            gfall[column] = np.ascontiguousarray(field).view(
+                'S{0:d}'.format(field.shape[1]))[:, 0]
+
+    return gfall
+
+
+def gfall_line_mask(element_code, wavelength, atoms=None, species=None,
+                    wavelength_range=None):
+    """
+    Select gfall lines by species and wavelength
+
+    A line is selected if its atom is in `atoms` or its species is in
+    `species` (if any of the two is given) and its wavelength is within
+    `wavelength_range`.
+
+    Parameters
+    ----------
+
+    element_code: ~numpy.ndarray
+        gfall element codes (e.g. 26.01 for Fe II)
+    wavelength: ~numpy.ndarray
+        gfall wavelengths in nm
+    atoms: list of int
+        atomic numbers (optional - default=None selects all)
+    species: list of (int, int)
+        (atomic number, ion number) tuples (optional - default=None selects
+        all)
+    wavelength_range: (float, float)
+        minimum and maximum wavelength in nm as given in gfall (air
+        wavelengths above 200 nm). The limits are inclusive and either of them
+        can be None (optional - default=None selects all)
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            boolean mask of the selected lines
+    """
+    mask = np.ones(len(element_code), dtype=bool)
+
+    if atoms is not None or species is not None:
+        atomic_number = element_code.astype(np.int64)
+        ion_number = ((element_code - atomic_number) * 100).round().astype(
+            np.int64)
+        species_mask = np.zeros(len(element_code), dtype=bool)
+        if atoms is not None:
+            species_mask |= np.in1d(atomic_number, list(atoms))
+        if species is not None:
+            species_mask |= np.in1d(atomic_number * 100 + ion_number,
+                                    [atom * 100 + ion for atom, ion in species])
+        mask &= species_mask
+
+    if wavelength_range is not None:
+        wavelength_min, wavelength_max = wavelength_range
+        if wavelength_min is not None:
+            mask &= wavelength >= wavelength_min
+        if wavelength_max is not None:
+            mask &= wavelength <= wavelength_max
+
+    return mask
+
+
+def select_gfall_lines(gfall_raw, atoms=None, species=None,
+                       wavelength_range=None):
+    """
+    Select lines of an already decoded raw gfall dataframe (see
+    `gfall_line_mask` for the predicates)
+    """
+    return gfall_raw[gfall_line_mask(gfall_raw.element_code.values,
+                                     gfall_raw.wavelength.values, atoms=atoms,
+                                     species=species,
+                                     wavelength_range=wavelength_range)]
+
+
+def _select_gfall_records(records, atoms=None, species=None,
+                          wavelength_range=None):
+    """
+    Apply the line predicates to undecoded gfall records. Only the fields
+    needed by the predicates are decoded.
+
+    Returns
+    -------
+        : ~numpy.ndarray, ~numpy.ndarray
+            records of the selected lines and their line numbers (None for
+            both if there are no predicates)
+    """
+    if atoms is None and species is None and wavelength_range is None:
+        return None, None
+
+    def decode_field(column):
+        field_type, field_slice = gfall_field_slices[column]
+        return _decode_numeric_field(records[:, field_slice], field_type)
+
+    element_code = decode_field('element_code')
+    if wavelength_range is None:
+        wavelength = None
+    else:
+        wavelength = decode_field('wavelength')
+
+    line_numbers = np.nonzero(gfall_line_mask(
+        element_code, wavelength, atoms=atoms, species=species,
+        wavelength_range=wavelength_range))[0]
+    return records[line_numbers], line_numbers
+
+
+def _decode_selected_records(records, line_offset=0, usecols=None,
+                             **predicates):
+    """
+    Decode the records selected by the line predicates into a dataframe
+    indexed by line number
+    """
+    selected_records, line_numbers = _select_gfall_records(records,
+                                                           **predicates)
+    if selected_records is None:
+        gfall = decode_gfall_records(records, usecols=usecols)
+        gfall.index = np.arange(line_offset, line_offset + len(gfall))
+    else:
+        gfall = decode_gfall_records(selected_records, usecols=usecols)
+        gfall.index = line_offset + line_numbers
+    return gfall
+
+
+def decode_gfall_records(records, usecols=None):
+    """
+    Decode gfall records held in a fixed-stride byte matrix
+
+    Parameters
+    ----------
+
+    records: ~numpy.ndarray
+        uint8 array of shape (n_lines, line_width) with one gfall line per
+        row
+    usecols: list
+        only decode these columns (optional - default=None decodes all)
 
     Returns
     -------
         : pandas.DataFrame
             pandas Dataframe represenation of gfall
     """
-    start_time = time.time()
-    #FORMAT(F11.4,F7.3,F6.2,F12.3,F5.2,1X,A10,F12.3,F5.2,1X,A10,
-    #3F6.2,A4,2I2,I3,F6.3,I3,F6.3,2I5,1X,A1,A1,1X,A1,A1,i1,A3,2I5,I6)
 
-    kurucz_fortran_format =('F11.4,F7.3,F6.2,F12.3,F5.2,1X,A10,F12.3,F5.2,1X,'
-                            'A10,F6.2,F6.2,F6.2,A4,I2,I2,I3,F6.3,I3,F6.3,I5,I5,'
-                            '1X,I1,A1,1X,I1,A1,I1,A3,I5,I5,I6')
+    return pd.DataFrame(_decode_gfall_columns(records, usecols=usecols),
+                        columns=_gfall_usecols(usecols))
 
-    number_match = re.compile(r'\d+(\.\d+)?')
-    type_match = re.compile(r'[FIXA]')
-    type_dict = {'F':np.float64, 'I':np.int64, 'X':'S1', 'A':'S10'}
-    field_types = tuple([type_dict[item] for item in number_match.sub(
-        '', kurucz_fortran_format).split(',')])
 
-    field_widths = type_match.sub('', kurucz_fortran_format)
-    field_widths = map(int, re.sub(r'\.\d+', '', field_widths).split(','))
+# line shape parameters which are stored as float32 in compact mode
+gfall_compact_float_columns = ['log_gamma_rad', 'log_gamma_stark',
+                               'log_gamma_vderwaals', 'log_f_hyperfine',
+                               'log_iso_abundance']
+
+
+def _compact_int_dtype(width):
+    """
+    Smallest integer dtype holding any value of an I field of `width`
+    """
+    if width <= 2:
+        return np.int8
+    elif width <= 4:
+        return np.int16
+    else:
+        return np.int32
+
+
+def compact_gfall(gfall_df):
+    """
+    Convert a raw or parsed gfall dataframe to compact dtypes (in place)
+
+    String fields become categoricals, integer fields the smallest integer
+    type that holds their width, the line shape parameters (see
+    `gfall_compact_float_columns`) float32 and atomic and ion number int8.
+    Wavelengths, oscillator strengths, energies and J stay float64.
+
+    Parameters
+    ----------
+
+    gfall_df: ~pandas.DataFrame
+        output of `read_gfall_raw` or `parse_gfall` (or a projection of it)
+
+    Returns
+    -------
+        : ~pandas.DataFrame
+            `gfall_df`
+    """
+    for column in gfall_df.columns:
+        if column in ('atomic_number', 'ion_number'):
+            gfall_df[column] = gfall_df[column].values.astype(np.int8)
+            continue
+
+        # the paired columns of a parsed gfall have the type of the raw ones
+        raw_column = re.sub('_(lower|upper)$', '_first', column)
+        if raw_column not in gfall_field_slices:
+            continue
+        field_type, field_slice = gfall_field_slices[raw_column]
+
+        if field_type in 'AX':
+            if gfall_df[column].dtype.name != 'category':
+                gfall_df[column] = gfall_df[column].astype('category')
+        elif field_type == 'I':
+            gfall_df[column] = gfall_df[column].values.astype(
+                _compact_int_dtype(field_slice.stop - field_slice.start))
+        elif raw_column in gfall_compact_float_columns:
+            gfall_df[column] = gfall_df[column].values.astype(np.float32)
+
+    return gfall_df
+
+
+def _map_gfall_records(fname, skip_header=2):
+    """
+    Memory-map gfall.dat as a fixed-stride byte matrix
+
+    Parameters
+    ----------
+
+    fname: ~str
+        path to gfall.dat
+    skip_header: ~int
+        number of lines to skip at the beginning of the file
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            uint8 array view with one gfall line (without newline) per row
+            (no rows if there are no lines after the header)
+    """
+    with open(fname, 'rb') as fh:
+        for i in xrange(skip_header):
+            fh.readline()
+        data_start = fh.tell()
+        line_stride = len(fh.readline())
+
+    if line_stride == 0:
+        return np.empty((0, gfall_record_length), dtype=np.uint8)
+    if line_stride <= gfall_record_length:
+        raise ValueError('Could not find a complete gfall record in '
+                         '{0}'.format(fname))
+
+    data = np.memmap(fname, dtype=np.uint8, mode='r', offset=data_start)
+
+    n_lines, remainder = divmod(len(data), line_stride)
+    if remainder == line_stride - 1:
+        # last line is not terminated by a newline
+        n_lines += 1
+    elif remainder != 0:
+        raise ValueError(fixed_width_error.format(fname))
+
+    if not np.all(data[line_stride - 1::line_stride] == ord('\n')):
+        raise ValueError(fixed_width_error.format(fname))
+
+    return as_strided(data, shape=(n_lines, line_stride - 1),
+                      strides=(line_stride, 1))
+
+
+def _gfall_compression(fname):
+    """
+    Compression of gfall.dat derived from the file extension ('gz', 'bz2',
+    'xz' or None for an uncompressed file)
+    """
+    extension = os.path.splitext(fname)[1].lower()
+    if extension in ('.gz', '.bz2', '.xz'):
+        return extension[1:]
+    else:
+        return None
+
+
+def _open_gfall(fname):
+    """
+    Open (the possibly compressed) gfall.dat as a binary file - compressed
+    files are decompressed while they are read
+    """
+    compression = _gfall_compression(fname)
+    if compression is None:
+        return open(fname, 'rb')
+    elif compression == 'gz':
+        return gzip.open(fname, 'rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(fname, 'rb')
+    else:
+        if not lzma_available:
+            raise ImportError('Reading {0} requires the lzma module (e.g. '
+                              'backports.lzma on python 2)'.format(fname))
+        return lzma.open(fname, 'rb')
+
+
+def _read_gfall_genfromtxt(fname, skip_header=2):
+    type_dict = {'F':np.float64, 'I':np.int64, 'X':'S1', 'A':'S10'}
+    field_types = tuple([type_dict[field_type]
+                         for field_type, _ in gfall_fields])
+    field_widths = [width for _, width in gfall_fields]
 
     gfall = np.genfromtxt(fname, dtype=field_types, delimiter=field_widths,
-                          skiprows=2)
-    columns = ['wavelength', 'loggf', 'element_code', 'e_first', 'j_first',
-               'blank1', 'label_first', 'e_second', 'j_second', 'blank2',
-               'label_second', 'log_gamma_rad', 'log_gamma_stark',
-               'log_gamma_vderwaals', 'ref', 'nlte_level_no_first',
-               'nlte_level_no_second', 'isotope', 'log_f_hyperfine',
-               'isotope2', 'log_iso_abundance', 'hyper_shift_first',
-               'hyper_shift_second', 'blank3', 'hyperfine_f_first',
-               'hyperfine_note_first', 'blank4', 'hyperfine_f_second',
-               'hyperfine_note_second', 'line_strength_class', 'line_code',
-               'lande_g_first', 'lande_g_second', 'isotopic_shift']
+                          skip_header=skip_header)
 
     gfall = pd.DataFrame(gfall)
-    gfall.columns = columns
+    gfall.columns = gfall_columns
+    return gfall
+
+
+def _decode_gfall_line_range(line_range):
+    """
+    Decode the lines `start` to `stop` of gfall.dat (worker for the parallel
+    reader - it returns plain arrays as they are cheap to pickle)
+    """
+    fname, skip_header, start, stop, usecols, predicates = line_range
+    records = _map_gfall_records(fname, skip_header=skip_header)[start:stop]
+    selected_records, line_numbers = _select_gfall_records(records,
+                                                           **predicates)
+    if selected_records is None:
+        return _decode_gfall_columns(records, usecols=usecols), None
+    else:
+        return (_decode_gfall_columns(selected_records, usecols=usecols),
+                start + line_numbers)
+
+
+def _read_gfall_parallel(fname, n_jobs, skip_header=2, usecols=None,
+                         **predicates):
+    """
+    Split gfall.dat into line-aligned ranges and decode them in a process pool
+    """
+    records = _map_gfall_records(fname, skip_header=skip_header)
+    n_lines = len(records)
+    if n_lines == 0:
+        return _decode_selected_records(records, usecols=usecols,
+                                        **predicates)
+    range_bounds = np.linspace(0, n_lines, n_jobs + 1).astype(np.int64)
+    line_ranges = [(fname, skip_header, start, stop, usecols, predicates)
+                   for start, stop in zip(range_bounds[:-1], range_bounds[1:])
+                   if stop > start]
+
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        range_results = pool.map(_decode_gfall_line_range, line_ranges)
+    finally:
+        pool.close()
+        pool.join()
+
+    usecols = _gfall_usecols(usecols)
+    gfall = OrderedDict()
+    for column in usecols:
+        gfall[column] = np.concatenate([columns[column]
+                                        for columns, _ in range_results])
+    gfall = pd.DataFrame(gfall, columns=usecols)
+
+    if range_results and range_results[0][1] is not None:
+        gfall.index = np.concatenate([line_numbers
+                                      for _, line_numbers in range_results])
+    return gfall
+
+
+def read_gfall_raw(fname, engine='bytes', skip_header=2, n_jobs=1,
+                   atoms=None, species=None, wavelength_range=None,
+                   usecols=None, compact=False):
+    """
+    Reading in a normal gfall.dat (please remove any empty lines)
+
+    Parameters
+    ----------
+
+    fname: ~str
+        path to gfall.dat (.gz, .bz2 and .xz files are decompressed while
+        they are read)
+
+    engine: ~str
+        'bytes' (default) memory-maps the file and decodes the fixed-width
+        columns with vectorized numpy operations (compressed files are
+        decoded in chunks instead), 'genfromtxt' uses `numpy.genfromtxt` and
+        also copes with ragged lines
+
+    skip_header: ~int
+        number of lines to skip at the beginning of the file (default=2)
+
+    n_jobs: ~int
+        number of processes decoding line ranges of the file in parallel
+        (only engine='bytes'; -1 uses all cores). The result is identical to
+        the serial reader.
+
+    atoms: list of int
+        only read lines of these atomic numbers (optional)
+
+    species: list of (int, int)
+        only read lines of these (atomic number, ion number) species
+        (optional)
+
+    wavelength_range: (float, float)
+        only read lines within this wavelength range in nm (optional). See
+        `gfall_line_mask` for the details of the predicates. With
+        engine='bytes' they are evaluated on the undecoded element code and
+        wavelength fields so that rejected lines are never fully decoded. The
+        index of the returned dataframe holds the line numbers in the file.
+
+    usecols: list
+        only read these columns (optional - default=None reads all). With
+        engine='bytes' the other fields are not decoded at all.
+
+    compact: ~bool
+        convert the columns to compact dtypes (see `compact_gfall`)
+
+    Returns
+    -------
+        : pandas.DataFrame
+            pandas Dataframe represenation of gfall
+    """
+    start_time = time.time()
+
+    predicates = dict(atoms=atoms, species=species,
+                      wavelength_range=wavelength_range)
+
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+
+    if engine == 'bytes':
+        if _gfall_compression(fname) is not None:
+            if n_jobs != 1:
+                raise ValueError('n_jobs is not supported for compressed '
+                                 'files')
+            gfall_chunks = list(iter_gfall_raw(fname, skip_header=skip_header,
+                                               usecols=usecols, **predicates))
+            if gfall_chunks:
+                gfall = pd.concat(gfall_chunks)
+            else:
+                gfall = decode_gfall_records(
+                    np.empty((0, gfall_record_length), dtype=np.uint8),
+                    usecols=usecols)
+        elif n_jobs > 1:
+            gfall = _read_gfall_parallel(fname, n_jobs,
+                                         skip_header=skip_header,
+                                         usecols=usecols, **predicates)
+        else:
+            gfall = _decode_selected_records(_map_gfall_records(
+                fname, skip_header=skip_header), usecols=usecols,
+                **predicates)
+    elif engine == 'genfromtxt':
+        if n_jobs != 1:
+            raise ValueError('n_jobs is only supported with engine="bytes"')
+        gfall = select_gfall_lines(_read_gfall_genfromtxt(
+            fname, skip_header=skip_header), **predicates)
+        gfall = gfall[_gfall_usecols(usecols)]
+    else:
+        raise ValueError('engine needs to be either "bytes" or "genfromtxt" '
+                         '(got {0})'.format(engine))
+
+    if compact:
+        compact_gfall(gfall)
+
     print "took {0:.2f} seconds".format(time.time() - start_time)
     return gfall
 
 
+def _read_block(fh, size):
+    """
+    Read `size` bytes from `fh` (less only at the end of the file)
+    """
+    parts = []
+    while size > 0:
+        part = fh.read(size)
+        if not part:
+            break
+        parts.append(part)
+        size -= len(part)
+    return ''.join(parts)
+
+
+def _iter_gfall_records(fh, chunksize, skip_header=2, name='gfall'):
+    """
+    Read gfall lines from an open file in blocks of `chunksize` lines
+
+    Parameters
+    ----------
 
-def parse_gfall(gfall_df):
+    fh: file
+        binary file object positioned at the start of gfall.dat
+    chunksize: ~int
+        number of lines per block
+    skip_header: ~int
+        number of lines to skip at the beginning of the file
+    name: ~str
+        name of the file used in error messages
+
+    Yields
+    ------
+        : ~numpy.ndarray
+            uint8 array with one gfall line (without newline) per row
     """
-    GFall pandas dataframe from read_gfall
-    :param gfall_df:
-    :return:
+    for i in xrange(skip_header):
+        fh.readline()
+
+    first_line = fh.readline()
+    line_stride = len(first_line)
+    if line_stride == 0:
+        return
+    if line_stride <= gfall_record_length:
+        raise ValueError('Could not find a complete gfall record in '
+                         '{0}'.format(name))
+
+    block_size = chunksize * line_stride
+    block = first_line + _read_block(fh, block_size - line_stride)
+    while block:
+        n_lines, remainder = divmod(len(block), line_stride)
+        if remainder == line_stride - 1:
+            # last line is not terminated by a newline
+            block += '\n'
+            n_lines += 1
+        elif remainder != 0:
+            raise ValueError(fixed_width_error.format(name))
+
+        records = np.frombuffer(block, dtype=np.uint8).reshape(
+            n_lines, line_stride)
+        if not np.all(records[:, -1] == ord('\n')):
+            raise ValueError(fixed_width_error.format(name))
+
+        yield records[:, :-1]
+        block = _read_block(fh, block_size)
+
+
+def iter_gfall_raw(fname, chunksize=100000, skip_header=2, atoms=None,
+                   species=None, wavelength_range=None, usecols=None,
+                   compact=False):
     """
+    Read gfall.dat in chunks of `chunksize` lines
 
-    gfall_df = gfall_df.copy()
+    Only one chunk is held in memory at any time, which allows to ingest the
+    full gfall with a fixed memory budget. Compressed files (.gz, .bz2 and
+    .xz) are decompressed block by block without a temporary copy.
 
-    double_columns = [item.replace('_first', '') for item in gfall_df.columns if
-                     item.endswith('first')]
+    Parameters
+    ----------
+
+    fname: ~str
+        path to gfall.dat
+    chunksize: ~int
+        number of lines per chunk (default=100000)
+    skip_header: ~int
+        number of lines to skip at the beginning of the file (default=2)
+    atoms, species, wavelength_range:
+        line predicates applied before decoding (see `read_gfall_raw`)
+    usecols: list
+        only read these columns (optional - default=None reads all)
+    compact: ~bool
+        convert the columns to compact dtypes (see `compact_gfall`)
+
+    Yields
+    ------
+        : pandas.DataFrame
+            pandas Dataframe represenation of the selected lines in the chunk
+            (same columns as `read_gfall_raw`)
+    """
+    line_offset = 0
+    with _open_gfall(fname) as fh:
+        for records in _iter_gfall_records(fh, chunksize,
+                                           skip_header=skip_header,
+                                           name=fname):
+            gfall = _decode_selected_records(
+                records, line_offset=line_offset, usecols=usecols,
+                atoms=atoms, species=species,
+                wavelength_range=wavelength_range)
+            if compact:
+                compact_gfall(gfall)
+            yield gfall
+            line_offset += len(records)
+
+
+# raw columns needed by parse_gfall, extract_levels and extract_lines (e.g. for
+# the usecols of read_gfall_raw)
+gfall_basic_columns = ['wavelength', 'loggf', 'element_code', 'e_first',
+                       'j_first', 'label_first', 'e_second', 'j_second',
+                       'label_second']
+
+
+def _where_categorical(condition, first, second):
+    """
+    `np.where` for two categorical series (working on their codes)
+    """
+    categories = first.cat.categories.union(second.cat.categories)
 
-    # due to the fact that energy is stored in 1/cm
-    order_lower_upper = (gfall_df.e_first.abs() <
-                         gfall_df.e_second.abs())
+    def recode(series):
+        codes = series.cat.codes.values
+        return np.where(codes == -1, -1, categories.get_indexer(
+            series.cat.categories)[codes])
 
+    return pd.Categorical.from_codes(
+        np.where(condition, recode(first), recode(second)), categories)
 
-    for column in double_columns:
-        data = pd.concat([gfall_df['{0}_first'.format(
-            column)][order_lower_upper], gfall_df['{0}_second'.format(
-            column)][~order_lower_upper]])
 
-        gfall_df['{0}_lower'.format(column)] = data
+def _strip_labels(labels):
+    """
+    Strip the whitespace around labels (for categoricals only the categories
+    are stripped)
+    """
+    if labels.dtype.name != 'category':
+        return labels.str.strip()
 
-        data = pd.concat([gfall_df['{0}_first'.format(
-            column)][~order_lower_upper], gfall_df['{0}_second'.format(
-            column)][order_lower_upper]])
+    # stripping can make categories equal
+    recode, categories = pd.factorize(labels.cat.categories.str.strip())
+    codes = labels.cat.codes.values
+    return pd.Categorical.from_codes(
+        np.where(codes == -1, -1, recode[codes]), categories)
 
-        gfall_df['{0}_upper'.format(column)] = data
 
+def _order_lower_upper(gfall_df):
+    """
+    Sort the levels of every line into lower and upper
 
-        del gfall_df['{0}_first'.format(column)]
-        del gfall_df['{0}_second'.format(column)]
+    The first level of a line is the lower one if the absolute value of its
+    energy (in 1/cm and negative for predicted levels) is smaller.
 
-    gfall_df.e_lower = (gfall_df.e_lower.values / u.cm).to(
-        u.eV, u.spectral()) #convert to eV
-    gfall_df.e_upper = (gfall_df.e_upper.values / u.cm).to(
-        u.eV, u.spectral()) #convert to eV
+    Parameters
+    ----------
 
+    gfall_df: ~pandas.DataFrame
+        raw gfall dataframe (with the paired `_first` and `_second` columns)
 
+    Returns
+    -------
+        : OrderedDict
+            (lower, upper) arrays for every paired column (e.g. 'e' for
+            e_first/e_second) in the order of the columns
+    """
 
+    first_is_lower = (np.abs(gfall_df.e_first.values) <
+                      np.abs(gfall_df.e_second.values))
+
+    lower_upper = OrderedDict()
+    for column in gfall_df.columns:
+        if not column.endswith('_first'):
+            continue
+        column = column[:-len('_first')]
+        first = gfall_df['{0}_first'.format(column)]
+        second = gfall_df['{0}_second'.format(column)]
+        if first.dtype.name == 'category' and second.dtype.name == 'category':
+            lower_upper[column] = (
+                _where_categorical(first_is_lower, first, second),
+                _where_categorical(first_is_lower, second, first))
+        else:
+            first = first.values
+            second = second.values
+            lower_upper[column] = (np.where(first_is_lower, first, second),
+                                   np.where(first_is_lower, second, first))
+    return lower_upper
+
+
+def parse_gfall(gfall_df, inplace=False, compact=False):
+    """
+    Parse the raw gfall dataframe from `read_gfall_raw`
 
-    gfall_df.wavelength *= 10
+    The `_first`/`_second` columns are sorted into `_lower`/`_upper`
+    columns, energies are converted to eV (with flags for predicted levels),
+    wavelengths to Angstrom and the element code is split into atomic and ion
+    number.
 
-    gfall_df.label_lower = gfall_df.label_lower.apply(
-        lambda x: x.strip())
-    gfall_df.label_upper = gfall_df.label_upper.apply(
-        lambda x: x.strip())
+    Parameters
+    ----------
 
-    gfall_df['e_lower_predicted'] = gfall_df.e_lower < 0
-    gfall_df.e_lower = gfall_df.e_lower.abs()
-    gfall_df['e_upper_predicted'] = gfall_df.e_upper < 0
-    gfall_df.e_upper = gfall_df.e_upper.abs()
+    gfall_df: ~pandas.DataFrame
+        raw gfall dataframe
+    inplace: ~bool
+        modify `gfall_df` instead of working on a copy (default=False). Only
+        the columns which are not replaced are copied otherwise.
+    compact: ~bool
+        convert the columns to compact dtypes (see `compact_gfall`). Columns
+        which are not needed should already be left out when reading gfall
+        (e.g. `read_gfall_raw(fname, usecols=gfall_basic_columns)`).
 
-    gfall_df['g_lower'] = 2*gfall_df.j_lower + 1
-    gfall_df['g_upper'] = 2*gfall_df.j_upper + 1
+    Returns
+    -------
+        : ~pandas.DataFrame
+            parsed gfall dataframe
+    """
 
-    gfall_df['atomic_number'] = gfall_df.element_code.astype(int)
-    gfall_df['ion_number'] = (
-        (gfall_df.element_code.values -
-         gfall_df.atomic_number.values) * 100).round().astype(int)
+    missing_columns = [column for column in gfall_basic_columns
+                       if column != 'loggf' and column not in gfall_df.columns]
+    if missing_columns:
+        raise ValueError('parse_gfall needs the raw gfall columns {0}'.format(
+            ', '.join(missing_columns)))
+
+    lower_upper = _order_lower_upper(gfall_df)
+    paired_columns = set()
+    for column in lower_upper:
+        paired_columns.update(['{0}_first'.format(column),
+                               '{0}_second'.format(column)])
+
+    if inplace:
+        for column in paired_columns:
+            del gfall_df[column]
+    else:
+        gfall_df = gfall_df[[column for column in gfall_df.columns
+                             if column not in paired_columns]].copy()
+
+    for column, (lower, upper) in lower_upper.items():
+        gfall_df['{0}_lower'.format(column)] = lower
+        gfall_df['{0}_upper'.format(column)] = upper
+
+    # energies are stored in 1/cm
+    gfall_df['e_lower'] = (gfall_df.e_lower.values / u.cm).to(
+        u.eV, u.spectral()).value
+    gfall_df['e_upper'] = (gfall_df.e_upper.values / u.cm).to(
+        u.eV, u.spectral()).value
+
+    gfall_df['wavelength'] = gfall_df.wavelength.values * 10
+
+    gfall_df['label_lower'] = _strip_labels(gfall_df.label_lower)
+    gfall_df['label_upper'] = _strip_labels(gfall_df.label_upper)
+
+    gfall_df['e_lower_predicted'] = gfall_df.e_lower.values < 0
+    gfall_df['e_lower'] = np.abs(gfall_df.e_lower.values)
+    gfall_df['e_upper_predicted'] = gfall_df.e_upper.values < 0
+    gfall_df['e_upper'] = np.abs(gfall_df.e_upper.values)
+
+    gfall_df['g_lower'] = 2 * gfall_df.j_lower.values + 1
+    gfall_df['g_upper'] = 2 * gfall_df.j_upper.values + 1
+
+    element_code = gfall_df.element_code.values
+    atomic_number = element_code.astype(int)
+    gfall_df['atomic_number'] = atomic_number
+    gfall_df['ion_number'] = ((element_code - atomic_number) *
+                              100).round().astype(int)
 
     del gfall_df['element_code']
 
+    if compact:
+        compact_gfall(gfall_df)
+
     return gfall_df
 
-def extract_levels(gfall_df, selected_columns=None):
+
+def iter_gfall(fname, chunksize=100000, skip_header=2, atoms=None,
+               species=None, wavelength_range=None, usecols=None,
+               compact=False):
     """
-    Extract the levels from the gfall dataframe
+    Read and parse gfall.dat in chunks of `chunksize` lines
+
+    The chunks can be handed to `extract_levels` directly. As the levels need
+    to be known before the lines can be linked, the lines are extracted in a
+    second pass::
+
+        levels = extract_levels(iter_gfall(fname))
+        for gfall_chunk in iter_gfall(fname):
+            lines = extract_lines(gfall_chunk, levels)
 
     Parameters
     ----------
 
-    gfall_df: ~pandas.DataFrame
-    selected_columns: list
-        list of which columns to select (optional - default=None which selects
-        a default set of columns)
+    fname: ~str
+        path to gfall.dat
+    chunksize: ~int
+        number of lines per chunk (default=100000)
+    skip_header: ~int
+        number of lines to skip at the beginning of the file (default=2)
+    atoms, species, wavelength_range:
+        line predicates applied before decoding (see `read_gfall_raw`)
+    usecols: list
+        only read these raw columns (optional - default=None reads all)
+    compact: ~bool
+        convert the columns to compact dtypes (see `compact_gfall`)
+
+    Yields
+    ------
+        : pandas.DataFrame
+            parsed gfall chunk (see `parse_gfall`)
+    """
+    for gfall_raw in iter_gfall_raw(fname, chunksize=chunksize,
+                                    skip_header=skip_header, atoms=atoms,
+                                    species=species,
+                                    wavelength_range=wavelength_range,
+                                    usecols=usecols, compact=compact):
+        yield parse_gfall(gfall_raw, inplace=True, compact=compact)
+
+
+def _factorize_keys(key_arrays):
+    """
+    Integer code for every distinct combination of the key arrays
+
+    Parameters
+    ----------
+
+    key_arrays: list of ~numpy.ndarray
+        arrays of equal length (missing values form a key of their own)
 
     Returns
     -------
-        : ~pandas.DataFrame
-            a level DataFrame
+        : ~numpy.ndarray
+            int64 codes numbered in the order of first appearance
+    """
+    codes = np.zeros(len(key_arrays[0]), dtype=np.int64)
+    n_codes = 1
+    for key_array in key_arrays:
+        key_codes, key_uniques = pd.factorize(key_array)
+        # shift the missing value code (-1) to 0
+        key_codes = key_codes.astype(np.int64) + 1
+        n_key_codes = len(key_uniques) + 1
+        if n_codes * n_key_codes >= 2**62:
+            # renumber the combined codes densely before they overflow
+            codes, uniques = pd.factorize(codes)
+            n_codes = len(uniques)
+        codes = codes * n_key_codes + key_codes
+        n_codes *= n_key_codes
+    return pd.factorize(codes)[0].astype(np.int64)
+
+
+def _first_occurrences(codes):
     """
+    Positions of the first occurrence of each code (for codes numbered in the
+    order of first appearance, see `_factorize_keys`)
+    """
+    running_max = np.maximum.accumulate(codes)
+    return np.flatnonzero(np.diff(np.r_[-1, running_max]) > 0)
 
-    if selected_columns is None:
-        selected_columns = ['atomic_number', 'ion_number', 'energy', 'g',
-                            'label', 'theoretical']
+
+def _unique_levels(levels):
+    """
+    Drop duplicate (atomic_number, ion_number, energy, g, label) levels
+    (keeping the first)
+    """
+    return levels.iloc[_first_occurrences(_factorize_keys(
+        [levels[column].values for column in
+         ['atomic_number', 'ion_number', 'energy', 'g', 'label']]))]
 
 
+def _extract_level_candidates(gfall_df, selected_columns):
+    """
+    Unique lower and upper levels of a parsed gfall dataframe (in order of
+    their first appearance)
+    """
+
     if 'e_lower' not in gfall_df.columns:
         raise ValueError('gfall dataframe needs to be parsed before this '
                          'function can be used')
 
-    column_renames = {'e_{0}':'energy', 'g_{0}':'g', 'label_{0}':'label',
-                      'e_{0}_predicted':'theoretical'}
+    column_sources = {'energy':'e_{0}', 'g':'g_{0}', 'label':'label_{0}',
+                      'theoretical':'e_{0}_predicted'}
 
+    level_candidates = []
+    for level_type in ('lower', 'upper'):
+        # only the selected columns are taken from the (large) gfall dataframe
+        levels = gfall_df[[column_sources.get(column, column).format(
+            level_type) for column in selected_columns]]
+        levels.columns = selected_columns
+        level_candidates.append(_unique_levels(levels))
 
-    e_lower_levels = gfall_df.rename(
-        columns=dict([(key.format('lower'), value)
-                      for key, value in column_renames.items()]))
+    return level_candidates
 
 
+def extract_levels(gfall_df, selected_columns=None, compact=False):
+    """
+    Extract the levels from the gfall dataframe
 
-    e_upper_levels = gfall_df.rename(
-        columns=dict([(key.format('upper'), value)
-                      for key, value in column_renames.items()]))
+    Parameters
+    ----------
 
-    levels = pd.concat([e_lower_levels[selected_columns],
-                        e_upper_levels[selected_columns]])
+    gfall_df: ~pandas.DataFrame or iterable of ~pandas.DataFrame
+        parsed gfall dataframe or parsed chunks of it (e.g. from
+        `iter_gfall`)
+    selected_columns: list
+        list of which columns to select (optional - default=None which selects
+        a default set of columns)
+    compact: ~bool
+        store labels as categoricals and atomic and ion numbers as int8
+        (default=False)
 
+    Returns
+    -------
+        : ~pandas.DataFrame
+            a level DataFrame
+    """
 
-    levels = levels.drop_duplicates(['atomic_number', 'ion_number',
-                                             'energy', 'g', 'label']).sort(
-        ['atomic_number', 'ion_number', 'energy'])
+    if selected_columns is None:
+        selected_columns = ['atomic_number', 'ion_number', 'energy', 'g',
+                            'label', 'theoretical']
 
-    levels_clean = levels.drop_duplicates(['atomic_number', 'ion_number',
-                                           'energy'])
 
-    levels_clean_level_number = levels_clean.groupby(
-        ['atomic_number', 'ion_number']).g.transform(
-        lambda x: np.arange(len(x))).values
-    levels_clean['level_number'] = levels_clean_level_number
+    if isinstance(gfall_df, pd.DataFrame):
+        lower_levels, upper_levels = _extract_level_candidates(
+            gfall_df, selected_columns)
+    else:
+        lower_levels = []
+        upper_levels = []
+        for gfall_chunk in gfall_df:
+            lower_chunk, upper_chunk = _extract_level_candidates(
+                gfall_chunk, selected_columns)
+            lower_levels.append(lower_chunk)
+            upper_levels.append(upper_chunk)
+        lower_levels = pd.concat(lower_levels)
+        upper_levels = pd.concat(upper_levels)
+
+    levels = pd.concat([lower_levels, upper_levels])
+
+    levels = _unique_levels(levels)
+    # np.lexsort is stable (equal energies keep their order)
+    levels = levels.iloc[np.lexsort((levels.energy.values,
+                                     levels.ion_number.values,
+                                     levels.atomic_number.values))].copy()
+
+    # levels with the same energy share a level number
+    species_key = keys.pack(levels.atomic_number.values,
+                            levels.ion_number.values)
+    energy_key = _factorize_keys([levels.atomic_number.values,
+                                  levels.ion_number.values,
+                                  levels.energy.values])
+    first_energy = _first_occurrences(energy_key)
+    energy_level_number = pd.Series(species_key[first_energy]).groupby(
+        species_key[first_energy]).cumcount().values
+
+    levels['level_number'] = energy_level_number[energy_key]
+    levels['level_id'] = np.arange(len(levels))
 
-    levels_clean = levels_clean.set_index(
-        ['atomic_number', 'ion_number', 'energy'])
+    if compact:
+        levels['label'] = levels.label.astype('category')
+        levels['atomic_number'] = levels.atomic_number.values.astype(np.int8)
+        levels['ion_number'] = levels.ion_number.values.astype(np.int8)
 
-    aie_index = [tuple(item)
-                 for item in levels[
-            ['atomic_number', 'ion_number', 'energy']].values.tolist()]
+    return levels
 
-    level_number = levels_clean.level_number.loc[aie_index]
 
-    levels['level_number'] = level_number.values
-    levels['level_id'] = np.arange(len(levels))
+def extract_lines(gfall_df, levels_df, selected_columns=None):
+    """
+    Extract the lines from the gfall dataframe and link them to their levels
 
-    return levels
-    
+    The lower and upper levels of each line are matched exactly on
+    (atomic_number, ion_number, energy, g, label) by factorizing the keys of
+    the lines and levels together into integer codes.
 
-def extract_lines(gfall_df, levels_df, selected_columns=None):
+    Parameters
+    ----------
 
-    if selected_columns is None:
-        selected_columns = ['wavelength','loggf' , 'atomic_number', 'ion_number']
+    gfall_df: ~pandas.DataFrame
+        parsed gfall dataframe
+    levels_df: ~pandas.DataFrame
+        levels from `extract_levels`
+    selected_columns: list
+        list of which columns to select (optional - default=None which selects
+        a default set of columns)
 
+    Returns
+    -------
+        : ~pandas.DataFrame
+            a line DataFrame with the level_id and level_number of the lower
+            and upper level (-1 if a level is not in `levels_df`)
+    """
 
+    if selected_columns is None:
+        selected_columns = ['wavelength','loggf' , 'atomic_number', 'ion_number']
 
     if 'e_lower' not in gfall_df.columns:
         raise ValueError('gfall dataframe needs to be parsed before this '
                          'function can be used')
 
-    levels_df_idx = levels_df.set_index(['atomic_number', 'ion_number',
-                                         'energy', 'g', 'label'])
-
     lines = gfall_df[selected_columns].copy()
 
-    level_lower_idx = gfall_df[['atomic_number', 'ion_number', 'e_lower',
-                                'g_lower', 'label_lower']].values.tolist()
-    level_lower_idx = [tuple(item) for item in level_lower_idx]
+    n_levels = len(levels_df)
+    n_lines = len(gfall_df)
+
+    key_columns = [('atomic_number', 'atomic_number'),
+                   ('ion_number', 'ion_number'), ('energy', 'e_{0}'),
+                   ('g', 'g_{0}'), ('label', 'label_{0}')]
+    key_codes = _factorize_keys([np.concatenate(
+        [levels_df[level_column].values,
+         gfall_df[line_column.format('lower')].values,
+         gfall_df[line_column.format('upper')].values])
+        for level_column, line_column in key_columns])
+
+    level_positions = -np.ones(key_codes.max() + 1 if len(key_codes) else 0,
+                               dtype=np.int64)
+    level_positions[key_codes[:n_levels]] = np.arange(n_levels)
+
+    line_positions = {
+        'lower':level_positions[key_codes[n_levels:n_levels + n_lines]],
+        'upper':level_positions[key_codes[n_levels + n_lines:]]}
+
+    for column in ('level_id', 'level_number'):
+        for level_type in ('lower', 'upper'):
+            positions = line_positions[level_type]
+            values = levels_df[column].values[positions]
+            values[positions == -1] = -1
+            lines['{0}_{1}'.format(column, level_type)] = values
 
-    level_upper_idx = gfall_df[['atomic_number', 'ion_number', 'e_upper',
-                                'g_upper', 'label_upper']].values.tolist()
-    level_upper_idx = [tuple(item) for item in level_upper_idx]
+    return lines
 
-    lines['level_id_lower'] = levels_df_idx.level_id.loc[level_lower_idx].values
-    lines['level_id_upper'] = levels_df_idx.level_id.loc[level_upper_idx].values
 
-    lines['level_number_lower'] = levels_df_idx.level_number.loc[
-        level_lower_idx].values
-    lines['level_number_upper'] = levels_df_idx.level_number.loc[
-        level_upper_idx].values
+gfall_db_insert_stmt = """
+INSERT INTO
+    gfall(%s)
+VALUES
+    (%s)"""
 
-    return lines
+
+def _gfall_raw_to_db_columns(gfall_raw):
+    """
+    Order the levels of a raw gfall dataframe into lower and upper and name
+    the columns as in the gfall table (see data/gfall.db3.schema). Energies
+    stay in 1/cm and wavelengths in nm.
+    """
+    gfall_db = OrderedDict()
+    gfall_db['wavelength'] = gfall_raw.wavelength.values
+    gfall_db['loggf'] = gfall_raw.loggf.values
+    atomic_number = gfall_raw.element_code.values.astype(np.int64)
+    gfall_db['atomic_number'] = atomic_number
+    gfall_db['ion_number'] = ((gfall_raw.element_code.values - atomic_number)
+                              * 100).round().astype(np.int64)
+
+    lower_upper = _order_lower_upper(gfall_raw)
+
+    e_lower, e_upper = lower_upper['e']
+    gfall_db['e_upper'] = np.abs(e_upper)
+    gfall_db['e_lower'] = np.abs(e_lower)
+    gfall_db['j_lower'], gfall_db['j_upper'] = lower_upper['j']
+    label_lower, label_upper = lower_upper['label']
+    gfall_db['label_upper'] = pd.Series(label_upper).str.strip().values
+    gfall_db['label_lower'] = pd.Series(label_lower).str.strip().values
+    gfall_db['log_gamma_rad'] = gfall_raw.log_gamma_rad.values
+    gfall_db['log_gamma_stark'] = gfall_raw.log_gamma_stark.values
+    gfall_db['log_gamma_vdw'] = gfall_raw.log_gamma_vderwaals.values
+    gfall_db['ref'] = gfall_raw.ref.values
+    (gfall_db['nlte_level_no_lower'],
+     gfall_db['nlte_level_no_upper']) = lower_upper['nlte_level_no']
+    gfall_db['isotope_number'] = gfall_raw.isotope.values
+    gfall_db['log_f_hyperfine'] = gfall_raw.log_f_hyperfine.values
+    gfall_db['isotope_number_2'] = gfall_raw.isotope2.values
+    gfall_db['log_isotope_fraction'] = gfall_raw.log_iso_abundance.values
+    (gfall_db['hyper_shift_lower'],
+     gfall_db['hyper_shift_upper']) = lower_upper['hyper_shift']
+    (gfall_db['hyperfine_f_lower'],
+     gfall_db['hyperfine_f_upper']) = lower_upper['hyperfine_f']
+    (gfall_db['hyperfine_f_lower_note'],
+     gfall_db['hyperfine_f_upper_note']) = lower_upper['hyperfine_note']
+    gfall_db['line_strength_class'] = gfall_raw.line_strength_class.values
+    gfall_db['line_code'] = gfall_raw.line_code.values
+    (gfall_db['lande_g_lower'],
+     gfall_db['lande_g_upper']) = lower_upper['lande_g']
+    gfall_db['isotope_shift'] = gfall_raw.isotopic_shift.values
+    gfall_db['predicted'] = ((gfall_raw.e_first.values < 0) |
+                             (gfall_raw.e_second.values < 0)).astype(np.int64)
+    return gfall_db
+
+
+def gfall_raw_2_db(gfall_raw, conn):
+    """
+    Insert raw gfall data into the gfall table of an sqlite database (the
+    table needs to exist - see data/gfall.db3.schema)
+
+    Parameters
+    ----------
+
+    gfall_raw: ~pandas.DataFrame or iterable of ~pandas.DataFrame
+        output of `read_gfall_raw` or chunks of it (e.g. from
+        `iter_gfall_raw`), which are inserted one at a time
+    conn: ~sqlite3.Connection
+
+    Returns
+    -------
+        : ~int
+            number of inserted lines
+    """
+
+    if isinstance(gfall_raw, pd.DataFrame):
+        gfall_raw = [gfall_raw]
+
+    no_lines = 0
+    for gfall_chunk in gfall_raw:
+        gfall_db = _gfall_raw_to_db_columns(gfall_chunk)
+        insert_stmt = gfall_db_insert_stmt % (
+            ', '.join(gfall_db.keys()), ', '.join('?' * len(gfall_db)))
+        conn.executemany(insert_stmt, zip(*[np.asarray(values).tolist()
+                                            for values in gfall_db.values()]))
+        no_lines += len(gfall_chunk)
+        print "inserted %d lines into gfall" % no_lines
+
+    return no_lines
 
 
 def ingest_gfall(levels, lines, atomic_db):
@@ -6,6 +6,8 @@ from scipy.integrate import quad
 
 from astropy import constants
 
+from tardisatomic import keys
+
 import ipdb
 
 class MacroAtomTransitions(object):
@@ -51,15 +53,60 @@ class MacroAtomTransitions(object):
 
 
     def get_absolute_energy(self):
-        t_levels = self.levels.reset_index()
-        t_ionization = self.ionization_data.reset_index()
-        data_merged = t_levels.merge(t_ionization,
-                                     on=['atomic_number', 'ion_number'],
-                                     how='left')
-        ionization_energy = data_merged['ionization_energy']
+        ionization_positions = keys.lookup(
+            keys.index_keys(self.ionization_data.index),
+            keys.pack(self.levels.index.get_level_values(0).values,
+                      self.levels.index.get_level_values(1).values))
+        ionization_energy = np.where(
+            ionization_positions >= 0,
+            self.ionization_data['ionization_energy'].values[
+                ionization_positions], 0.0)
         ionization_energy[np.isnan(ionization_energy)] = 0.0
-        energy_abs = ionization_energy + data_merged['energy']
-        return energy_abs.values
+        return ionization_energy + self.levels['energy'].values
+
+    def get_level_positions(self, level_keys):
+        """
+        Positions of the levels with the keys `level_keys` (see
+        `tardisatomic.keys`) in `levels` (-1 for levels that do not exist)
+        """
+        if self._levels_order is None:
+            all_level_keys = keys.index_keys(self.levels.index)
+            order = np.argsort(all_level_keys, kind='mergesort')
+            self._levels_order = order, all_level_keys[order]
+        order, sorted_level_keys = self._levels_order
+        positions = keys.lookup(sorted_level_keys, level_keys,
+                                assume_sorted=True)
+        return np.where(positions >= 0, order[positions], -1)
+
+    def get_lines_group(self, index, level_type):
+        """
+        Lines with the upper or lower level `index`
+
+        Parameters
+        ----------
+
+        index: tuple
+            (atomic_number, ion_number, level_number)
+        level_type: ~str
+            'upper' or 'lower'
+
+        Returns
+        -------
+            : ~pandas.DataFrame
+                lines in the order of `lines` (raises KeyError if there
+                are none, like `get_group`)
+        """
+        if level_type not in self._lines_groups:
+            self._lines_groups[level_type] = keys.group_offsets(keys.pack(
+                self.lines['atomic_number'].values,
+                self.lines['ion_number'].values,
+                self.lines['level_number_' + level_type].values))
+        line_positions, _ = keys.gather_groups(
+            self._lines_groups[level_type],
+            keys.pack(*[[item] for item in index]))
+        if len(line_positions) == 0:
+            raise KeyError(index)
+        return self.lines.iloc[line_positions]
 
     @property
     def levels(self):
@@ -72,6 +119,7 @@ class MacroAtomTransitions(object):
                              '"atom, ion, level"')
         else:
             self._levels = value
+            self._levels_order = None
 
     @property
     def lines(self):
@@ -83,6 +131,7 @@ class MacroAtomTransitions(object):
     @lines.setter
     def lines(self, value):
         self._lines = value.reset_index()
+        self._lines_groups = {}
 
 
     @property
@@ -94,16 +143,6 @@ class MacroAtomTransitions(object):
                                      'level_number_lower'])
 
 
-    @property
-    def lines_level_number_lower_gby(self):
-        """
-        Lines grouped by MultiIndex
-        """
-        return self.lines.groupby(['atomic_number', 'ion_number',
-                                          'level_number_lower'])
-
-
-
     @property
     def lines_level_number_upper(self):
         """
@@ -114,15 +153,6 @@ class MacroAtomTransitions(object):
                                      'level_number_upper'])
 
 
-    @property
-    def lines_level_number_upper_gby(self):
-        """
-        Lines grouped by MultiIndex
-        """
-        return self.lines.groupby(['atomic_number', 'ion_number',
-                                   'level_number_upper'])
-
-
     @property
     def ionization_data(self):
         return self._ionization
@@ -195,8 +225,11 @@ class BaseInternalBoundBoundTransition(MacroAtomTransitions):
 
         temp_transitions = pd.DataFrame(columns=
                                         self.macro_atom_transition_columns)
-        destination_level_energy = (
-            self.levels.energy.loc[destination_level_index].values)
+        destination_positions = self.get_level_positions(
+            keys.pack(*np.array(destination_level_index).T))
+        destination_level_energy = np.where(
+            destination_positions >= 0,
+            self.levels.energy.values[destination_positions], np.nan)
 
         p_coef = self._calculate_p_coeff(transitions_group.nu.values,
                                           transitions_group.f_ul.values,
@@ -230,7 +263,7 @@ class PEmissionDown(BaseInternalBoundBoundTransition):
         if self.levels.loc[index].metastable:
             return None, None
         else:
-            transition_group = self.lines_level_number_upper_gby.get_group(index)
+            transition_group = self.get_lines_group(index, 'upper')
             destination_levels = map(tuple, transition_group[
                 ['atomic_number', 'ion_number', 'level_number_lower']].values)
             return transition_group, destination_levels
@@ -252,7 +285,7 @@ class PInternalDown(BaseInternalBoundBoundTransition):
         if self.levels.loc[index].metastable:
             return None, None
         else:
-            transition_group = self.lines_level_number_upper_gby.get_group(index)
+            transition_group = self.get_lines_group(index, 'upper')
             destination_levels = map(tuple, transition_group[
                 ['atomic_number', 'ion_number', 'level_number_lower']].values)
             return transition_group, destination_levels
@@ -273,7 +306,7 @@ class PInternalUp(BaseInternalBoundBoundTransition):
         if self.levels.loc[index].metastable:
             return None
         else:
-            transition_group = self.lines_level_number_lower_gby.get_group(index)
+            transition_group = self.get_lines_group(index, 'lower')
             destination_levels = map(tuple, transition_group[
                 ['atomic_number', 'ion_number', 'level_number_upper']].values)
             return transition_group, destination_levels
@@ -1,9 +1,18 @@
 __author__ = 'wkerzend'
 
+# util.convert_air_to_vacuum for wavelengths above 2000 angstrom
+air_to_vacuum_stmt = """
+CASE WHEN 10*wavelength > 2000. THEN
+    10*wavelength * (1. + 5.792105e-2 / (238.0185 - %(sigma2)s)
+                        + 1.67917e-3 / (57.362 - %(sigma2)s))
+ELSE
+    10*wavelength
+END""" % {'sigma2': '(1e4 / (10*wavelength)) * (1e4 / (10*wavelength))'}
+
 linelist_select_stmt = """
 SELECT
-    convert_air2vacuum(10*wavelength),
-    loggf,
+    %(air_to_vacuum)s,
+    gfall.loggf,
     atomic_number,
     ion_number,
     e_upper * %(hc).20f,
@@ -12,9 +21,13 @@ SELECT
     e_lower * %(hc).20f,
     cast(2*j_lower + 1 AS integer) AS g_lower,
     label_lower,
+    %(gf)s / cast(2*j_upper + 1 AS integer),
+    %(gf)s / cast(2*j_lower + 1 AS integer),
     "kurucz"
 FROM
-    gfall
+    %(from_stmt)s
+%(where_stmt)s
+ORDER BY gfall.id
 """
 
 
@@ -30,6 +43,8 @@ insert into
         e_lower,
         g_lower,
         label_lower,
+        f_ul,
+        f_lu,
         source)"""
 
 
@@ -55,11 +70,3 @@ CREATE TABLE
     f_lu float,
     source text)
     """
-
-update_oscillator_stmt = """
-UPDATE
-    lines
-SET
-    f_ul = pow(10, loggf) / g_upper,
-    f_lu = pow(10, loggf) / g_lower
-"""
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+Storage of numpy arrays in the int_ndarray and float_ndarray columns of the
+atom database (e.g. macro_atom.reference_down or zeta.zeta)
+
+Importing this module registers an adapter for numpy arrays and converters
+for both column types. The converters are only used by connections that are
+opened with detect_types=sqlite3.PARSE_DECLTYPES (see `connect`).
+"""
+
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+ndarray_dtypes = OrderedDict([('int_ndarray', np.dtype(np.int64)),
+                              ('float_ndarray', np.dtype(np.float64))])
+
+
+def adapt_ndarray(array):
+    """
+    Store integer arrays as int64 and float arrays as float64 blobs
+    """
+    if array.dtype.kind in 'biu':
+        dtype = ndarray_dtypes['int_ndarray']
+    elif array.dtype.kind == 'f':
+        dtype = ndarray_dtypes['float_ndarray']
+    else:
+        raise TypeError('Can not store arrays of dtype {0} in the '
+                        'database'.format(array.dtype))
+    return sqlite3.Binary(np.ascontiguousarray(array, dtype=dtype).tobytes())
+
+
+def _frombuffer(blob, dtype):
+    if len(blob) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(blob, dtype=dtype)
+
+
+def convert_int_ndarray(blob):
+    """
+    Read-only int64 array on the blob (no copy)
+    """
+    return _frombuffer(blob, ndarray_dtypes['int_ndarray'])
+
+
+def convert_float_ndarray(blob):
+    """
+    Read-only float64 array on the blob (no copy)
+    """
+    return _frombuffer(blob, ndarray_dtypes['float_ndarray'])
+
+
+sqlite3.register_adapter(np.ndarray, adapt_ndarray)
+sqlite3.register_converter('int_ndarray', convert_int_ndarray)
+sqlite3.register_converter('float_ndarray', convert_float_ndarray)
+
+
+def connect(dbname, **kwargs):
+    """
+    `sqlite3.connect` that decodes the ndarray columns
+    """
+    kwargs.setdefault('detect_types', sqlite3.PARSE_DECLTYPES)
+    return sqlite3.connect(dbname, **kwargs)
+
+
+def read_ragged(conn, table, columns, key='id', where_stmt=''):
+    """
+    Read ndarray columns of all rows of a table at once as ragged arrays
+
+    The blobs of each column are concatenated and decoded with a single
+    `np.frombuffer`; the values of row i are values[offsets[i]:offsets[i+1]].
+    NULL is read as an empty array.
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    table: ~str
+    columns: list
+        names of int_ndarray or float_ndarray columns
+    key: ~str
+        integer column that is returned with the arrays and by which the rows
+        are ordered (default='id')
+    where_stmt: ~str
+        optional WHERE clause selecting the rows
+
+    Returns
+    -------
+        : ~numpy.ndarray
+            key of every row
+        : OrderedDict
+            (offsets, values) for every column
+    """
+    column_types = dict((name, column_type.lower()) for _, name, column_type,
+                        _, _, _ in conn.execute(
+                            'PRAGMA table_info({0})'.format(table)))
+    # expressions have no declared type, so the converters are not applied
+    rows = conn.execute('SELECT {0} FROM {1} {2} ORDER BY {3}'.format(
+        ', '.join([key] + ["CAST(ifnull({0}, x'') AS BLOB)".format(column)
+                           for column in columns]),
+        table, where_stmt, key)).fetchall()
+    row_columns = zip(*rows) if rows else [()] * (len(columns) + 1)
+
+    ragged = OrderedDict()
+    for column, blobs in zip(columns, row_columns[1:]):
+        dtype = ndarray_dtypes[column_types[column]]
+        offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, blobs), dtype=np.int64,
+                              count=len(blobs)) // dtype.itemsize,
+                  out=offsets[1:])
+        ragged[column] = (offsets,
+                          _frombuffer(b''.join(map(bytes, blobs)), dtype))
+    return np.array(row_columns[0], dtype=np.int64), ragged
+
+
+def read_structured(conn, select_stmt, dtype, parameters=(), size=None,
+                    chunksize=10000):
+    """
+    Read the result of a query into a structured array
+
+    The rows are fetched `chunksize` at a time into an array that is allocated
+    for the number of rows of the query, so the result is never held as a
+    list of tuples in addition to the array. The array grows by doubling if
+    the query returns more rows than expected.
+
+    Parameters
+    ----------
+
+    conn: ~sqlite3.Connection
+    select_stmt: ~str
+    dtype: ~numpy.dtype
+        dtype with one field per column of the query
+    parameters: tuple
+        parameters of the query (default=())
+    size: ~int
+        expected number of rows (default=None counts the rows of the query)
+    chunksize: ~int
+        number of rows fetched at a time (default=10000)
+
+    Returns
+    -------
+        : ~numpy.ndarray
+    """
+    dtype = np.dtype(dtype)
+    if size is None:
+        size = conn.execute('SELECT count(*) FROM ({0})'.format(select_stmt),
+                            parameters).fetchone()[0]
+    data = np.empty(size, dtype=dtype)
+
+    cursor = conn.execute(select_stmt, parameters)
+    n_rows = 0
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            break
+        if n_rows + len(rows) > len(data):
+            grown_data = np.empty(max(2 * len(data), n_rows + len(rows)),
+                                  dtype=dtype)
+            grown_data[:n_rows] = data[:n_rows]
+            data = grown_data
+        data[n_rows:n_rows + len(rows)] = rows
+        n_rows += len(rows)
+
+    if n_rows < len(data):
+        data = data[:n_rows].copy()
+    return data
@@ -0,0 +1,80 @@
+import os
+import sqlite3
+
+import pytest
+
+import numpy as np
+import numpy.testing as nptesting
+
+import tardisatomic
+from tardisatomic.kurucz.io.gfall import read_gfall_raw, gfall_raw_2_db
+
+gfall_line_format = ('%11.4f%7.3f%6.2f%12.3f%5.2f %-10s%12.3f%5.2f %-10s'
+                     '%6.2f%6.2f%6.2f%-4s%2d%2d%3d%6.3f%3d%6.3f%5d%5d '
+                     '%1d%1s %1d%1s%1d%-3s%5d%5d%6d')
+
+
+def make_gfall_line(wavelength, loggf, element_code, e_first, j_first,
+                    label_first, e_second, j_second, label_second):
+    return gfall_line_format % (wavelength, loggf, element_code, e_first,
+                                j_first, label_first, e_second, j_second,
+                                label_second, 7.92, -5.55, -7.1, 'K88', 0,
+                                0, 0, 0., 0, 0., 0, 0, 0, ' ', 0, ' ', 0,
+                                'AT', 1100, 1200, 0)
+
+
+gfall_test_lines = [
+    (72.5537, -0.527, 26.01, 0.0, 4.5, '3d6 4s a6D', 13783.5, 3.5,
+     '3d64p z6F'),
+    (1641.1234, -8.29, 14.00, 6298.850, 1.0, '3s23p2 3P', -77.115, 0.0,
+     '3s23p2 3P'),
+    (299.7925, -4.385, 26.01, -2430.1, 2.5, 'x  a4F', 384.790, 3.5,
+     '3d6 4s a6D'),
+    (300.0001, 0.0, 1.00, 82259.158, 0.5, '2p 2P', 0.0, 0.5, '1s 2S')]
+
+
+@pytest.fixture
+def gfall_fname(tmpdir):
+    gfall_fname = tmpdir.join('gfall.dat')
+    gfall_lines = ['header', 'header'] + [make_gfall_line(*line)
+                                          for line in gfall_test_lines]
+    gfall_fname.write('\n'.join(gfall_lines) + '\n')
+    return str(gfall_fname)
+
+
+def assert_frames_equal(frame1, frame2):
+    assert list(frame1.columns) == list(frame2.columns)
+    for column in frame1.columns:
+        if frame1[column].dtype.kind == 'f':
+            nptesting.assert_array_equal(frame1[column].values,
+                                         frame2[column].values)
+            assert np.all(np.signbit(frame1[column].values) ==
+                          np.signbit(frame2[column].values))
+        else:
+            assert np.all(frame1[column].values == frame2[column].values)
+
+
+gfall_schema_path = os.path.join(os.path.dirname(tardisatomic.__file__),
+                                 'data', 'gfall.db3.schema')
+
+
+@pytest.fixture
+def kurucz_dbname(tmpdir, gfall_fname):
+    kurucz_dbname = str(tmpdir.join('kurucz.db3'))
+    conn = sqlite3.connect(kurucz_dbname)
+    conn.executescript(open(gfall_schema_path).read())
+    gfall_raw_2_db(read_gfall_raw(gfall_fname), conn)
+    conn.commit()
+    conn.close()
+    return kurucz_dbname
+
+
+@pytest.fixture
+def linked_conn(kurucz_dbname):
+    # imported here as construct_atom_db needs h5py (through import_ionDB)
+    # which the gfall tests do not
+    from tardisatomic import construct_atom_db
+
+    conn = construct_atom_db.new_linelist_from_gfall(kurucz_dbname)
+    conn = construct_atom_db.create_levels(conn)
+    return construct_atom_db.link_levels(conn)
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tardisatomic import basic_io
+
+
+@pytest.fixture
+def levels_lines():
+    rs = np.random.RandomState(1)
+    levels = pd.DataFrame({'atomic_number': np.repeat([1, 2, 26], 20),
+                           'ion_number': np.tile(np.repeat([0, 1], 10), 3),
+                           'level_number': np.tile(np.arange(10), 6),
+                           'energy': rs.uniform(0, 10, 60)})
+    levels.set_index(['atomic_number', 'ion_number', 'level_number'],
+                     inplace=True)
+
+    n_lines = 80
+    species = rs.randint(0, 6, n_lines)
+    lines = pd.DataFrame({'line_id': np.arange(n_lines) + 1,
+                          'atomic_number': np.array([1, 2, 26])[species // 2],
+                          'ion_number': species % 2,
+                          'level_number_lower': rs.randint(-1, 6, n_lines),
+                          'level_number_upper': rs.randint(6, 12, n_lines)})
+    return levels, lines
+
+
+def test_auto_ionizing_lines_mask(levels_lines):
+    levels, lines = levels_lines
+    auto_ionizing_levels = levels[levels.energy > 5]
+
+    # reference: look up the lines of every auto-ionizing level
+    upper = lines.groupby(['atomic_number', 'ion_number',
+                           'level_number_upper'])
+    lower = lines.groupby(['atomic_number', 'ion_number',
+                           'level_number_lower'])
+    line_ids = []
+    unreferenced = []
+    for index in auto_ionizing_levels.index:
+        in_lines = False
+        for groups in (upper, lower):
+            try:
+                line_ids += groups.get_group(index).line_id.tolist()
+            except KeyError:
+                pass
+            else:
+                in_lines = True
+        if not in_lines:
+            unreferenced.append(index)
+
+    mask = basic_io.auto_ionizing_lines_mask(lines, auto_ionizing_levels)
+    assert 0 < mask.sum() < len(lines)
+    assert sorted(lines.line_id[mask]) == sorted(set(line_ids))
+    assert (basic_io.levels_without_lines(auto_ionizing_levels,
+                                          lines).tolist() == unreferenced)
+
+
+def test_orphan_levels_mask(levels_lines):
+    levels, lines = levels_lines
+    levels['source'] = 'kurucz'
+    levels.loc[(26, 1, 9), 'source'] = 'tardis_artificial_missing_ion'
+    levels.loc[(1, 1, 8), 'source'] = 'kurucz'
+    lines = lines[lines.level_number_upper != 9]
+
+    upper = lines.groupby(['atomic_number', 'ion_number',
+                           'level_number_upper'])
+    lower = lines.groupby(['atomic_number', 'ion_number',
+                           'level_number_lower'])
+    existing_levels = []
+    for index, source in zip(levels.index, levels.source):
+        if (index in upper.groups or index in lower.groups or
+                index[0] == index[1] or source.startswith('tardis_artificial')):
+            existing_levels.append(index)
+
+    orphan_levels = basic_io.orphan_levels_mask(levels, lines)
+    assert orphan_levels.dtype == bool
+    assert 0 < orphan_levels.sum() < len(levels)
+    assert levels.index[~orphan_levels].tolist() == existing_levels
+    assert not orphan_levels[levels.index.get_loc((26, 1, 9))]
+    assert not orphan_levels[levels.index.get_loc((1, 1, 8))]
+
+
+def test_renumber_levels(levels_lines):
+    levels, lines = levels_lines
+    levels = levels[levels.energy < 7]
+
+    # reference: number the levels of every ion in a loop
+    levels_prev_index = pd.Series(np.nan, index=levels.index.copy())
+    for atomic_number, ion_number in set(zip(
+            levels.index.get_level_values(0), levels.index.get_level_values(1))):
+        ion_mask = ((levels.index.get_level_values(0) == atomic_number) &
+                    (levels.index.get_level_values(1) == ion_number))
+        levels_prev_index[ion_mask] = np.arange(ion_mask.sum())
+
+    level_numbers, level_number_map = basic_io.renumber_levels(levels)
+    np.testing.assert_array_equal(level_numbers, levels_prev_index.values)
+
+    for level_type in ('lower', 'upper'):
+        line_levels = pd.MultiIndex.from_arrays(
+            [lines.atomic_number, lines.ion_number,
+             lines['level_number_' + level_type]])
+        expected = levels_prev_index.reindex(line_levels).values
+        assert np.isnan(expected).any()
+        np.testing.assert_array_equal(
+            basic_io.remap_level_numbers(
+                level_number_map, basic_io.line_level_keys(lines, level_type)),
+            expected)
+
+    _, empty_map = basic_io.renumber_levels(levels.iloc[:0])
+    assert np.isnan(basic_io.remap_level_numbers(
+        empty_map, basic_io.line_level_keys(lines, 'upper'))).all()
+
+
+def test_metastable_levels_mask(levels_lines):
+    levels, lines = levels_lines
+    lines = lines[lines.line_id % 3 == 0]
+
+    count_down = lines.groupby(['atomic_number', 'ion_number',
+                                'level_number_upper'])['line_id'].count()
+    metastable = pd.isnull(pd.Series(count_down == 0).reindex(levels.index))
+    mask = basic_io.metastable_levels_mask(levels, lines)
+    assert 0 < mask.sum() < len(levels)
+    np.testing.assert_array_equal(mask, metastable.values)
+
+
+def test_levels_ionization_energy(levels_lines):
+    levels, _ = levels_lines
+    ionization_data = pd.DataFrame({'atomic_number': [1, 2, 2, 26],
+                                    'ion_number': [1, 1, 2, 1],
+                                    'ionization_energy': [13.6, 24.6, 54.4,
+                                                          7.9]})
+    ionization_data.set_index(['atomic_number', 'ion_number'], inplace=True)
+
+    expected = [ionization_data.ionization_energy.get((atomic_number,
+                                                       ion_number + 1), np.nan)
+                for atomic_number, ion_number, _ in levels.index]
+    np.testing.assert_array_equal(
+        basic_io.levels_ionization_energy(levels, ionization_data), expected)
@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from tardisatomic.kurucz.io.gfall import read_gfall_raw, parse_gfall
+from tardisatomic.kurucz.io.cache import GFallCache
+from tardisatomic.tests.conftest import (gfall_test_lines, make_gfall_line,
+                                         assert_frames_equal)
+
+
+def test_gfall_cache_hit(gfall_fname, tmpdir):
+    cache = GFallCache(str(tmpdir.join('cache')))
+    gfall = cache.read_gfall_raw(gfall_fname)
+    assert len(cache.entries()) == 1
+
+    gfall_cached = cache.read_gfall_raw(gfall_fname)
+    assert len(cache.entries()) == 1
+    assert_frames_equal(gfall_cached, read_gfall_raw(gfall_fname))
+    assert_frames_equal(gfall_cached, gfall)
+
+
+def memmap_backed(values):
+    while isinstance(values, np.ndarray):
+        if isinstance(values, np.memmap):
+            return True
+        values = values.base
+    return False
+
+
+def test_gfall_cache_hit_memmapped(gfall_fname, tmpdir):
+    cache = GFallCache(str(tmpdir.join('cache')))
+    gfall = cache.read_gfall_raw(gfall_fname)
+    assert not any(memmap_backed(gfall[column].values)
+                   for column in gfall.columns)
+
+    gfall_cached = cache.read_gfall_raw(gfall_fname)
+    numeric_columns = [column for column in gfall_cached.columns
+                       if gfall_cached[column].dtype != object]
+    assert len(numeric_columns) > 1
+    for column in numeric_columns:
+        assert memmap_backed(gfall_cached[column].values)
+
+    # copy-on-write - the cache entry is not modified
+    gfall_cached[numeric_columns[0]] *= 2
+    assert_frames_equal(cache.read_gfall_raw(gfall_fname), gfall)
+
+
+def test_gfall_cache_parsed(gfall_fname, tmpdir):
+    cache = GFallCache(str(tmpdir.join('cache')))
+    gfall = parse_gfall(read_gfall_raw(gfall_fname))
+    cache.parse_gfall(gfall_fname)
+    # the raw table is cached as well
+    assert len(cache.entries()) == 2
+    assert_frames_equal(cache.parse_gfall(gfall_fname), gfall)
+
+    columns = ['wavelength', 'label_lower']
+    gfall_projected = cache.parse_gfall(gfall_fname, columns=columns)
+    assert list(gfall_projected.columns) == columns
+    assert_frames_equal(gfall_projected, gfall[columns])
+
+
+def test_gfall_cache_stale(gfall_fname, tmpdir):
+    cache = GFallCache(str(tmpdir.join('cache')))
+    cache.read_gfall_raw(gfall_fname)
+    old_hash = cache.entries()[0]['file_hash']
+
+    with open(gfall_fname, 'a') as fh:
+        fh.write(make_gfall_line(*gfall_test_lines[0]) + '\n')
+
+    gfall = cache.read_gfall_raw(gfall_fname)
+    assert len(gfall) == len(gfall_test_lines) + 1
+    entries = cache.entries()
+    assert len(entries) == 1
+    assert entries[0]['file_hash'] != old_hash
+
+
+def test_gfall_cache_evict(gfall_fname, tmpdir):
+    cache = GFallCache(str(tmpdir.join('cache')), max_size=0)
+    cache.read_gfall_raw(gfall_fname)
+    assert cache.entries() == []
+    assert os.listdir(cache.cache_dir) == [cache.hash_index_fname]
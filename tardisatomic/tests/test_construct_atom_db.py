@@ -0,0 +1,366 @@
+import os
+import math
+import functools
+import sqlite3
+
+import numpy as np
+import pytest
+
+from tardisatomic import construct_atom_db, util
+from tardisatomic.kurucz.io.gfall import (read_gfall_raw, parse_gfall,
+                                          extract_levels, extract_lines)
+from tardisatomic.tests.conftest import gfall_test_lines
+
+
+@pytest.mark.parametrize('math_functions', [True, False])
+def test_new_linelist_from_gfall(kurucz_dbname, monkeypatch, math_functions):
+    monkeypatch.setattr(construct_atom_db, 'sqlite_math_functions_available',
+                        lambda conn: math_functions)
+    conn = construct_atom_db.new_linelist_from_gfall(kurucz_dbname)
+    lines = np.array(conn.execute(
+        'SELECT wavelength, g_upper, g_lower, f_ul, f_lu FROM lines '
+        'ORDER BY id').fetchall())
+    gfall = np.array(conn.execute(
+        'SELECT wavelength, loggf, j_upper, j_lower FROM gfall '
+        'ORDER BY id').fetchall())
+    assert len(lines) == len(gfall_test_lines)
+
+    wavelength = [util.convert_air_to_vacuum(10 * wavelength)
+                  if 10 * wavelength > 2000. else 10 * wavelength
+                  for wavelength in gfall[:, 0]]
+    np.testing.assert_array_equal(lines[:, 0], wavelength)
+    np.testing.assert_array_equal(lines[:, 1], 2 * gfall[:, 2] + 1)
+    np.testing.assert_array_equal(lines[:, 2], 2 * gfall[:, 3] + 1)
+    gf = np.array([math.pow(10, loggf) for loggf in gfall[:, 1]])
+    np.testing.assert_allclose(lines[:, 3], gf / lines[:, 1], rtol=1e-14)
+    np.testing.assert_allclose(lines[:, 4], gf / lines[:, 2], rtol=1e-14)
+
+    selected_conn = construct_atom_db.new_linelist_from_gfall(
+        kurucz_dbname, select_atom=[26])
+    assert selected_conn.execute(
+        'SELECT DISTINCT atom FROM lines').fetchall() == [(26,)]
+
+
+@pytest.mark.parametrize('update_from', [True, False])
+def test_link_levels(kurucz_dbname, gfall_fname, monkeypatch, update_from):
+    if update_from and sqlite3.sqlite_version_info < (3, 33, 0):
+        pytest.skip('UPDATE FROM is not available')
+    monkeypatch.setattr(construct_atom_db, 'sqlite_update_from_available',
+                        update_from)
+    linked_conn = construct_atom_db.link_levels(
+        construct_atom_db.create_levels(
+            construct_atom_db.new_linelist_from_gfall(kurucz_dbname)))
+    gfall = parse_gfall(read_gfall_raw(gfall_fname))
+    lines = extract_lines(gfall, extract_levels(gfall))
+
+    db_lines = linked_conn.execute(
+        'SELECT level_id_lower, level_id_upper FROM lines '
+        'ORDER BY id').fetchall()
+    assert len(db_lines) == len(gfall_test_lines)
+    assert db_lines == zip(lines.level_number_lower.tolist(),
+                           lines.level_number_upper.tolist())
+
+    for atom, ion, level_id, global_level_id in linked_conn.execute(
+            'SELECT atom, ion, level_id_upper, global_level_id_upper '
+            'FROM lines'):
+        assert linked_conn.execute(
+            'SELECT atom, ion, level_id FROM levels WHERE id=?',
+            (global_level_id,)).fetchone() == (atom, ion, level_id)
+
+
+def test_create_levels_fallback(kurucz_dbname, monkeypatch):
+    levels_select = 'SELECT * FROM levels ORDER BY id'
+    conn = construct_atom_db.new_linelist_from_gfall(kurucz_dbname)
+    construct_atom_db.create_levels(conn)
+    levels = conn.execute(levels_select).fetchall()
+
+    monkeypatch.setattr(construct_atom_db,
+                        'sqlite_window_functions_available', False)
+    construct_atom_db.create_levels(conn)
+    assert conn.execute(levels_select).fetchall() == levels
+
+    level_ids = {}
+    for _, atom, ion, _, _, _, level_id, _, _ in levels:
+        level_ids.setdefault((atom, ion), []).append(level_id)
+    for ion_level_ids in level_ids.values():
+        assert ion_level_ids == range(len(ion_level_ids))
+
+
+def test_build_kurucz_db(kurucz_dbname, tmpdir):
+    safe_dbname = str(tmpdir.join('kurucz_safe.db3'))
+    with open(kurucz_dbname, 'rb') as fh:
+        open(safe_dbname, 'wb').write(fh.read())
+
+    conn = sqlite3.connect(kurucz_dbname)
+    pragmas = [conn.execute('PRAGMA {0}'.format(name)).fetchone()
+               for name in construct_atom_db.build_profiles['bulk']]
+    construct_atom_db.build_kurucz_db(conn, profile='bulk')
+    assert [conn.execute('PRAGMA {0}'.format(name)).fetchone()
+            for name in construct_atom_db.build_profiles['bulk']] == pragmas
+    assert conn.execute('SELECT count(*) FROM sqlite_stat1').fetchone()[0] > 0
+
+    safe_conn = construct_atom_db.build_kurucz_db(
+        sqlite3.connect(safe_dbname))
+    for table in ('lines', 'levels', 'ion_cx'):
+        select_stmt = 'SELECT * FROM {0} ORDER BY id'.format(table)
+        assert (conn.execute(select_stmt).fetchall() ==
+                safe_conn.execute(select_stmt).fetchall())
+
+
+@pytest.mark.parametrize('atoms_per_shard', [1, 2])
+def test_build_kurucz_db_sharded(kurucz_dbname, tmpdir, atoms_per_shard):
+    serial_dbname = str(tmpdir.join('kurucz_serial.db3'))
+    with open(kurucz_dbname, 'rb') as fh:
+        open(serial_dbname, 'wb').write(fh.read())
+
+    shard_dir = str(tmpdir.mkdir('shards'))
+    conn = construct_atom_db.build_kurucz_db(
+        sqlite3.connect(kurucz_dbname), n_jobs=2,
+        atoms_per_shard=atoms_per_shard, shard_dir=shard_dir)
+    assert os.listdir(shard_dir) == []
+    assert len(construct_atom_db.shard_atoms(conn, atoms_per_shard)) > 1
+
+    serial_conn = construct_atom_db.build_kurucz_db(
+        sqlite3.connect(serial_dbname))
+    for table in ('lines', 'levels', 'ion_cx'):
+        select_stmt = 'SELECT * FROM {0} ORDER BY id'.format(table)
+        assert (conn.execute(select_stmt).fetchall() ==
+                serial_conn.execute(select_stmt).fetchall())
+
+    with pytest.raises(ValueError):
+        construct_atom_db.build_sharded_levels(sqlite3.connect(':memory:'))
+
+
+def test_build_stage_rollback(kurucz_dbname):
+    conn = sqlite3.connect(kurucz_dbname)
+    with pytest.raises(ValueError):
+        with construct_atom_db.build_stage(conn, 'failing'):
+            construct_atom_db.create_gf_table(conn)
+            conn.execute('CREATE TABLE lines(id integer primary key)')
+            raise ValueError
+    assert conn.execute("SELECT count(*) FROM sqlite_master "
+                        "WHERE name='lines'").fetchone()[0] == 0
+
+
+@pytest.mark.parametrize('failing_stage', [
+    name for name, _ in construct_atom_db.kurucz_build_stages] + [
+    'sharded_levels'])
+def test_build_stage_rollback_after_stage(kurucz_dbname, tmpdir,
+                                          failing_stage):
+    stages = list(construct_atom_db.kurucz_build_stages)
+    if failing_stage == 'sharded_levels':
+        stages = [(failing_stage,
+                   functools.partial(construct_atom_db.insert_sharded_levels,
+                                     commit=False),
+                   functools.partial(construct_atom_db.sharded_levels_database,
+                                     n_jobs=2, shard_dir=str(tmpdir)))]
+    names = [stage[0] for stage in stages]
+    conn = sqlite3.connect(kurucz_dbname)
+    construct_atom_db.run_build_stages(
+        conn, stages[:names.index(failing_stage)])
+    database = list(conn.iterdump())
+
+    stage = stages[names.index(failing_stage)]
+
+    def failing(conn):
+        stage[1](conn)
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        construct_atom_db.run_build_stages(
+            conn, [(failing_stage, failing) + tuple(stage[2:])])
+    assert list(conn.iterdump()) == database
+    assert [name for _, name, _ in conn.execute('PRAGMA database_list')
+            if name not in ('main', 'temp')] == []
+
+
+@pytest.mark.parametrize('method', ['vacuum', 'dump'])
+def test_copy_database(kurucz_dbname, tmpdir, method, capsys):
+    if method == 'vacuum' and sqlite3.sqlite_version_info < (3, 27, 0):
+        pytest.skip('VACUUM INTO is not available')
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('\n'.join(sqlite3.connect(kurucz_dbname).iterdump()))
+    construct_atom_db.build_kurucz_db(conn)
+    capsys.readouterr()
+
+    dbname = str(tmpdir.join('kurucz_copy.db3'))
+    construct_atom_db.copy_database(conn, dbname, method=method, pages=1,
+                                    rows=10)
+    assert os.listdir(str(tmpdir)).count('kurucz_copy.db3.partial') == 0
+
+    progress = [line.split() for line in capsys.readouterr()[0].splitlines()
+                if line.startswith('copied') and ' of ' in line]
+    if method == 'vacuum':
+        total = (conn.execute('PRAGMA page_count').fetchone()[0] -
+                 conn.execute('PRAGMA freelist_count').fetchone()[0])
+        assert progress[-1] == ['copied', str(total), 'of', str(total),
+                                'pages']
+    else:
+        total = construct_atom_db._count_dump_rows(conn)
+        assert len(progress) == (total + 9) // 10
+        assert progress[0] == ['copied', '10', 'of', str(total), 'rows']
+        assert progress[-1] == ['copied', str(total), 'of', str(total),
+                                'rows']
+
+    copy_conn = sqlite3.connect(dbname)
+    for table in ('gfall', 'lines', 'levels', 'ion_cx'):
+        select_stmt = 'SELECT * FROM {0} ORDER BY id'.format(table)
+        assert (copy_conn.execute(select_stmt).fetchall() ==
+                conn.execute(select_stmt).fetchall())
+
+
+def test_create_macro_atom(linked_conn):
+    conn = construct_atom_db.create_macro_atom(linked_conn)
+    lines = conn.execute('SELECT id, wavelength, e_upper, e_lower, f_ul, f_lu, '
+                         'global_level_id_upper, global_level_id_lower '
+                         'FROM lines ORDER BY id').fetchall()
+    c = construct_atom_db.constants.c.cgs.value
+    h = construct_atom_db.constants.h.cgs.value
+
+    macro_atom = conn.execute('SELECT * FROM macro_atom ORDER BY id').fetchall()
+    assert ([row[0] for row in macro_atom] ==
+            sorted(set(line[6] for line in lines) |
+                   set(line[7] for line in lines)))
+
+    for (level_id, count_down, count_up, reference_down, reference_up,
+         line_id_down, line_id_up, p_internal_down, p_emission_down,
+         p_internal_up) in macro_atom:
+        down_lines = [line for line in lines if line[6] == level_id]
+        up_lines = [line for line in lines if line[7] == level_id]
+        assert count_down == len(down_lines)
+        assert count_up == len(up_lines)
+        assert (np.frombuffer(reference_down, dtype=np.int64).tolist() ==
+                [line[7] for line in down_lines])
+        assert (np.frombuffer(reference_up, dtype=np.int64).tolist() ==
+                [line[6] for line in up_lines])
+        assert (np.frombuffer(line_id_down, dtype=np.int64).tolist() ==
+                [line[0] for line in down_lines])
+        assert (np.frombuffer(line_id_up, dtype=np.int64).tolist() ==
+                [line[0] for line in up_lines])
+
+        p_down = [2 * (c / (line[1] * 1e-8))**2 * line[4] / c**2
+                  for line in down_lines]
+        np.testing.assert_allclose(
+            np.frombuffer(p_emission_down, dtype=np.float64),
+            [p * (line[2] - line[3]) for p, line in zip(p_down, down_lines)])
+        np.testing.assert_allclose(
+            np.frombuffer(p_internal_down, dtype=np.float64),
+            [p * line[3] for p, line in zip(p_down, down_lines)])
+        np.testing.assert_allclose(
+            np.frombuffer(p_internal_up, dtype=np.float64),
+            [line[5] * line[3] / (h * c / (line[1] * 1e-8))
+             for line in up_lines])
+
+
+def test_add_artificial_ionized_levels(kurucz_dbname, tmpdir):
+    def add_levels_per_ion(conn):
+        # one query per ion of the NIST data
+        conn.execute('DELETE FROM levels WHERE atom == ion')
+        ionization_data = construct_atom_db.fileio.read_nist_ionization_data(
+            full_information=True)
+        for atom, ion, g in zip(ionization_data['atomic_number'],
+                                ionization_data['ion_number'] - 1,
+                                ionization_data['ground_level_g']):
+            if ion + 1 == atom:
+                conn.execute('INSERT INTO levels(atom, ion, energy, g, '
+                             'metastable, level_id, source) VALUES '
+                             '(?, ?, 0.0, 1.0, 1, 0, ?)',
+                             (int(atom), int(atom),
+                              'tardis_artificial_fully_ionized'))
+            if conn.execute('SELECT count(atom) FROM levels '
+                            'WHERE atom=? AND ion=?',
+                            (int(atom), int(ion))).fetchone()[0] == 0:
+                conn.execute('INSERT INTO levels(atom, ion, energy, g, '
+                             'metastable, level_id, source) VALUES '
+                             '(?, ?, 0.0, ?, 1, 0, ?)',
+                             (int(atom), int(ion), float(g),
+                              'tardis_artificial_missing_ion'))
+
+    reference_dbname = str(tmpdir.join('kurucz_reference.db3'))
+    with open(kurucz_dbname, 'rb') as fh:
+        open(reference_dbname, 'wb').write(fh.read())
+
+    levels_select = 'SELECT * FROM levels ORDER BY id'
+    conn = construct_atom_db.create_levels(
+        construct_atom_db.new_linelist_from_gfall(kurucz_dbname))
+    construct_atom_db.add_artificial_ionized_levels(conn)
+    # fully ionized levels are replaced when the stage is run again
+    construct_atom_db.add_artificial_ionized_levels(conn)
+
+    reference_conn = construct_atom_db.create_levels(
+        construct_atom_db.new_linelist_from_gfall(reference_dbname))
+    add_levels_per_ion(reference_conn)
+    add_levels_per_ion(reference_conn)
+    assert (conn.execute(levels_select).fetchall() ==
+            reference_conn.execute(levels_select).fetchall())
+    assert conn.execute("SELECT count(*) FROM levels WHERE source = "
+                        "'tardis_artificial_missing_ion'").fetchone()[0] > 0
+
+
+@pytest.mark.parametrize('update_from', [True, False])
+def test_flag_metastable(linked_conn, monkeypatch, update_from):
+    if update_from and sqlite3.sqlite_version_info < (3, 33, 0):
+        pytest.skip('UPDATE FROM is not available')
+    monkeypatch.setattr(construct_atom_db, 'sqlite_update_from_available',
+                        update_from)
+    conn = construct_atom_db.create_macro_atom(linked_conn)
+    conn.execute("INSERT INTO levels(atom, ion, energy, g, metastable, "
+                 "level_id, source) VALUES (1, 1, 0.0, 1, 1, 0, 'test')")
+    construct_atom_db.flag_metastable(conn)
+
+    count_down = dict(conn.execute('SELECT id, count_down FROM macro_atom'))
+    for level_id, metastable in conn.execute(
+            'SELECT id, metastable FROM levels'):
+        if level_id in count_down:
+            assert metastable == (count_down[level_id] == 0)
+        else:
+            assert metastable is None
+    assert 0 in count_down.values()
+
+
+def test_build_kurucz_db_resume(gfall_fname, tmpdir, monkeypatch):
+    build_stages = construct_atom_db.kurucz_build_stages
+    run_stages = []
+
+    def record_stage(name, stage):
+        def recorded_stage(conn):
+            run_stages.append(name)
+            return stage(conn)
+        return recorded_stage
+
+    def failing_stage(conn):
+        raise ValueError
+
+    def build(conn, fingerprint, fail=None):
+        monkeypatch.setattr(construct_atom_db, 'kurucz_build_stages',
+                            [(name, failing_stage if name == fail
+                              else record_stage(name, stage))
+                             for name, stage in build_stages])
+        del run_stages[:]
+        return construct_atom_db.build_kurucz_db(
+            conn, read_gfall=lambda: read_gfall_raw(gfall_fname),
+            fingerprint=fingerprint, resume=True)
+
+    conn = sqlite3.connect(str(tmpdir.join('kurucz_resume.db3')))
+    with pytest.raises(ValueError):
+        build(conn, 'gfall-1', fail='ion_xs')
+    assert run_stages == ['linelist', 'levels', 'link_levels']
+    assert sorted(stage for stage, in conn.execute(
+        'SELECT stage FROM build_metadata')) == ['gfall', 'levels',
+                                                 'linelist', 'link_levels']
+
+    build(conn, 'gfall-1')
+    assert run_stages == ['ion_xs', 'artificial_levels']
+    build(conn, 'gfall-1')
+    assert run_stages == []
+
+    reference_conn = construct_atom_db.build_kurucz_db(
+        sqlite3.connect(str(tmpdir.join('kurucz_reference.db3'))),
+        read_gfall=lambda: read_gfall_raw(gfall_fname))
+    for table in ('gfall', 'lines', 'levels', 'ion_cx'):
+        select_stmt = 'SELECT * FROM {0} ORDER BY id'.format(table)
+        assert (conn.execute(select_stmt).fetchall() ==
+                reference_conn.execute(select_stmt).fetchall())
+
+    build(conn, 'gfall-2')
+    assert run_stages == [name for name, _ in build_stages]
@@ -0,0 +1,242 @@
+import gzip
+import bz2
+
+import pytest
+
+import numpy as np
+import numpy.testing as nptesting
+
+import pandas as pd
+
+from tardisatomic.kurucz.io.gfall import (read_gfall_raw, iter_gfall_raw,
+                                          parse_gfall, iter_gfall,
+                                          extract_levels, extract_lines,
+                                          gfall_basic_columns,
+                                          gfall_columns, gfall_field_slices)
+from tardisatomic.tests.conftest import (gfall_test_lines, make_gfall_line,
+                                         assert_frames_equal)
+
+
+def test_read_gfall_raw_bytes(gfall_fname):
+    gfall = read_gfall_raw(gfall_fname)
+    assert len(gfall) == len(gfall_test_lines)
+    nptesting.assert_array_equal(gfall.wavelength.values,
+                                 [line[0] for line in gfall_test_lines])
+    nptesting.assert_array_equal(gfall.e_second.values,
+                                 [line[6] for line in gfall_test_lines])
+    assert gfall.label_first[0].strip() == '3d6 4s a6D'
+    assert gfall.lande_g_first.dtype == np.int64
+    assert gfall.isotopic_shift[0] == 0
+
+
+def test_read_gfall_raw_engines_agree(gfall_fname, tmpdir):
+    assert_frames_equal(read_gfall_raw(gfall_fname, engine='bytes'),
+                        read_gfall_raw(gfall_fname, engine='genfromtxt'))
+
+    # fields with a sign or point but without digits are blank, not -0.0
+    dash_line = make_gfall_line(*gfall_test_lines[0])
+    for column, field in [('log_gamma_stark', '-'), ('log_f_hyperfine', '-.'),
+                          ('isotope', '-')]:
+        field_slice = gfall_field_slices[column][1]
+        dash_line = (dash_line[:field_slice.start] +
+                     field.rjust(field_slice.stop - field_slice.start) +
+                     dash_line[field_slice.stop:])
+    dash_fname = tmpdir.join('gfall_dash.dat')
+    dash_fname.write('header\nheader\n' + dash_line + '\n' +
+                     make_gfall_line(*gfall_test_lines[1]) + '\n')
+
+    gfall = read_gfall_raw(str(dash_fname), engine='bytes')
+    assert np.isnan(gfall.log_gamma_stark[0])
+    assert np.isnan(gfall.log_f_hyperfine[0])
+    assert gfall.isotope[0] == -1
+    assert_frames_equal(gfall, read_gfall_raw(str(dash_fname),
+                                              engine='genfromtxt'))
+
+
+@pytest.mark.parametrize('read_kwargs', [{}, {'n_jobs': 2}, {'atoms': [26]},
+                                         {'engine': 'genfromtxt'}])
+def test_read_gfall_raw_no_lines(tmpdir, read_kwargs):
+    gfall_fname = tmpdir.join('gfall_empty.dat')
+    gfall_fname.write('header\nheader\n')
+
+    gfall = read_gfall_raw(str(gfall_fname), **read_kwargs)
+    assert len(gfall) == 0
+    assert list(gfall.columns) == gfall_columns
+    assert list(iter_gfall_raw(str(gfall_fname))) == []
+
+
+def test_read_gfall_raw_ragged(tmpdir):
+    gfall_fname = tmpdir.join('gfall_ragged.dat')
+    gfall_fname.write('header\nheader\n' +
+                      make_gfall_line(*gfall_test_lines[0]) + '\n\n')
+    with pytest.raises(ValueError):
+        read_gfall_raw(str(gfall_fname))
+
+
+def test_read_gfall_raw_parallel(gfall_fname):
+    gfall = read_gfall_raw(gfall_fname)
+    gfall_parallel = read_gfall_raw(gfall_fname, n_jobs=3)
+    assert_frames_equal(gfall_parallel, gfall)
+    assert list(gfall_parallel.dtypes) == list(gfall.dtypes)
+    assert list(gfall_parallel.index) == list(gfall.index)
+
+
+def test_iter_gfall_raw(gfall_fname):
+    gfall_chunks = list(iter_gfall_raw(gfall_fname, chunksize=3))
+    assert [len(chunk) for chunk in gfall_chunks] == [3, 1]
+    assert_frames_equal(pd.concat(gfall_chunks), read_gfall_raw(gfall_fname))
+
+
+@pytest.mark.parametrize('engine', ['bytes', 'genfromtxt'])
+def test_read_gfall_raw_predicates(gfall_fname, engine):
+    gfall = read_gfall_raw(gfall_fname)
+
+    gfall_fe = read_gfall_raw(gfall_fname, engine=engine, atoms=[26])
+    assert list(gfall_fe.index) == [0, 2]
+    assert_frames_equal(gfall_fe, gfall.loc[[0, 2]])
+
+    gfall_species = read_gfall_raw(gfall_fname, engine=engine,
+                                   species=[(14, 0), (26, 2)])
+    assert list(gfall_species.index) == [1]
+
+    gfall_wavelength = read_gfall_raw(gfall_fname, engine=engine,
+                                      atoms=[1, 26],
+                                      wavelength_range=(299.7925, None))
+    assert list(gfall_wavelength.index) == [2, 3]
+
+
+def test_read_gfall_raw_predicates_chunked(gfall_fname):
+    gfall = read_gfall_raw(gfall_fname, n_jobs=2,
+                           wavelength_range=(100, 1000))
+    assert list(gfall.index) == [2, 3]
+    gfall_chunks = list(iter_gfall_raw(gfall_fname, chunksize=3,
+                                       wavelength_range=(100, 1000)))
+    assert [list(chunk.index) for chunk in gfall_chunks] == [[2], [3]]
+    assert_frames_equal(pd.concat(gfall_chunks), gfall)
+
+
+@pytest.mark.parametrize('compressed_open,extension',
+                         [(gzip.open, '.gz'), (bz2.BZ2File, '.bz2')])
+def test_read_gfall_raw_compressed(gfall_fname, compressed_open, extension):
+    compressed_fname = gfall_fname + extension
+    with open(gfall_fname, 'rb') as fh:
+        gfall_data = fh.read()
+    compressed_fh = compressed_open(compressed_fname, 'wb')
+    compressed_fh.write(gfall_data)
+    compressed_fh.close()
+
+    gfall = read_gfall_raw(gfall_fname)
+    assert_frames_equal(read_gfall_raw(compressed_fname), gfall)
+    gfall_chunks = list(iter_gfall_raw(compressed_fname, chunksize=3))
+    assert [len(chunk) for chunk in gfall_chunks] == [3, 1]
+    assert_frames_equal(pd.concat(gfall_chunks), gfall)
+
+
+def test_parse_gfall(gfall_fname):
+    gfall_raw = read_gfall_raw(gfall_fname)
+    gfall = parse_gfall(gfall_raw)
+    assert 'e_first' in gfall_raw.columns
+
+    nptesting.assert_allclose(gfall.e_lower.values[1], 77.115 * 1.239842e-4,
+                              rtol=1e-6)
+    assert gfall.e_lower_predicted.tolist() == [False, True, False, False]
+    assert gfall.e_upper_predicted.tolist() == [False, False, True, False]
+    assert gfall.label_lower.tolist() == ['3d6 4s a6D', '3s23p2 3P',
+                                          '3d6 4s a6D', '1s 2S']
+    assert gfall.g_upper.tolist() == [8., 3., 6., 2.]
+    assert gfall.atomic_number.tolist() == [26, 14, 26, 1]
+    assert gfall.ion_number.tolist() == [1, 0, 1, 0]
+    nptesting.assert_allclose(gfall.wavelength.values,
+                              [line[0] * 10 for line in gfall_test_lines])
+
+    gfall_inplace = parse_gfall(gfall_raw, inplace=True)
+    assert gfall_inplace is gfall_raw
+    assert_frames_equal(gfall_inplace, gfall)
+
+
+def test_extract_levels(gfall_fname):
+    levels = extract_levels(parse_gfall(read_gfall_raw(gfall_fname)))
+    assert levels.atomic_number.tolist() == [1, 1, 14, 14, 26, 26, 26, 26]
+    assert levels.level_number.tolist() == [0, 1, 0, 1, 0, 1, 2, 3]
+    assert levels.level_id.tolist() == range(8)
+    assert levels.label.tolist()[-2:] == ['x  a4F', '3d64p z6F']
+
+
+def test_extract_levels_shared_energy():
+    gfall = pd.DataFrame({'atomic_number':[26, 26, 26], 'ion_number':[0, 0, 0],
+                          'e_lower':[0.0, 0.0, 1.0], 'e_upper':[2.0, 1.0, 2.0],
+                          'g_lower':[1., 3., 3.], 'g_upper':[5., 1., 5.],
+                          'label_lower':['a', 'b', 'c'],
+                          'label_upper':['d', 'c', 'd'],
+                          'e_lower_predicted':[False] * 3,
+                          'e_upper_predicted':[False] * 3})
+    levels = extract_levels(gfall)
+    assert levels.energy.tolist() == [0.0, 0.0, 1.0, 1.0, 2.0]
+    assert levels.label.tolist() == ['a', 'b', 'c', 'c', 'd']
+    assert levels.level_number.tolist() == [0, 0, 1, 1, 2]
+    assert levels.level_id.tolist() == range(5)
+
+
+def test_extract_lines(gfall_fname):
+    gfall = parse_gfall(read_gfall_raw(gfall_fname))
+    levels = extract_levels(gfall)
+    lines = extract_lines(gfall, levels)
+    assert list(lines.columns) == ['wavelength', 'loggf', 'atomic_number',
+                                   'ion_number', 'level_id_lower',
+                                   'level_id_upper', 'level_number_lower',
+                                   'level_number_upper']
+    assert lines.level_id_lower.tolist() == [4, 2, 5, 0]
+    assert lines.level_id_upper.tolist() == [7, 3, 6, 1]
+    assert lines.level_number_lower.tolist() == [0, 0, 1, 0]
+    assert lines.level_number_upper.tolist() == [3, 1, 2, 1]
+
+    lines = extract_lines(gfall, levels[levels.level_id != 6])
+    assert lines.level_id_upper.tolist() == [7, 3, -1, 1]
+    assert lines.level_number_upper.tolist() == [3, 1, -1, 1]
+
+
+def test_read_gfall_raw_usecols(gfall_fname):
+    gfall = read_gfall_raw(gfall_fname)
+    columns = ['label_second', 'wavelength', 'isotope']
+    gfall_projected = read_gfall_raw(gfall_fname, usecols=columns)
+    assert list(gfall_projected.columns) == ['wavelength', 'label_second',
+                                             'isotope']
+    assert_frames_equal(gfall_projected, gfall[gfall_projected.columns])
+
+    with pytest.raises(ValueError):
+        read_gfall_raw(gfall_fname, usecols=['wavelength', 'hyperfine'])
+    with pytest.raises(ValueError):
+        parse_gfall(gfall_projected)
+
+
+def test_gfall_compact(gfall_fname):
+    gfall_raw = read_gfall_raw(gfall_fname, compact=True)
+    assert gfall_raw.label_first.dtype.name == 'category'
+    assert gfall_raw.isotope.dtype == np.int16
+    assert gfall_raw.log_gamma_rad.dtype == np.float32
+    assert gfall_raw.e_first.dtype == np.float64
+
+    gfall = parse_gfall(read_gfall_raw(gfall_fname))
+    gfall_compact = parse_gfall(read_gfall_raw(
+        gfall_fname, usecols=gfall_basic_columns, compact=True), compact=True)
+    assert gfall_compact.atomic_number.dtype == np.int8
+    assert gfall_compact.label_lower.dtype.name == 'category'
+    for column in gfall_compact.columns:
+        assert np.all(gfall_compact[column].values.astype(gfall[column].dtype)
+                      == gfall[column].values)
+
+    levels = extract_levels(gfall)
+    levels_compact = extract_levels(gfall_compact, compact=True)
+    assert levels_compact.label.dtype.name == 'category'
+    assert levels_compact.level_number.tolist() == levels.level_number.tolist()
+    assert levels_compact.label.tolist() == levels.label.tolist()
+    lines = extract_lines(gfall, levels)
+    lines_compact = extract_lines(gfall_compact, levels_compact)
+    assert (lines_compact.level_id_upper.tolist() ==
+            lines.level_id_upper.tolist())
+
+
+def test_extract_levels_chunked(gfall_fname):
+    levels = extract_levels(parse_gfall(read_gfall_raw(gfall_fname)))
+    levels_chunked = extract_levels(iter_gfall(gfall_fname, chunksize=2))
+    assert_frames_equal(levels, levels_chunked)
@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from tardisatomic.alchemy.ingest.kurucz import read_gfall_levels_lines
+from tardisatomic.tests.conftest import assert_frames_equal
+
+
+@pytest.mark.parametrize('atoms', [None, [26], [14, 26]])
+def test_read_gfall_levels_lines_cached(gfall_fname, tmpdir, atoms):
+    levels, lines = read_gfall_levels_lines(gfall_fname, atoms=atoms)
+    if atoms is not None:
+        assert sorted(set(levels.atomic_number)) == atoms
+        assert sorted(set(lines.atomic_number)) == atoms
+
+    cache_dir = str(tmpdir.join('cache'))
+    # cache miss and cache hit
+    for _ in range(2):
+        cached_levels, cached_lines = read_gfall_levels_lines(
+            gfall_fname, atoms=atoms, cache_dir=cache_dir)
+        assert_frames_equal(cached_levels, levels)
+        assert_frames_equal(cached_lines, lines)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from tardisatomic import keys
+
+
+def test_pack_unpack():
+    atomic_number = np.array([26, 26, 1, 1, 2], dtype=np.int8)
+    ion_number = np.array([25, 0, 0, 0, 1])
+    level_number = np.array([0, 2**40, 3, 0, 7])
+    level_keys = keys.pack(atomic_number, ion_number, level_number)
+    assert level_keys.dtype == np.int64
+    assert len(np.unique(level_keys)) == len(level_keys)
+    # the keys sort like the tuples
+    assert (np.argsort(level_keys).tolist() ==
+            sorted(range(5), key=lambda i: (atomic_number[i], ion_number[i],
+                                            level_number[i])))
+    for unpacked, values in zip(keys.unpack(level_keys),
+                                (atomic_number, ion_number, level_number)):
+        np.testing.assert_array_equal(unpacked, values)
+
+    np.testing.assert_array_equal(
+        keys.pack([1, 1, 1], [0, 0, 0], [-1, np.nan, 2.]),
+        [keys.missing_key, keys.missing_key, keys.pack(1, 0, 2)])
+    np.testing.assert_array_equal(keys.pack([26, 26], [1, 1]),
+                                  keys.pack([26, 26], [1, 1], [0, 0]))
+
+
+@pytest.mark.parametrize('assume_sorted', [True, False])
+def test_lookup(assume_sorted):
+    level_keys = keys.pack([1, 1, 2, 26, 2], [0, 0, 1, 3, 1], [0, 1, 0, 5, 0])
+    if assume_sorted:
+        level_keys = np.sort(level_keys)
+    query = np.r_[level_keys[::-1], keys.pack(3, 0, 0), keys.missing_key]
+    positions = keys.lookup(level_keys, query, assume_sorted=assume_sorted)
+    expected = [level_keys.tolist().index(key) if key in level_keys else -1
+                for key in query]
+    assert positions.tolist() == expected
+
+    assert keys.lookup([], query).tolist() == [-1] * len(query)
+    assert keys.isin(query, level_keys).tolist() == [
+        key in level_keys for key in query]
+
+
+def test_group_offsets():
+    group_keys = keys.pack([26, 1, 26, 1, 2, 26], [0, 0, 0, 0, 1, 0],
+                           [3, 0, 3, 1, 0, 3])
+    groups = keys.group_offsets(group_keys)
+    order, unique_keys, offsets = groups
+    np.testing.assert_array_equal(unique_keys, np.unique(group_keys))
+    for i, key in enumerate(unique_keys):
+        assert (order[offsets[i]:offsets[i + 1]].tolist() ==
+                np.flatnonzero(group_keys == key).tolist())
+
+    query = keys.pack([26, 3, 1, 26], [0, 0, 0, 0], [3, 0, 1, 3])
+    positions, counts = keys.gather_groups(groups, query)
+    assert counts.tolist() == [3, 0, 1, 3]
+    assert positions.tolist() == [0, 2, 5, 3, 0, 2, 5]
+
+    positions, counts = keys.gather_groups(keys.group_offsets([]), query)
+    assert len(positions) == 0
+    assert counts.tolist() == [0, 0, 0, 0]
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from tardisatomic import sqlite_ndarray
+from tardisatomic import construct_atom_db
+
+
+@pytest.fixture
+def ndarray_conn():
+    conn = sqlite_ndarray.connect(':memory:')
+    conn.execute('CREATE TABLE arrays(id integer primary key, '
+                 'ints int_ndarray, floats float_ndarray)')
+    return conn
+
+
+def test_ndarray_round_trip(ndarray_conn):
+    ints = np.arange(5, dtype=np.int32)
+    floats = np.linspace(0, 1, 7)[::2]
+    ndarray_conn.execute('INSERT INTO arrays(ints, floats) VALUES (?, ?)',
+                         (ints, floats))
+    ints_db, floats_db = ndarray_conn.execute(
+        'SELECT ints, floats FROM arrays').fetchone()
+    assert ints_db.dtype == np.int64
+    np.testing.assert_array_equal(ints_db, ints)
+    np.testing.assert_array_equal(floats_db, floats)
+
+    with pytest.raises(TypeError):
+        sqlite_ndarray.adapt_ndarray(np.array(['a']))
+
+
+def test_read_ragged(ndarray_conn):
+    arrays = [(np.arange(3), np.ones(1)), (np.arange(0), None),
+              (np.arange(2) + 10, np.zeros(4))]
+    ndarray_conn.executemany('INSERT INTO arrays(ints, floats) VALUES (?, ?)',
+                             arrays)
+    ids, ragged = sqlite_ndarray.read_ragged(ndarray_conn, 'arrays',
+                                             ['ints', 'floats'])
+    np.testing.assert_array_equal(ids, [1, 2, 3])
+    for column, (offsets, values) in zip(['ints', 'floats'], ragged.values()):
+        assert values.dtype == sqlite_ndarray.ndarray_dtypes[
+            {'ints': 'int_ndarray', 'floats': 'float_ndarray'}[column]]
+        for i, row in enumerate(arrays):
+            expected = row[column == 'floats']
+            if expected is None:
+                expected = []
+            np.testing.assert_array_equal(
+                values[offsets[i]:offsets[i + 1]], expected)
+
+    ids, ragged = sqlite_ndarray.read_ragged(ndarray_conn, 'arrays', ['ints'],
+                                             where_stmt='WHERE id > 5')
+    assert len(ids) == 0
+    np.testing.assert_array_equal(ragged['ints'][0], [0])
+
+
+def test_read_ragged_macro_atom(linked_conn, kurucz_dbname):
+    construct_atom_db.create_macro_atom(linked_conn)
+    conn = sqlite_ndarray.connect(kurucz_dbname)
+    rows = conn.execute('SELECT id, count_down, reference_down, '
+                        'p_internal_up FROM macro_atom ORDER BY id').fetchall()
+    ids, ragged = sqlite_ndarray.read_ragged(
+        conn, 'macro_atom', ['reference_down', 'p_internal_up'])
+    np.testing.assert_array_equal(ids, [row[0] for row in rows])
+
+    offsets, reference_down = ragged['reference_down']
+    np.testing.assert_array_equal(np.diff(offsets), [row[1] for row in rows])
+    for i, row in enumerate(rows):
+        np.testing.assert_array_equal(
+            reference_down[offsets[i]:offsets[i + 1]], row[2])
+        offsets_up, p_internal_up = ragged['p_internal_up']
+        np.testing.assert_array_equal(
+            p_internal_up[offsets_up[i]:offsets_up[i + 1]], row[3])
+
+
+@pytest.mark.parametrize('size', [None, 0, 1, 1000])
+def test_read_structured(linked_conn, size):
+    select_stmt = ('SELECT id, wavelength, atom, level_id_lower, source '
+                   'FROM lines WHERE atom >= ? ORDER BY wavelength')
+    dtype = [('line_id', np.int64), ('wavelength', np.float64),
+             ('atomic_number', np.int64), ('level_number_lower', np.int64),
+             ('source', '|S64')]
+    expected = np.array(linked_conn.execute(select_stmt, (2,)).fetchall(),
+                        dtype=dtype)
+    assert len(expected) > 1
+
+    data = sqlite_ndarray.read_structured(linked_conn, select_stmt, dtype,
+                                          parameters=(2,), size=size,
+                                          chunksize=1)
+    assert data.dtype == np.dtype(dtype)
+    np.testing.assert_array_equal(data, expected)
+
+    empty = sqlite_ndarray.read_structured(linked_conn, select_stmt, dtype,
+                                           parameters=(100,), size=size)
+    assert empty.dtype == np.dtype(dtype)
+    assert len(empty) == 0